@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Measure import and startup time of the command line interface with
+``python -X importtime``, compare with a baseline. See README.md."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Modules which must not be imported just to start the command line
+# interface, only when the code path which needs them runs.
+HEAVY = ['multiprocessing',
+         'concurrent.futures.process',
+         'concurrent.futures.thread',
+         'numpy',
+         'matplotlib',
+         ]
+
+
+def importtime(module, repeat=10):
+    """Return (min cumulative import time of `module` in us, set of all
+    imported modules)."""
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               f'import {module}'],
+                              stderr=subprocess.PIPE, check=True, text=True)
+        # import time: self [us] | cumulative | imported package
+        modules = set()
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            name = name.strip()
+            modules.add(name)
+            if name == module:
+                times.append(int(cumulative))
+    return min(times), modules
+
+
+def walltime(cmd, repeat=10):
+    """Min wall time of running `cmd` in s."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def run(repeat=10):
+    cli_us, modules = importtime('findsame.cli', repeat=repeat)
+    return dict(python=sys.version.split()[0],
+                cli_import_us=cli_us,
+                interpreter_s=walltime([sys.executable, '-c', 'pass'],
+                                       repeat=repeat),
+                cli_help_s=walltime([sys.executable, '-m', 'findsame.cli',
+                                     '-h'], repeat=repeat),
+                heavy=sorted(mod for mod in HEAVY if mod in modules),
+                )
+
+
+def compare(result, baseline, tol):
+    """Return list of regressions of `result` w.r.t. `baseline`."""
+    msgs = [f"heavy module imported at startup: {mod}"
+            for mod in result['heavy']]
+    for key in ['cli_import_us', 'cli_help_s']:
+        if result[key] > baseline[key] * (1 + tol):
+            msgs.append(f"{key}: {result[key]} > {baseline[key]} "
+                        f"(baseline) + {tol*100:.0f}%")
+    return msgs
+
+
+if __name__ == '__main__':
+    here = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="number of runs, we use the fastest "
+                             "[default: %(default)s]")
+    parser.add_argument("-b", "--baseline",
+                        default=os.path.join(here, 'baseline.json'),
+                        help="[default: %(default)s]")
+    parser.add_argument("-s", "--save", action="store_true",
+                        help="store result as new baseline")
+    parser.add_argument("--tol", type=float, default=0.2,
+                        help="allowed relative slowdown [default: %(default)s]")
+    args = parser.parse_args()
+
+    result = run(repeat=args.repeat)
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.baseline, 'w') as fd:
+            json.dump(result, fd, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as fd:
+            msgs = compare(result, json.load(fd), args.tol)
+        for msg in msgs:
+            print(f"REGRESSION: {msg}")
+        sys.exit(1 if msgs else 0)
+    elif result['heavy']:
+        sys.exit(f"heavy modules imported at startup: {result['heavy']}")
@@ -0,0 +1,3 @@
+#!/bin/sh
+
+rm -f baseline.json
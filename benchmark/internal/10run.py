@@ -3,6 +3,7 @@
 import os
 import textwrap
 import timeit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tempfile import mkdtemp
 
 import numpy as np
@@ -29,17 +30,11 @@ run("sudo -A sh -c 'sync; echo 3 > /proc/sys/vm/drop_caches'", shell=True)
 """
 
 # This code is executed by timeit in callback() before each benchmark run. Each
-# run (bench_func) may modify cfg -- the package-wide configuration dict
-# findsame.config.cfg -- before calling the package's main.main() or other
-# functions. Since this script here is run by a single Python interpreter,
-# changes to cfg are persistent from one bench_func to another. This is by
-# design, but in this context here a subtle gotcha. Therefore, we need to reset
-# cfg to default_cfg before doing anything else in each run.
+# run (bench_func) creates its own findsame.Engine with the config values it
+# wants to test, so there is no package-wide state (findsame.config.cfg) which
+# we'd need to reset between runs.
 default_setup = f"""
-from findsame import main
-from findsame.config import cfg, default_cfg
-
-cfg.update(default_cfg)
+from findsame import Engine
 
 {cache_flush_setup}
 """
@@ -164,8 +159,8 @@ def write_collection(collection_size=GiB, min_size=128*KiB, tmpdir=None,
 
 def bench_main_blocksize_filesize(tmpdir, maxsize):
     stmt = textwrap.dedent("""
-        cfg.update(blocksize={blocksize})
-        main.main({files_dirs})
+        with Engine(blocksize={blocksize}) as engine:
+            engine.scan({files_dirs})
         """)
     params = []
 
@@ -210,11 +205,11 @@ def bench_main_blocksize_filesize(tmpdir, maxsize):
 
 def bench_main_parallel(tmpdir, maxsize):
     stmt = textwrap.dedent("""
-        cfg.update(blocksize={blocksize},
-                   nthreads={nthreads},
-                   nprocs={nprocs},
-                   share_leafs={share_leafs})
-        main.main({files_dirs})
+        with Engine(blocksize={blocksize},
+                    nthreads={nthreads},
+                    nprocs={nprocs},
+                    share_leafs={share_leafs}) as engine:
+            engine.scan({files_dirs})
         """)
     params = []
 
@@ -254,10 +249,10 @@ def bench_main_parallel(tmpdir, maxsize):
 
 def bench_main_parallel_2d(tmpdir, maxsize):
     stmt = textwrap.dedent("""
-        cfg.update(blocksize={blocksize},
-                   nthreads={nthreads},
-                   nprocs={nprocs})
-        main.main({files_dirs})
+        with Engine(blocksize={blocksize},
+                    nthreads={nthreads},
+                    nprocs={nprocs}) as engine:
+            engine.scan({files_dirs})
         """)
     params = []
 
@@ -288,8 +283,8 @@ def bench_hash_file_parallel(tmpdir, maxsize):
                                                   study=study)
 
     pool_map = {'seq': pl.SequentialPoolExecutor,
-                'thread': pl.ThreadPoolExecutor,
-                'proc': pl.ProcessPoolExecutor,
+                'thread': ThreadPoolExecutor,
+                'proc': ProcessPoolExecutor,
                 'proc,thread=1': lambda nw: pl.ProcessAndThreadPoolExecutor(nw, 1),
                 'thread,proc=1': lambda nw: pl.ProcessAndThreadPoolExecutor(1, nw),
                 }
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""Run the benchmark suite, write results as json. Compare with
+20compare.py. See README.md."""
+
+import argparse
+import os
+import time
+
+from findsame import Engine
+from findsame.common import KiB, MiB, size2str
+
+import benchlib as bl
+
+pj = os.path.join
+
+
+def scenarios(mixes, ncores):
+    """Yield dicts with one benchmark scenario each."""
+    for mix in mixes:
+        for blocksize in [64*KiB, 256*KiB, 1*MiB]:
+            yield dict(mix=mix, blocksize=blocksize, pool='thread',
+                       nworkers=ncores)
+        for pool, nworkers in [('seq', 1), ('proc', ncores)]:
+            yield dict(mix=mix, blocksize=256*KiB, pool=pool,
+                       nworkers=nworkers)
+
+
+def scenario_id(sc):
+    """Key by which results are compared."""
+    return (f"{sc['mix']}/bs={size2str(sc['blocksize'])}/"
+            f"{sc['pool']}x{sc['nworkers']}/{sc['cache']}")
+
+
+def engine_kwds(sc):
+    nworkers = sc['nworkers']
+    return dict(blocksize=sc['blocksize'],
+                nthreads=nworkers if sc['pool'] == 'thread' else 1,
+                nprocs=nworkers if sc['pool'] == 'proc' else 1)
+
+
+def run(datadir, mixes, repeat=3, caches=('cold', 'warm'), scale=1.0):
+    ncores = os.cpu_count()
+    results = []
+    for sc in scenarios(mixes, ncores):
+        mix = sc['mix']
+        dr = bl.write_mix(pj(datadir, f'{mix}_{scale}'),
+                          bl.scale_mix(bl.MIXES[mix], scale))
+        nbytes = bl.data_size([dr])
+        nfiles = sum(1 for _ in bl.iter_files([dr]))
+        for cache in caches:
+            if cache == 'cold' and not bl.can_evict():
+                continue
+            sc = dict(sc, cache=cache)
+            # new engine for each call, else we'd measure the fpr cache
+            def func():
+                with Engine(**engine_kwds(sc)) as engine:
+                    engine.scan([dr])
+            if cache == 'warm':
+                func()
+            timing = bl.timeit(func, repeat=repeat,
+                               cold_paths=[dr] if cache == 'cold' else None)
+            res = dict(sc, scenario=scenario_id(sc), time=timing,
+                       nbytes=nbytes, nfiles=nfiles,
+                       mb_per_s=nbytes / timing / MiB)
+            print(f"{res['scenario']:40} {timing:8.3f} s "
+                  f"{res['mb_per_s']:8.1f} MiB/s")
+            results.append(res)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--datadir", default="files",
+                        help="where to write test data, re-used in later "
+                             "runs [default: %(default)s]")
+    parser.add_argument("-o", "--output",
+                        help="result file [default: "
+                             "results/<hostname>_<time>.json]")
+    parser.add_argument("-m", "--mix", action="append",
+                        choices=list(bl.MIXES.keys()),
+                        help="file size mix, can be repeated [default: all]")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of runs per scenario, we use the "
+                             "fastest [default: %(default)s]")
+    parser.add_argument("-q", "--quick", action="store_true",
+                        help="10x less files, for testing the suite")
+    args = parser.parse_args()
+
+    mixes = list(bl.MIXES.keys()) if args.mix is None else args.mix
+    scale = 0.1 if args.quick else 1.0
+    os.makedirs(args.datadir, exist_ok=True)
+    info = bl.machine_info(args.datadir)
+    if not info['evict']:
+        print("posix_fadvise() not available, skip cold cache runs")
+    results = run(args.datadir, mixes, repeat=args.repeat, scale=scale)
+    output = args.output
+    if output is None:
+        stamp = time.strftime('%Y-%m-%dT%H-%M-%S')
+        output = pj('results', f"{info['hostname']}_{stamp}.json")
+    bl.write_results(output, results, dict(info, scale=scale))
+    print(f"wrote {output}")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Compare a result of 10run.py with a baseline result, per scenario. Exit
+with 1 if any scenario is slower than the baseline by more than TOL."""
+
+import argparse
+import sys
+
+import benchlib as bl
+
+# metadata which must be the same for a meaningful comparison
+MACHINE_KEYS = ['hostname', 'cpu', 'ncores', 'fstype', 'scale']
+
+
+def compare(result, baseline, tol=0.1):
+    """Return list of (scenario, time, baseline time, relative change,
+    status), where status is one of 'ok', 'faster', 'SLOWER', 'new',
+    'missing'."""
+    res = dict((rr['scenario'], rr) for rr in result['results'])
+    base = dict((rr['scenario'], rr) for rr in baseline['results'])
+    rows = []
+    for key in sorted(set(res) | set(base)):
+        if key not in base:
+            rows.append((key, res[key]['time'], None, None, 'new'))
+        elif key not in res:
+            rows.append((key, None, base[key]['time'], None, 'missing'))
+        else:
+            tt = res[key]['time']
+            tb = base[key]['time']
+            rel = (tt - tb) / tb
+            if rel > tol:
+                status = 'SLOWER'
+            elif rel < -tol:
+                status = 'faster'
+            else:
+                status = 'ok'
+            rows.append((key, tt, tb, rel, status))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("result", help="result of 10run.py")
+    parser.add_argument("baseline", help="baseline result of 10run.py")
+    parser.add_argument("-t", "--tol", type=float, default=0.1,
+                        help="allowed relative slowdown [default: %(default)s]")
+    args = parser.parse_args()
+
+    result = bl.read_results(args.result)
+    baseline = bl.read_results(args.baseline)
+    for key in MACHINE_KEYS:
+        va = result['machine'].get(key)
+        vb = baseline['machine'].get(key)
+        if va != vb:
+            print(f"WARNING: {key} differs: {va} (result) vs. {vb} "
+                  f"(baseline)")
+
+    fmt = lambda x: '-' if x is None else f"{x:.3f}"
+    nslower = 0
+    for key, tt, tb, rel, status in compare(result, baseline, tol=args.tol):
+        relstr = '-' if rel is None else f"{rel*100:+.1f}%"
+        print(f"{key:40} {fmt(tt):>9} {fmt(tb):>9} {relstr:>8} {status}")
+        nslower += status == 'SLOWER'
+    if nslower > 0:
+        print(f"{nslower} regression(s)")
+    sys.exit(1 if nslower > 0 else 0)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""Time the in-memory phases of a scan (tree building, node fprs, grouping)
+separately on generated trees of growing size, to see where scaling breaks
+down. Writes the same result format as 10run.py, compare with
+20compare.py."""
+
+import argparse
+import os
+import resource
+import time
+
+from findsame import calc, main
+from findsame import common as co
+from findsame.config import Config, default_cfg
+
+import benchlib as bl
+from gentree import TreeGenerator, fanout_for
+
+pj = os.path.join
+
+
+def timed(func):
+    t0 = time.perf_counter()
+    ret = func()
+    return time.perf_counter() - t0, ret
+
+
+def phases(root):
+    """Return dict {phase: time} for one scan of `root`, single process and
+    thread."""
+    cfg = Config(default_cfg)
+    times = {}
+    times['build_tree'], tree = timed(lambda: calc.FileDirTree(dr=root))
+    mt = calc.MerkleTree(tree, cfg=cfg)
+    # not in-memory, but needed for the rest, files are tiny
+    times['calc_leaf_fprs'], _ = timed(mt.calc_leaf_fprs)
+    times['calc_node_fprs'], _ = timed(mt.calc_node_fprs)
+    times['invert_dict'], _ = timed(lambda: (co.invert_dict(mt.leaf_fprs),
+                                             co.invert_dict(mt.node_fprs)))
+    # leaf and node fprs are cached in the tree's elements (lazyprop), so
+    # this is mostly iter_groups() and building the result
+    times['assemble_result'], _ = timed(lambda: main.assemble_result(mt))
+    return times, len(tree.leafs), len(tree.nodes)
+
+
+def run(datadir, scales, depth=3, files_per_dir=10, repeat=1):
+    results = []
+    for target in scales:
+        fanout = fanout_for(target, depth=depth, files_per_dir=files_per_dir)
+        root = pj(datadir, f'tree_d{depth}_f{fanout}_n{files_per_dir}')
+        if not os.path.exists(root):
+            print(f"generate {root}")
+            TreeGenerator(depth=depth, fanout=fanout,
+                          files_per_dir=files_per_dir).generate(root + '.tmp')
+            os.rename(root + '.tmp', root)
+        best = None
+        for _ in range(repeat):
+            times, nleafs, nnodes = phases(root)
+            best = times if best is None else \
+                dict((kk, min(vv, best[kk])) for kk, vv in times.items())
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        for phase, timing in best.items():
+            res = dict(scenario=f"phases/files={target}/{phase}",
+                       phase=phase, nfiles=nleafs, ndirs=nnodes, time=timing,
+                       us_per_entry=timing / (nleafs + nnodes) * 1e6,
+                       maxrss=maxrss)
+            print(f"{res['scenario']:45} {timing:8.3f} s "
+                  f"{res['us_per_entry']:8.2f} us/entry")
+            results.append(res)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--datadir", default="files",
+                        help="where to write trees, re-used in later runs "
+                             "[default: %(default)s]")
+    parser.add_argument("-o", "--output",
+                        help="result file [default: "
+                             "results/phases_<hostname>_<time>.json]")
+    parser.add_argument("-s", "--scales", default="1e3,1e4,1e5,1e6",
+                        help="comma separated approximate numbers of files "
+                             "[default: %(default)s]")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="number of runs per scale, we use the fastest "
+                             "per phase [default: %(default)s]")
+    args = parser.parse_args()
+
+    scales = [int(float(xx)) for xx in args.scales.split(',')]
+    os.makedirs(args.datadir, exist_ok=True)
+    info = bl.machine_info(args.datadir)
+    results = run(args.datadir, scales, repeat=args.repeat)
+    output = args.output
+    if output is None:
+        stamp = time.strftime('%Y-%m-%dT%H-%M-%S')
+        output = pj('results', f"phases_{info['hostname']}_{stamp}.json")
+    bl.write_results(output, results, dict(info, scales=scales))
+    print(f"wrote {output}")
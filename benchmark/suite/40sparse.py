@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Time scans of large sparse files (VM and database images) with and w/o
+--sparse. Files have a share of data regions (`--data-ratios`) spread over
+the file, the rest are holes. Writes the same result format as 10run.py,
+compare with 20compare.py."""
+
+import argparse
+import os
+import random
+import time
+
+from findsame import Engine
+from findsame.common import MiB, size2str, str2size
+
+import benchlib as bl
+from gentree import write_file
+
+pj = os.path.join
+
+# size of each data region
+EXTENT = 1*MiB
+
+
+def write_sparse(path, size, data_ratio, seed=0):
+    """Write sparse file of `size` bytes where about `data_ratio` of all
+    EXTENT sized regions are random data, the rest are holes."""
+    rng = random.Random(seed)
+    # first 8 bytes: content id, see gentree
+    write_file(path, seed, size=size, sparse=True)
+    with open(path, 'r+b') as fd:
+        for pos in range(EXTENT, size - EXTENT, EXTENT):
+            if rng.random() < data_ratio:
+                fd.seek(pos)
+                fd.write(rng.randbytes(EXTENT))
+
+
+def run(datadir, sizes, ratios, nfiles=2, repeat=3, caches=('cold', 'warm')):
+    results = []
+    for size in sizes:
+        for ratio in ratios:
+            dr = pj(datadir, f'sparse_{size2str(size)}_{ratio}')
+            if not os.path.exists(dr):
+                os.makedirs(dr + '.tmp')
+                for ii in range(nfiles):
+                    write_sparse(pj(dr + '.tmp', f'file_{ii}'), size, ratio,
+                                 seed=ii)
+                os.rename(dr + '.tmp', dr)
+            for sparse in [False, True]:
+                for cache in caches:
+                    if cache == 'cold' and not bl.can_evict():
+                        continue
+                    def func():
+                        with Engine(sparse=sparse, nthreads=nfiles,
+                                    blocksize=1*MiB) as engine:
+                            engine.scan([dr])
+                    if cache == 'warm':
+                        func()
+                    timing = bl.timeit(func, repeat=repeat,
+                                       cold_paths=[dr] if cache == 'cold'
+                                       else None)
+                    nbytes = size * nfiles
+                    mode = 'sparse' if sparse else 'full'
+                    res = dict(scenario=f"sparse/size={size2str(size)}/"
+                                        f"data={ratio}/{mode}/{cache}",
+                               size=size, data_ratio=ratio, sparse=sparse,
+                               cache=cache, nfiles=nfiles, time=timing,
+                               nbytes=nbytes,
+                               mb_per_s=nbytes / timing / MiB)
+                    print(f"{res['scenario']:45} {timing:8.3f} s "
+                          f"{res['mb_per_s']:10.1f} MiB/s (apparent)")
+                    results.append(res)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--datadir", default="files",
+                        help="where to write files, re-used in later runs "
+                             "[default: %(default)s]")
+    parser.add_argument("-o", "--output",
+                        help="result file [default: "
+                             "results/sparse_<hostname>_<time>.json]")
+    parser.add_argument("-s", "--sizes", default="1G,8G",
+                        help="comma separated file sizes "
+                             "[default: %(default)s]")
+    parser.add_argument("--data-ratios", default="0,0.1",
+                        help="comma separated shares of data regions "
+                             "[default: %(default)s]")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of runs per scenario, we use the "
+                             "fastest [default: %(default)s]")
+    args = parser.parse_args()
+
+    sizes = [str2size(xx) for xx in args.sizes.split(',')]
+    ratios = [float(xx) for xx in args.data_ratios.split(',')]
+    os.makedirs(args.datadir, exist_ok=True)
+    info = bl.machine_info(args.datadir)
+    results = run(args.datadir, sizes, ratios, repeat=args.repeat)
+    output = args.output
+    if output is None:
+        stamp = time.strftime('%Y-%m-%dT%H-%M-%S')
+        output = pj('results', f"sparse_{info['hostname']}_{stamp}.json")
+    bl.write_results(output, results, dict(info, sizes=sizes, ratios=ratios))
+    print(f"wrote {output}")
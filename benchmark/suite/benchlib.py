@@ -0,0 +1,168 @@
+"""Helpers for the benchmark suite: test data, per-file cache eviction,
+timing, machine metadata and result files. See README.md."""
+
+import json
+import os
+import platform
+import subprocess
+import time
+
+from findsame.common import KiB, MiB, size2str
+
+pj = os.path.join
+
+
+#------------------------------------------------------------------------------
+# page cache
+#------------------------------------------------------------------------------
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    yield pj(root, name)
+        else:
+            yield path
+
+
+def evict(paths):
+    """Drop all files in `paths` (files and/or dirs) from the page cache with
+    posix_fadvise(POSIX_FADV_DONTNEED). Unlike ``echo 3 >
+    /proc/sys/vm/drop_caches``, this needs no root and doesn't affect other
+    processes on the machine. Dirty pages are written first, else the kernel
+    would keep them. Dentries and inodes stay cached, so this gives cold
+    *data* reads only.
+    """
+    for fn in iter_files(paths):
+        fd = os.open(fn, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def can_evict():
+    return hasattr(os, 'posix_fadvise')
+
+
+#------------------------------------------------------------------------------
+# test data
+#------------------------------------------------------------------------------
+
+# file size mixes: list of (file size, number of files)
+MIXES = {
+    'small': [(4*KiB, 2000), (32*KiB, 500)],
+    'large': [(64*MiB, 4)],
+    'mixed': [(4*KiB, 500), (128*KiB, 100), (4*MiB, 10), (32*MiB, 2)],
+    }
+
+
+def scale_mix(mix, scale):
+    """Scale number of files in `mix` by `scale`, keep at least 1."""
+    return [(size, max(1, int(nfiles * scale))) for size, nfiles in mix]
+
+
+def write_mix(dr, mix, dup_every=4):
+    """Write files for `mix` to `dr`, skip if `dr` exists. Every
+    `dup_every`-th file is a copy of the one before, such that there is
+    something to find. Return `dr`."""
+    if os.path.exists(dr):
+        return dr
+    tmp = dr + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    for size, nfiles in mix:
+        sub = pj(tmp, f'filesize_{size2str(size)}')
+        os.makedirs(sub, exist_ok=True)
+        last = None
+        for ii in range(nfiles):
+            if last is not None and ii % dup_every == 0:
+                data = last
+            else:
+                data = os.urandom(size)
+            with open(pj(sub, f'file_{ii}'), 'wb') as fd:
+                fd.write(data)
+            last = data
+    os.rename(tmp, dr)
+    return dr
+
+
+def data_size(paths):
+    return sum(os.path.getsize(fn) for fn in iter_files(paths))
+
+
+#------------------------------------------------------------------------------
+# timing, metadata, results
+#------------------------------------------------------------------------------
+
+def timeit(func, repeat=3, cold_paths=None):
+    """Min wall time of `repeat` calls of `func`. With `cold_paths`, evict
+    those from the page cache before each call."""
+    times = []
+    for _ in range(repeat):
+        if cold_paths is not None:
+            evict(cold_paths)
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def _read(fn):
+    try:
+        with open(fn) as fd:
+            return fd.read()
+    except OSError:
+        return ''
+
+
+def git_rev():
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                          cwd=here, capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def machine_info(datadir=None):
+    """Dict with info about the machine and software, stored with each
+    result, such that we only compare results from the same setup."""
+    cpu = None
+    for line in _read('/proc/cpuinfo').splitlines():
+        if line.startswith('model name'):
+            cpu = line.split(':', 1)[1].strip()
+            break
+    mem = None
+    for line in _read('/proc/meminfo').splitlines():
+        if line.startswith('MemTotal'):
+            mem = int(line.split()[1]) * KiB
+            break
+    info = dict(hostname=platform.node(),
+                system=platform.system(),
+                release=platform.release(),
+                machine=platform.machine(),
+                cpu=cpu,
+                ncores=os.cpu_count(),
+                mem=mem,
+                python=platform.python_version(),
+                findsame=git_rev(),
+                evict=can_evict())
+    if datadir is not None:
+        # file system type of the data dir
+        proc = subprocess.run(['stat', '-f', '-c', '%T', datadir],
+                              capture_output=True, text=True)
+        info['fstype'] = proc.stdout.strip() or None
+    return info
+
+
+def write_results(fn, results, info):
+    os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+    with open(fn, 'w') as fd:
+        json.dump(dict(machine=info,
+                       time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       results=results), fd, indent=2)
+
+
+def read_results(fn):
+    with open(fn) as fd:
+        return json.load(fd)
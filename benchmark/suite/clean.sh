@@ -0,0 +1,3 @@
+#!/bin/sh
+
+rm -rf files results
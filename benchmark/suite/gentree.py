@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""Generate a synthetic file tree with many entries, controlled duplicate
+ratios and duplicated subtrees, cheap on disk (tiny or sparse files)."""
+
+import argparse
+import json
+import os
+import random
+
+pj = os.path.join
+
+# Each file starts with an 8 byte content id, followed by zeros (sparse:
+# a hole) up to its size. Same id = same content.
+ID_SIZE = 8
+
+
+def write_file(path, cid, size=ID_SIZE, sparse=False):
+    assert size >= ID_SIZE, f"size={size} < {ID_SIZE}"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, cid.to_bytes(ID_SIZE, 'little'))
+        if size > ID_SIZE:
+            if sparse:
+                os.ftruncate(fd, size)
+            else:
+                os.write(fd, bytes(size - ID_SIZE))
+    finally:
+        os.close(fd)
+
+
+def read_file(path):
+    """Return (content id, size) of a file written by write_file()."""
+    with open(path, 'rb') as fd:
+        cid = int.from_bytes(fd.read(ID_SIZE), 'little')
+    return cid, os.path.getsize(path)
+
+
+def copy_tree(src, dst, sparse=False):
+    """Copy a tree written by gentree(), keep files sparse. Return number of
+    files."""
+    nfiles = 0
+    for root, dirs, files in os.walk(src):
+        target = pj(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            cid, size = read_file(pj(root, name))
+            write_file(pj(target, name), cid, size=size, sparse=sparse)
+            nfiles += 1
+    return nfiles
+
+
+class TreeGenerator:
+    """
+    Parameters
+    ----------
+    depth : int
+        number of dir levels below the root
+    fanout : int
+        number of sub-dirs per dir
+    files_per_dir : int
+        number of files in each dir
+    size : int
+        file size in bytes (>= 8)
+    sparse : bool
+        write files as 8 bytes + hole, such that `size` costs no disk space
+    dup_ratio : float
+        probability that a file is a copy of another one, copies are drawn
+        from a pool of `dup_pool` contents, which gives groups of
+        duplicates spread over the whole tree
+    dup_subtree_ratio : float
+        probability that a sub-dir is a copy of an earlier generated
+        sub-dir on the same level (whole subtree)
+    seed : int
+    """
+    def __init__(self, depth=3, fanout=10, files_per_dir=10, size=ID_SIZE,
+                 sparse=False, dup_ratio=0.1, dup_subtree_ratio=0.02,
+                 dup_pool=1000, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.files_per_dir = files_per_dir
+        self.size = size
+        self.sparse = sparse
+        self.dup_ratio = dup_ratio
+        self.dup_subtree_ratio = dup_subtree_ratio
+        self.dup_pool = dup_pool
+        self.rng = random.Random(seed)
+
+    def content_id(self):
+        if self.rng.random() < self.dup_ratio:
+            self.stats['dup_files'] += 1
+            return self.rng.randrange(self.dup_pool)
+        # ids >= dup_pool are unique
+        return self.dup_pool + next(self._unique)
+
+    def _gen_dir(self, path, level):
+        os.makedirs(path, exist_ok=True)
+        self.stats['dirs'] += 1
+        for ii in range(self.files_per_dir):
+            write_file(pj(path, f'file_{ii}'), self.content_id(),
+                       size=self.size, sparse=self.sparse)
+            self.stats['files'] += 1
+        if level < self.depth:
+            for jj in range(self.fanout):
+                sub = pj(path, f'dir_{jj}')
+                done = self._done[level + 1]
+                if done and self.rng.random() < self.dup_subtree_ratio:
+                    nfiles = copy_tree(self.rng.choice(done), sub,
+                                       sparse=self.sparse)
+                    self.stats['files'] += nfiles
+                    self.stats['dup_files_in_subtrees'] += nfiles
+                    self.stats['dup_subtrees'] += 1
+                else:
+                    self._gen_dir(sub, level + 1)
+        self._done[level].append(path)
+
+    def generate(self, root):
+        """Write tree to `root`, return dict with statistics."""
+        self.stats = dict(files=0, dirs=0, dup_files=0, dup_subtrees=0,
+                          dup_files_in_subtrees=0)
+        self._unique = iter(range(2**62))
+        self._done = dict((level, []) for level in range(self.depth + 1))
+        self._gen_dir(root, 0)
+        self.stats['bytes'] = self.stats['files'] * self.size
+        return self.stats
+
+
+def nfiles(depth, fanout, files_per_dir):
+    """Number of files in a tree w/o duplicated subtrees."""
+    return files_per_dir * sum(fanout**level for level in range(depth + 1))
+
+
+def fanout_for(target_nfiles, depth=3, files_per_dir=10):
+    """Smallest fanout which gives at least `target_nfiles` files."""
+    fanout = 1
+    while nfiles(depth, fanout, files_per_dir) < target_nfiles:
+        fanout += 1
+    return fanout
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", help="dir to write, must not exist")
+    parser.add_argument("-d", "--depth", type=int, default=3)
+    parser.add_argument("-f", "--fanout", type=int, default=10)
+    parser.add_argument("-n", "--files-per-dir", type=int, default=10)
+    parser.add_argument("-s", "--size", type=int, default=ID_SIZE,
+                        help="file size in bytes [default: %(default)s]")
+    parser.add_argument("--sparse", action="store_true",
+                        help="write sparse files")
+    parser.add_argument("--dup-ratio", type=float, default=0.1,
+                        help="share of duplicate files [default: %(default)s]")
+    parser.add_argument("--dup-subtree-ratio", type=float, default=0.02,
+                        help="share of duplicated sub-dirs "
+                             "[default: %(default)s]")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    assert not os.path.exists(args.root), f"exists: {args.root}"
+    gen = TreeGenerator(depth=args.depth, fanout=args.fanout,
+                        files_per_dir=args.files_per_dir, size=args.size,
+                        sparse=args.sparse, dup_ratio=args.dup_ratio,
+                        dup_subtree_ratio=args.dup_subtree_ratio,
+                        seed=args.seed)
+    print(json.dumps(gen.generate(args.root)))
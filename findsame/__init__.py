@@ -0,0 +1,7 @@
+# Import lazily, such that "import findsame.<module>" (e.g. by the command
+# line interface) doesn't pull in everything.
+def __getattr__(name):
+    if name == 'Engine':
+        from findsame.engine import Engine
+        return Engine
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
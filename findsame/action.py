@@ -0,0 +1,293 @@
+"""Act on duplicate files: replace them by hardlinks or reflinks to one kept
+copy, or delete them.
+
+For each group of same files in a result (any outmode), the first path is
+kept and all others are acted on, one after another within a group, groups
+are processed in parallel. Each duplicate goes through these steps
+
+::
+
+    check   stat keeper and duplicate, skip the duplicate if it is gone, not
+            a regular file, already a hardlink of the keeper, has a
+            different size or was modified after the result was written
+    backup  rename duplicate to a temp name next to it
+    apply   create hardlink/reflink to the keeper at the duplicate's path
+            (nothing to do for delete)
+    commit  remove the temp file
+    done
+
+Every step is written to a journal (json lines, fsync-ed) *before* it is
+carried out (write-ahead). After an interruption, the journal and the
+presence of the temp file tell us how far each duplicate got, such that a
+run can be resumed (finish all started duplicates, then continue with the
+rest) or rolled back (restore all duplicates).
+"""
+
+import json
+import os
+import shutil
+import stat
+import threading
+from collections import defaultdict
+
+from findsame import main, parallel
+
+
+ACTIONS = ['hardlink', 'reflink', 'delete']
+TMP_SUFFIX = '.findsame-tmp'
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+class ActionError(Exception):
+    pass
+
+
+def reflink(src, dst):
+    """Create `dst` as a copy-on-write clone of `src` (Linux, on file
+    systems which support it, e.g. btrfs, xfs)."""
+    import fcntl
+    with open(src, 'rb') as fd_src:
+        with open(dst, 'xb') as fd_dst:
+            try:
+                fcntl.ioctl(fd_dst.fileno(), FICLONE, fd_src.fileno())
+            except OSError:
+                os.unlink(dst)
+                raise
+
+
+class Journal:
+    """Append-only journal of steps, one json object per line."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def read(self):
+        """Dict of the last journal entry for each duplicate path, and the
+        action of the run which wrote the journal."""
+        last = {}
+        action = None
+        if os.path.exists(self.filename):
+            with open(self.filename) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line may be incomplete after a crash
+                        continue
+                    if entry['step'] == 'start':
+                        action = entry['action']
+                    else:
+                        last[entry['path']] = entry
+        return last, action
+
+    def write(self, **entry):
+        with self._lock:
+            if self._fd is None:
+                self._fd = open(self.filename, 'a')
+            self._fd.write(json.dumps(entry) + '\n')
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+def iter_dup_groups(result):
+    """Yield ``(keeper, [dup, ...])`` for all groups of non-empty files in
+    `result`."""
+    for typ, paths in main.iter_result_groups(result):
+        if typ == 'file' and len(paths) > 1:
+            yield paths[0], paths[1:]
+
+
+class Deduper:
+    """Carry out `action` on all duplicates in `result`, write steps to
+    `journal`.
+
+    Parameters
+    ----------
+    action : str
+        one of ACTIONS
+    journal : str
+        journal file name
+    nthreads : int
+        number of groups processed in parallel
+    result_mtime : float, None
+        skip duplicates modified after that time (e.g. the mtime of the
+        result file)
+    verify : bool
+        compare the content of keeper and duplicate before acting, turn off
+        only if the result comes from a scan w/o cfg.limit (same hash !=
+        same content otherwise)
+    """
+    def __init__(self, action, journal, nthreads=1, result_mtime=None,
+                 verify=True):
+        if action not in ACTIONS:
+            raise ActionError(f"unknown action: {action}")
+        self.action = action
+        self.journal = Journal(journal)
+        self.nthreads = nthreads
+        self.result_mtime = result_mtime
+        self.verify = verify
+
+    def _check(self, keeper, dup):
+        """Return reason to skip `dup` or None."""
+        try:
+            st_keep = os.lstat(keeper)
+            st_dup = os.lstat(dup)
+        except FileNotFoundError as ex:
+            return f"missing: {ex.filename}"
+        if not (stat.S_ISREG(st_keep.st_mode) and stat.S_ISREG(st_dup.st_mode)):
+            return "not a regular file"
+        if (st_keep.st_dev, st_keep.st_ino) == (st_dup.st_dev, st_dup.st_ino):
+            return "already a hardlink"
+        if st_keep.st_size != st_dup.st_size:
+            return "size changed"
+        if os.path.lexists(dup + TMP_SUFFIX):
+            # not ours (we have no journal entry for it), don't overwrite
+            return f"temp file exists: {dup + TMP_SUFFIX}"
+        if self.result_mtime is not None:
+            for st in [st_keep, st_dup]:
+                if st.st_mtime > self.result_mtime:
+                    return "modified after scan"
+        if self.action == 'hardlink' and st_keep.st_dev != st_dup.st_dev:
+            return "different file systems"
+        if self.verify:
+            import filecmp
+            if not filecmp.cmp(keeper, dup, shallow=False):
+                return "content differs"
+        return None
+
+    def _apply(self, keeper, dup):
+        if self.action == 'hardlink':
+            os.link(keeper, dup)
+        elif self.action == 'reflink':
+            reflink(keeper, dup)
+
+    def process(self, keeper, dup, last=None):
+        """Run (or finish, if `last` journal entry is given) all steps for
+        one duplicate. Return final step name ('done' or 'skip')."""
+        tmp = dup + TMP_SUFFIX
+        step = None if last is None else last['step']
+        if step in ['done', 'skip']:
+            return step
+        # backup intent was written, but rename didn't happen, or we start
+        # again after a rollback
+        if (step == 'backup' and not os.path.exists(tmp)) or step == 'rollback':
+            step = None
+        if step is None:
+            reason = self._check(keeper, dup)
+            if reason is not None:
+                self.journal.write(step='skip', path=dup, keeper=keeper,
+                                   reason=reason)
+                return 'skip'
+            st = os.stat(dup)
+            self.journal.write(step='backup', path=dup, keeper=keeper,
+                               tmp=tmp, mode=st.st_mode,
+                               mtime_ns=st.st_mtime_ns, size=st.st_size)
+            os.rename(dup, tmp)
+            step = 'backup'
+        if step == 'apply' and self.action == 'reflink' and \
+                os.path.exists(dup) and os.path.exists(tmp) and \
+                os.path.getsize(dup) != os.path.getsize(tmp):
+            # interrupted between creating the file and cloning into it
+            os.unlink(dup)
+        if step == 'backup' or (step == 'apply' and self.action != 'delete'
+                                and not os.path.exists(dup)):
+            self.journal.write(step='apply', path=dup, keeper=keeper, tmp=tmp)
+            try:
+                self._apply(keeper, dup)
+            except OSError as ex:
+                # undo backup
+                os.rename(tmp, dup)
+                self.journal.write(step='skip', path=dup, keeper=keeper,
+                                   reason=f"{self.action} failed: {ex}")
+                return 'skip'
+            step = 'apply'
+        self.journal.write(step='commit', path=dup, keeper=keeper, tmp=tmp)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        self.journal.write(step='done', path=dup, keeper=keeper)
+        return 'done'
+
+    def _group_worker(self, args):
+        keeper, dups, last = args
+        return [(dup, self.process(keeper, dup, last.get(dup))) for dup in dups]
+
+    def run(self, result, resume=False):
+        """Act on all duplicates in `result`. With `resume`, continue from
+        the journal, else the journal must not exist. Return dict with number
+        of duplicates per final step."""
+        if resume:
+            last, action = self.journal.read()
+            if action is not None and action != self.action:
+                raise ActionError(f"journal was written by action "
+                                  f"'{action}', not '{self.action}'")
+        else:
+            if os.path.exists(self.journal.filename):
+                raise ActionError(f"journal exists, use resume or remove "
+                                  f"it: {self.journal.filename}")
+            last = {}
+        self.journal.write(step='start', action=self.action)
+        counts = defaultdict(int)
+        jobs = ((keeper, dups, last) for keeper, dups in iter_dup_groups(result))
+        try:
+            with parallel.get_pool(nthreads=self.nthreads) as pool:
+                for res in pool.map(self._group_worker, jobs):
+                    for _, step in res:
+                        counts[step] += 1
+        finally:
+            self.journal.close()
+        return dict(counts)
+
+
+def rollback(journal):
+    """Restore all duplicates recorded in `journal`.
+
+    Duplicates which were not yet committed are restored from the temp file
+    (original inode, metadata and content). For committed ones, the original
+    inode is gone, so we restore an independent copy of the keeper (same
+    content) with the duplicate's original mode and mtime. Return dict with
+    number of restored duplicates per method.
+    """
+    jrnl = Journal(journal)
+    last, _ = jrnl.read()
+    # the entry with backup info, needed for mode and mtime
+    backups = {}
+    with open(journal) as fd:
+        for line in fd:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry['step'] == 'backup':
+                backups[entry['path']] = entry
+    counts = defaultdict(int)
+    for dup, entry in last.items():
+        step = entry['step']
+        if step == 'skip':
+            continue
+        tmp = dup + TMP_SUFFIX
+        if os.path.exists(tmp):
+            if os.path.lexists(dup):
+                os.unlink(dup)
+            os.rename(tmp, dup)
+            counts['restored'] += 1
+        elif step in ['commit', 'done']:
+            bak = backups[dup]
+            copy = dup + TMP_SUFFIX
+            shutil.copyfile(entry['keeper'], copy)
+            os.chmod(copy, stat.S_IMODE(bak['mode']))
+            os.utime(copy, ns=(bak['mtime_ns'], bak['mtime_ns']))
+            os.replace(copy, dup)
+            counts['copied'] += 1
+        else:
+            # backup intent, rename never happened
+            continue
+        jrnl.write(step='rollback', path=dup, keeper=entry['keeper'])
+    jrnl.close()
+    return dict(counts)
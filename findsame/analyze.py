@@ -1,13 +1,76 @@
+import array
 import os
 
 import numpy as np
-from matplotlib import pyplot as plt
 
-from findsame import main, common as co
+from findsame import common as co
 
 
-def collect_file_sizes(files_dirs):
-    """1d array with file sizes for all files and dirs (recursive) in
+def _scan_dir(path):
+    """Sizes of all regular files (no links) in `path` as array('q'), sub-dirs
+    (no links) and the dir's mtime."""
+    sizes = array.array('q')
+    subdirs = []
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    sizes.append(entry.stat(follow_symlinks=False).st_size)
+    except (FileNotFoundError, PermissionError, NotADirectoryError):
+        co.debug_msg(f"skip unreadable dir: {path}")
+        return sizes, subdirs, None
+    return sizes, subdirs, mtime_ns
+
+
+def scan_sizes(files_dirs, nthreads=None):
+    """Collect file sizes w/o building a MerkleTree.
+
+    Dirs are listed by a thread pool, each dir is one job, sub-dirs are
+    submitted as they are found. Sizes are appended to a compact
+    array('q'), which is turned into a numpy array w/o copy.
+
+    Parameters
+    ----------
+    files_dirs : seq of str
+    nthreads : int, None
+        None = os.cpu_count()
+
+    Returns
+    -------
+    sizes : 1d int64 array
+    dir_mtimes : dict
+        {path: mtime_ns} of all dirs, see DataDir
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    sizes = array.array('q')
+    dir_mtimes = {}
+    dirs = []
+    for path in files_dirs:
+        if os.path.isdir(path):
+            dirs.append(path)
+        elif os.path.isfile(path) and not os.path.islink(path):
+            sizes.append(os.path.getsize(path))
+    nthreads = os.cpu_count() if nthreads is None else nthreads
+    with ThreadPoolExecutor(nthreads) as pool:
+        futures = dict((pool.submit(_scan_dir, dr), dr) for dr in dirs)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                dr = futures.pop(future)
+                _sizes, subdirs, mtime_ns = future.result()
+                sizes.extend(_sizes)
+                if mtime_ns is not None:
+                    dir_mtimes[dr] = mtime_ns
+                for sub in subdirs:
+                    futures[pool.submit(_scan_dir, sub)] = sub
+    return np.frombuffer(sizes, dtype=np.int64), dir_mtimes
+
+
+def collect_file_sizes(files_dirs, nthreads=None):
+    """1d int64 array with file sizes for all files and dirs (recursive) in
     `files_dirs` in bytes.
 
     Parameters
@@ -15,33 +78,55 @@ def collect_file_sizes(files_dirs):
     files_dirs : list of strings
         files and dirs, the returned array contains the sizes of all files
         found
+    nthreads : int, None
+        see scan_sizes()
     """
-    # MekleTree is actually not needed here, as well as FileDirTree which is
-    # used in there, sice we are only interested in the files, not the tree. We
-    # could do what we need here by using os.walk and replicate a part of
-    # FileDirTree.build_tree(), but we are lazy.
-    mt = main.get_merkle_tree(files_dirs)
-    return np.array([leaf.filesize for leaf in mt.tree.leafs.values()],
-                    dtype=np.float64)
+    return scan_sizes(files_dirs, nthreads=nthreads)[0]
+
+
+def dir_mtimes_valid(dir_mtimes):
+    """True if all dirs still exist with the same mtime. Files and sub-dirs
+    added, removed or renamed in any dir change that dir's mtime. Files
+    changed in-place (new size, same name) don't, we miss those."""
+    for path, mtime_ns in dir_mtimes.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime_ns:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
 
 
 class DataDir:
     """A dir on which we ran a benchmark and/or want to calculate a file size
     histogram using self.sizes. (Calculate and) store bookkeeping data (path,
     file sizes array, ...).
+
+    File sizes are cached in `tmpdir`, together with the mtimes of all dirs.
+    The cache is used only if no dir has changed since, see
+    dir_mtimes_valid().
     """
     def __init__(self, path, alias=None, tmpdir='/tmp/findsame_datadir_cache'):
         self.path = path
         self.alias = alias
-        cache_fn = os.path.join(tmpdir, path.replace('/','_')) + '.npy'
+        cache_fn = os.path.join(tmpdir, path.replace('/','_')) + '.npz'
+        self.sizes = None
         if os.path.exists(cache_fn):
-            self.sizes = np.load(cache_fn)
-        else:
-            self.sizes = collect_file_sizes([self.path])
+            with np.load(cache_fn) as npz:
+                dir_mtimes = dict(zip(npz['dirs'].tolist(),
+                                      npz['mtimes'].tolist()))
+                if dir_mtimes_valid(dir_mtimes):
+                    self.sizes = npz['sizes']
+        if self.sizes is None:
+            self.sizes, dir_mtimes = scan_sizes([self.path])
             os.makedirs(tmpdir, exist_ok=True)
-            np.save(cache_fn, self.sizes)
+            np.savez(cache_fn,
+                     sizes=self.sizes,
+                     dirs=np.array(list(dir_mtimes.keys()), dtype=str),
+                     mtimes=np.array(list(dir_mtimes.values()),
+                                     dtype=np.int64))
         self.cache_fn = cache_fn
-        self.size_str = co.size2str(self.sizes.sum())
+        self.size_str = co.size2str(int(self.sizes.sum()))
 
     def __repr__(self):
         if self.alias is None:
@@ -50,6 +135,60 @@ class DataDir:
             return f"{self.alias}:{self.path}"
 
 
+# upper bounds of size classes in summary()
+SIZE_CLASSES = [0, 4*co.KiB, 64*co.KiB, co.MiB, 16*co.MiB, 256*co.MiB,
+                co.GiB]
+
+
+def summary(sizes, classes=SIZE_CLASSES):
+    """Summary statistics of a file size array. All operations are
+    vectorized (one sort for the same-size groups, the rest is O(N)).
+
+    Parameters
+    ----------
+    sizes : 1d int array
+    classes : seq of int
+        upper bounds (inclusive) of size classes, an extra class for
+        everything larger is added
+
+    Returns
+    -------
+    dict
+        {'nfiles': ...,
+         'total_size': ...,
+         'classes': [{'max_size': ..., 'nfiles': ..., 'files_share': ...,
+                      'size_share': ...}, ...],
+         'same_size_groups': number of sizes which occur more than once,
+         'same_size_files': number of files in those groups,
+         'same_size_bytes': size of those files}
+
+    Only files with the same size can be same, so the last three are an
+    upper bound for what findsame can find (empty files included).
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    nfiles = len(sizes)
+    total = int(sizes.sum())
+    # class index for each file: 0 for size <= classes[0], ...
+    idx = np.searchsorted(np.asarray(classes), sizes, side='left')
+    ncls = len(classes) + 1
+    counts = np.bincount(idx, minlength=ncls)
+    nbytes = np.bincount(idx, weights=sizes, minlength=ncls)
+    cls = []
+    for ii in range(ncls):
+        cls.append(dict(max_size=classes[ii] if ii < len(classes) else None,
+                        nfiles=int(counts[ii]),
+                        files_share=counts[ii] / nfiles if nfiles else 0.0,
+                        size_share=nbytes[ii] / total if total else 0.0))
+    uniq, ucounts = np.unique(sizes, return_counts=True)
+    multi = ucounts > 1
+    return dict(nfiles=nfiles,
+                total_size=total,
+                classes=cls,
+                same_size_groups=int(multi.sum()),
+                same_size_files=int(ucounts[multi].sum()),
+                same_size_bytes=int((uniq[multi] * ucounts[multi]).sum()))
+
+
 def get_log_pow(logbase):
     return lambda x: np.log(x)/np.log(logbase), lambda x: np.power(logbase, x)
 
@@ -91,6 +230,8 @@ def hist(_xlst, bins=100, norm=False, shift_fac=0.8, labels=None,
     better visability. In that case we turn of y ticks (the bin counts) since
     it makes no sense in that case.
     """
+    # matplotlib is slow to import and only needed here
+    from matplotlib import pyplot as plt
     xlst = [_xlst] if isinstance(_xlst, np.ndarray) else _xlst
     if labels is not None:
         assert len(xlst) == len(labels)
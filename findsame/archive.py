@@ -0,0 +1,165 @@
+"""Hash members of tar and zip archives without extracting them.
+
+With cfg.archives, each archive file found in the scan (by name, see
+ARCHIVE_SUFFIXES) is read once, as a stream, and all its members are hashed
+with the same leaf fpr scheme as files (size + content, respecting
+cfg.limit and cfg.sparse). The archive becomes a synthetic node with the
+members as leafs and dirs inside as sub-nodes, so duplicates between
+archive contents and loose files or dirs are reported. Paths of members are
+``<archive>::<member>``, the archive node is ``<archive>::``. The archive
+file itself is a normal leaf as before, archive nodes are separate
+sub-graphs in the tree, i.e. they don't change the fpr of the dir the
+archive is in.
+
+Archives are hashed in parallel, one job per archive, see
+calc.MerkleTree.expand_archives(). Unreadable archives (also e.g. zip
+files with an unsupported compression method) are skipped. Nested
+archives, links, special files and encrypted members in archives are
+ignored.
+"""
+
+import os
+import tarfile
+import zipfile
+import zlib
+
+from findsame import calc
+from findsame import common as co
+from findsame import throttle
+
+SEP = '::'
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                    '.tar.xz', '.txz', '.zip')
+
+# blocksize when cfg.blocksize is None
+DEFAULT_BLOCKSIZE = 256*1024
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def hash_member(fd, size, blocksize=None, limit=None, thr=None,
+                sparse=False):
+    """Hash of `size` bytes read from file object `fd`, same as
+    calc.hash_file() or calc.hash_file_limit() (calc.hash_file_sparse()
+    if `sparse`) of a file with that content."""
+    hasher = calc.HASHFUNC()
+    hasher.update(str(size).encode('ascii'))
+    bs = DEFAULT_BLOCKSIZE if blocksize is None else blocksize
+    remain = size if limit is None else min(size, limit)
+    if sparse:
+        for pos, buf in calc._iter_sparse_chunks(fd, remain, bs, thr,
+                                                 extents=False):
+            calc.update_sparse(hasher, pos, buf)
+        return hasher.hexdigest()
+    while remain > 0:
+        buf = calc._read(fd, min(bs, remain), thr)
+        if not buf:
+            break
+        hasher.update(buf)
+        remain -= len(buf)
+    return hasher.hexdigest()
+
+
+def _iter_zip(path):
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                yield info.filename, None, None
+            elif info.flag_bits & 0x1:
+                co.debug_msg(f"skip encrypted archive member: "
+                             f"{path}{SEP}{info.filename}")
+            else:
+                with zf.open(info) as fd:
+                    yield info.filename, info.file_size, fd
+
+
+def _iter_tar(path):
+    # stream mode: read the (compressed) archive once, front to back
+    with tarfile.open(path, mode='r|*') as tf:
+        for info in tf:
+            if info.isdir():
+                yield info.name, None, None
+            elif info.isfile():
+                yield info.name, info.size, tf.extractfile(info)
+            else:
+                co.debug_msg(f"skip archive member: {path}{SEP}{info.name}")
+
+
+def hash_archive(path, blocksize=None, limit=None, sparse=False):
+    """Hash all members of archive `path`.
+
+    Returns
+    -------
+    list of ``(name, size, fpr)``, where `name` is the member name w/o
+    leading "./" or "/", dirs have size and fpr None, None if the archive
+    can't be read
+    """
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
+    func = _iter_zip if path.lower().endswith('.zip') else _iter_tar
+    members = []
+    try:
+        for name, size, fd in func(path):
+            name = name.lstrip('/')
+            while name.startswith('./'):
+                name = name[2:]
+            name = name.rstrip('/')
+            if name in ('', '.'):
+                continue
+            fpr = None if fd is None else \
+                hash_member(fd, size, blocksize=blocksize, limit=limit,
+                            thr=thr, sparse=sparse)
+            members.append((name, size, fpr))
+    except (OSError, EOFError, RuntimeError, NotImplementedError,
+            tarfile.TarError, zipfile.BadZipFile, zlib.error) as ex:
+        co.debug_msg(f"skip unreadable archive: {path}: {ex}")
+        return None
+    return members
+
+
+class ArchiveNode(calc.Node):
+    """Dir in an archive, or the archive itself."""
+    def _get_fpr(self):
+        return self._merge_fpr([c.fpr for c in self.childs])
+
+
+class ArchiveLeaf(calc.Leaf):
+    """File in an archive, the fpr is known from hash_archive()."""
+    def __init__(self, path, filesize, mtime_ns, fpr):
+        calc.Element.__init__(self, path=path)
+        self.kind = 'leaf'
+        self.fpr_func = None
+        self.filesize = filesize
+        self.mtime_ns = mtime_ns
+        self.fpr = fpr
+
+
+def build_nodes(leaf, members):
+    """Build nodes and leafs of archive `leaf` (calc.Leaf) from `members`
+    (output of hash_archive()). Return dicts ``nodes, leafs`` (path ->
+    element), as FileDirTree.nodes and FileDirTree.leafs."""
+    top = f"{leaf.path}{SEP}"
+    nodes = {'': ArchiveNode(path=top, childs=[])}
+    leafs = {}
+
+    def get_node(name):
+        node = nodes.get(name)
+        if node is None:
+            node = ArchiveNode(path=top + name, childs=[])
+            nodes[name] = node
+            get_node(os.path.dirname(name)).add_child(node)
+        return node
+
+    for name, size, fpr in members:
+        if fpr is None:
+            get_node(name)
+        elif name not in leafs:
+            elem = ArchiveLeaf(top + name, size, leaf.mtime_ns, fpr)
+            get_node(os.path.dirname(name)).add_child(elem)
+            leafs[name] = elem
+    return (dict((node.path, node) for node in nodes.values()),
+            dict((elem.path, elem) for elem in leafs.values()))
@@ -0,0 +1,124 @@
+import threading
+import time
+
+
+class FprCache:
+    """In-memory cache of leaf fprs.
+
+    Entries are keyed by path and are valid as long as the file's size and
+    mtime are unchanged. Each entry can hold fprs for several fpr settings
+    (see calc.fpr_key()), e.g. a full-file fpr and one calculated with a
+    limit.
+
+    ::
+
+        {path: (filesize, mtime_ns, {key1: fpr1, key2: fpr2, ...}),
+         ...}
+    """
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, leaf, key):
+        """Return cached fpr of `leaf` for fpr setting `key` or None if there
+        is none or the cache entry is stale."""
+        entry = self._data.get(leaf.path)
+        if entry is not None and entry[:2] == (leaf.filesize, leaf.mtime_ns):
+            return entry[2].get(key)
+        return None
+
+    def set(self, leaf, key, fpr):
+        with self._lock:
+            entry = self._data.get(leaf.path)
+            if entry is None or entry[:2] != (leaf.filesize, leaf.mtime_ns):
+                entry = (leaf.filesize, leaf.mtime_ns, {})
+                self._data[leaf.path] = entry
+            entry[2][key] = fpr
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, path):
+        return path in self._data
+
+
+class PersistentFprCache(FprCache):
+    """FprCache stored in a sqlite file, to be used across runs.
+
+    All fprs of a leaf (all keys, e.g. from cfg.digests) are stored, so a
+    later run with any of those limits reads nothing for unchanged files.
+    Fprs with other hash functions than calc.HASHFUNC are only stored, no
+    run uses them.
+    Entries are keyed by path as given, so use the same (e.g. absolute)
+    paths in each run. New fprs are written every `interval` seconds and in
+    close().
+
+    Parameters
+    ----------
+    filename : str
+        sqlite file, created if it doesn't exist
+    interval : float
+    """
+    def __init__(self, filename, interval=60):
+        import sqlite3
+        super().__init__()
+        self.filename = filename
+        self.interval = interval
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fprs (path TEXT,
+                                             size INTEGER,
+                                             mtime_ns INTEGER,
+                                             key TEXT,
+                                             fpr TEXT,
+                                             PRIMARY KEY (path, key))
+            """)
+        self._conn.commit()
+        for path, size, mtime_ns, key, fpr in self._conn.execute(
+                "SELECT path, size, mtime_ns, key, fpr FROM fprs "
+                "ORDER BY rowid"):
+            entry = self._data.get(path)
+            if entry is None or entry[:2] != (size, mtime_ns):
+                entry = (size, mtime_ns, {})
+                self._data[path] = entry
+            entry[2][key] = fpr
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def set(self, leaf, key, fpr):
+        super().set(leaf, key, fpr)
+        with self._lock:
+            self._pending.append((leaf.path, leaf.filesize, leaf.mtime_ns,
+                                  key, fpr))
+        if time.monotonic() - self._last_flush > self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write everything collected since the last flush. Entries of a
+        path with another size or mtime are removed."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._conn.executemany("DELETE FROM fprs WHERE path=? AND "
+                                   "(size!=? OR mtime_ns!=?)",
+                                   [rec[:3] for rec in pending])
+            self._conn.executemany("INSERT OR REPLACE INTO fprs "
+                                   "VALUES (?,?,?,?,?)", pending)
+            self._conn.commit()
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,15 +1,15 @@
+import errno
 import os
 import hashlib
+import time
 import functools
 import itertools
-from collections import defaultdict
-##from multiprocessing import Pool # same as ProcessPoolExecutor
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter, defaultdict
 
 from findsame import common as co
-from findsame.parallel import ProcessAndThreadPoolExecutor, \
-    SequentialPoolExecutor
-from findsame.config import cfg
+from findsame import parallel
+from findsame import throttle
+from findsame.config import Config, cfg as global_cfg
 
 
 HASHFUNC = hashlib.sha1
@@ -53,6 +53,72 @@ EMPTY_DIR_FPR = hashsum('')
 # work.
 MISSING_FILE_FPR = hashsum('-1')
 MISSING_DIR_FPR = hashsum('-2')
+# Files which we gave up on (read error or timeout, see findsame.watchdog).
+# Dirs with such a file get a unique fpr (see Node._get_fpr()), since we
+# don't know their content.
+UNREADABLE_FILE_FPR = hashsum('-3')
+
+
+def make_fpr_key(hashname, limit=None, sparse=False):
+    key = hashname
+    if limit is not None:
+        key += f":{limit}"
+    if sparse:
+        key += ":sparse"
+    return key
+
+
+def fpr_key(cfg):
+    """String which identifies all settings in `cfg` which change a leaf's
+    fpr. Fprs calculated with different keys cannot be compared. The
+    blocksize is not part of it since it doesn't change the hash."""
+    return make_fpr_key(HASHFUNC().name, cfg.limit, cfg.sparse)
+
+
+def parse_digest(spec):
+    """Parse a digest spec ``[HASHNAME][:LIMIT]`` as in cfg.digests, e.g.
+    "512K" (HASHFUNC, limit), "sha256" (full file), "md5:1M" or "full".
+    Return ``(hashname, limit)``. Hashes w/o a fixed digest size (shake_*)
+    are not supported."""
+    hashname = HASHFUNC().name
+    limit = None
+    for part in spec.split(':'):
+        if part in hashlib.algorithms_available:
+            if hashlib.new(part).digest_size == 0:
+                raise ValueError(f"variable length hash not supported: "
+                                 f"{spec}")
+            hashname = part
+        elif part not in ('', 'full'):
+            try:
+                limit = co.str2size(part)
+            except (ValueError, KeyError):
+                raise ValueError(f"illegal digest spec: {spec}")
+            if limit is None or limit <= 0:
+                raise ValueError(f"illegal digest spec: {spec}")
+    return hashname, limit
+
+
+def digest_keys(cfg):
+    """List of ``(key, hashname, limit)`` of the leaf fpr setting in `cfg`
+    (first) and all of cfg.digests, w/o duplicates."""
+    digests = [(HASHFUNC().name, cfg.limit)]
+    digests += [parse_digest(spec) for spec in cfg.digests]
+    keys = {}
+    for hashname, limit in digests:
+        keys.setdefault(make_fpr_key(hashname, limit, cfg.sparse),
+                        (hashname, limit))
+    return [(key,) + val for key, val in keys.items()]
+
+
+def _read(fd, size, thr):
+    """fd.read(size), with throttling if `thr` (throttle.Throttle) is not
+    None."""
+    if thr is None:
+        return fd.read(size)
+    t0 = time.monotonic()
+    buf = fd.read(size)
+    thr.read(len(buf), time.monotonic() - t0)
+    return buf
 
 
 def hash_file(leaf, blocksize=None, use_filesize=True):
@@ -75,11 +141,14 @@ def hash_file(leaf, blocksize=None, use_filesize=True):
     hasher = HASHFUNC()
     if use_filesize:
         hasher.update(str(leaf.filesize).encode('ascii'))
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
     with open(leaf.path, 'rb') as fd:
-        buf = fd.read(blocksize)
+        buf = _read(fd, blocksize, thr)
         while buf:
             hasher.update(buf)
-            buf = fd.read(blocksize)
+            buf = _read(fd, blocksize, thr)
     return hasher.hexdigest()
 
 
@@ -97,15 +166,192 @@ def hash_file_limit(leaf, blocksize=None, limit=None, use_filesize=True):
     hasher = HASHFUNC()
     if use_filesize:
         hasher.update(str(leaf.filesize).encode('ascii'))
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
     with open(leaf.path, 'rb') as fd:
         while True:
             pos = fd.tell()
             if pos == leaf.filesize or pos == limit:
                 break
-            hasher.update(fd.read(bs))
+            hasher.update(_read(fd, bs, thr))
     return hasher.hexdigest()
 
 
+# Sparse fpr scheme, see hash_file_sparse(). Changing this changes all sparse
+# fprs.
+SPARSE_CHUNK = 64*1024
+_ZERO_CHUNK = bytes(SPARSE_CHUNK)
+
+
+def update_sparse(hasher, offset, buf):
+    """Feed all non-zero SPARSE_CHUNK-sized chunks of `buf` (bytes, read at
+    file offset `offset`, a multiple of SPARSE_CHUNK) into `hasher`, each
+    prefixed by its offset. All-zero chunks are skipped."""
+    for ii in range(0, len(buf), SPARSE_CHUNK):
+        # slicing bytes + memcmp is much faster than comparing memoryviews
+        chunk = buf[ii:ii+SPARSE_CHUNK]
+        if chunk != _ZERO_CHUNK[:len(chunk)]:
+            hasher.update(f"{offset + ii}:".encode('ascii'))
+            hasher.update(chunk)
+
+
+def data_extents(fd, size):
+    """Yield ``(start, end)`` of data regions in the file opened as `fd` (int)
+    using lseek(SEEK_DATA/SEEK_HOLE). Everything else is a hole (zeros). If
+    the OS or file system doesn't support that, the whole file is one
+    region."""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # no data after pos
+                return
+            # not supported
+            yield pos, size
+            return
+        end = min(size, os.lseek(fd, start, os.SEEK_HOLE))
+        yield start, end
+        pos = end
+
+
+def _iter_sparse_chunks(fd, size, blocksize=None, thr=None, extents=True):
+    """Yield ``(pos, buf)`` for the first `size` bytes of file object `fd`,
+    `pos` is a multiple of SPARSE_CHUNK and `buf` has `blocksize` bytes
+    (made a multiple of SPARSE_CHUNK) or less at the end. With `extents`,
+    read only blocks which overlap data regions (see data_extents(), `fd`
+    must be an unbuffered regular file) with pread(), else read `fd` front
+    to back (e.g. archive members). We stop at a short read (e.g. file
+    truncated while we read it), such that offsets stay aligned."""
+    bs = max(SPARSE_CHUNK, (blocksize or 0) // SPARSE_CHUNK * SPARSE_CHUNK)
+    if extents:
+        regions = data_extents(fd.fileno(), size)
+    else:
+        regions = [(0, size)]
+    pos = 0
+    for start, end in regions:
+        # read whole chunks, beginning at the chunk which has start
+        pos = max(pos, start // SPARSE_CHUNK * SPARSE_CHUNK)
+        while pos < end:
+            nbytes = min(bs, size - pos)
+            if not extents:
+                buf = _read(fd, nbytes, thr)
+            elif thr is None:
+                buf = os.pread(fd.fileno(), nbytes, pos)
+            else:
+                t0 = time.monotonic()
+                buf = os.pread(fd.fileno(), nbytes, pos)
+                thr.read(len(buf), time.monotonic() - t0)
+            if buf:
+                yield pos, buf
+            if len(buf) < nbytes:
+                return
+            pos += len(buf)
+
+
+def hash_file_sparse(leaf, blocksize=None, limit=None, use_filesize=True):
+    """Hash file content w/o reading holes in sparse files.
+
+    This is a different fpr than that of :func:`hash_file`: we hash the
+    file size and all non-zero chunks of SPARSE_CHUNK bytes (aligned to
+    multiples of that) together with their offset. All-zero chunks, and so
+    holes, are skipped. Only chunks which overlap data regions (see
+    data_extents()) are read. Therefore the fpr doesn't depend on how the
+    file is allocated: a sparse file and a copy with all zeros written out
+    have the same fpr. With `limit`, only the first `limit` bytes are used.
+    """
+    hasher = HASHFUNC()
+    if use_filesize:
+        hasher.update(str(leaf.filesize).encode('ascii'))
+    size = leaf.filesize if limit is None else min(leaf.filesize, limit)
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
+    with open(leaf.path, 'rb', buffering=0) as fd:
+        for pos, buf in _iter_sparse_chunks(fd, size, blocksize, thr):
+            update_sparse(hasher, pos, buf)
+    return hasher.hexdigest()
+
+
+def hash_file_multi(leaf, digests, blocksize=None, sparse=False,
+                    use_filesize=True):
+    """Calculate several fprs of a file in one read.
+
+    Each fpr is the same as that of :func:`hash_file` or
+    :func:`hash_file_limit` (:func:`hash_file_sparse` if `sparse`) with its
+    hash function and limit. The file is read once, up to the largest
+    limit.
+
+    Parameters
+    ----------
+    leaf : Leaf
+    digests : seq
+        ``(key, hashname, limit)``, see digest_keys(), limit None = full
+        file
+    blocksize : int, None
+    sparse : bool
+    use_filesize : bool
+
+    Returns
+    -------
+    dict key -> fpr
+    """
+    hashers = [(key, hashlib.new(hashname), limit)
+               for key, hashname, limit in digests]
+    if use_filesize:
+        for _, hasher, _ in hashers:
+            hasher.update(str(leaf.filesize).encode('ascii'))
+    limits = [limit for _, _, limit in hashers]
+    end = None if None in limits else max(limits)
+
+    def update(pos, buf):
+        for _, hasher, limit in hashers:
+            if limit is None or pos + len(buf) <= limit:
+                chunk = buf
+            elif pos < limit:
+                chunk = buf[:limit - pos]
+            else:
+                continue
+            if sparse:
+                update_sparse(hasher, pos, chunk)
+            else:
+                hasher.update(chunk)
+
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
+    if sparse:
+        size = leaf.filesize if end is None else min(leaf.filesize, end)
+        with open(leaf.path, 'rb', buffering=0) as fd:
+            for pos, buf in _iter_sparse_chunks(fd, size, blocksize, thr):
+                update(pos, buf)
+    else:
+        with open(leaf.path, 'rb') as fd:
+            pos = 0
+            while end is None or pos < end:
+                size = blocksize if end is None else \
+                    end - pos if blocksize is None else \
+                    min(blocksize, end - pos)
+                buf = _read(fd, size, thr)
+                if not buf:
+                    break
+                update(pos, buf)
+                pos += len(buf)
+    return dict((key, hasher.hexdigest()) for key, hasher, _ in hashers)
+
+
+def multi_fpr_func(leaf, digests, **kwds):
+    """Leaf fpr_func which uses hash_file_multi(). Return the fpr of the
+    first of `digests`, store all in leaf.digests."""
+    leaf.digests = hash_file_multi(leaf, digests, **kwds)
+    return leaf.digests[digests[0][0]]
+
+
 def split_path(path):
     """//foo/bar/baz -> ['foo', 'bar', 'baz']"""
     return [x for x in path.split('/') if x != '']
@@ -163,17 +409,40 @@ class Node(Element):
 
     def _get_fpr(self):
         if os.path.exists(self.path):
-            return self._merge_fpr([c.fpr for c in self.childs])
+            fprs = [c.fpr for c in self.childs]
+            if UNREADABLE_FILE_FPR in fprs:
+                return hashsum(f"unreadable:{self.path}")
+            return self._merge_fpr(fprs)
         else:
             return MISSING_DIR_FPR
 
+    @co.lazyprop
+    def filesize(self):
+        """Sum of the sizes of all leafs below this node."""
+        return sum(c.filesize for c in self.childs)
+
+    @co.lazyprop
+    def sig(self):
+        """Structural signature: hash of the multiset of child leaf sizes and
+        child node signatures. Cheap (no file is read). Nodes with the same
+        fpr have the same signature, so a node with a unique signature
+        can't have a twin."""
+        return hashsum(''.join(sorted(f"d{c.sig}" if c.kind == 'node' else
+                                      f"f{c.filesize}" for c in self.childs)))
+
 
 class Leaf(Element):
+    # all fprs from the same read (dict key -> fpr), set by multi_fpr_func()
+    digests = None
+
     def __init__(self, *args, fpr_func=hash_file, **kwds):
         super().__init__(*args, **kwds)
         self.kind = 'leaf'
         self.fpr_func = fpr_func
-        self.filesize = os.path.getsize(self.path)
+        st = os.stat(self.path)
+        self.filesize = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.dev = st.st_dev
 
     def _get_fpr(self):
         if os.path.exists(self.path):
@@ -217,11 +486,41 @@ class FileDirTree:
          ('test/a/d', ['e'], []),
          ('test/a/d/e', [], ['file2'])]
     """
-    def __init__(self, dr=None, files=None):
+    def __init__(self, dr=None, files=None, filt=None, build=True, walk=None,
+                 link=False):
+        """
+        Parameters
+        ----------
+        dr : str, None
+            walk this dir
+        files : iterable of str, None
+            use these files, can be an iterator (e.g. reading a file
+            list), consumed only once in build_tree()
+        filt : filters.PathFilter instance, None
+            skip excluded files and dirs and prune excluded dirs from the
+            walk, None = use everything
+        build : bool
+            build the tree now, else call build_tree() or iter_build()
+            later
+        walk : callable, None
+            used instead of os.walk() (same signature and behavior, must
+            be top-down and respect in-place changes of the dirs list)
+        link : bool
+            only with `files`: link each node to the node of its nearest
+            ancestor dir, with nodes for the dirs in between, independent
+            of the order of files (see link_nodes()), else a node is only
+            linked to the node of its parent dir if that came first
+        """
         self.dr = dr
         self.files = files
+        self.filt = filt
+        self.link = link
+        self.walk = os.walk if walk is None else walk
         assert [files, dr].count(None) == 1, "dr or files must be None"
-        self.build_tree()
+        self.nodes = {}
+        self.leafs = {}
+        if build:
+            self.build_tree()
 
     @staticmethod
     def walk_files(files):
@@ -247,17 +546,101 @@ class FileDirTree:
             return self.walk_files(self.files)
         elif self.dr is not None:
             assert os.path.exists(self.dr) and os.path.isdir(self.dr)
-            return os.walk(self.dr)
+            if self.filt is None:
+                return self.walk(self.dr)
+            else:
+                return self._walk_pruned(self.dr)
         else:
             raise Exception("files and dr are None")
 
+    def _walk_pruned(self, dr):
+        """os.walk() w/o excluded dirs and everything below."""
+        for root, dirs, files in self.walk(dr):
+            dirs[:] = [dd for dd in dirs if not
+                       self.filt.skip_dir(os.path.join(root, dd))]
+            yield root, dirs, files
+
     def build_tree(self):
         """Construct Merkle tree from all dirs and files in directory
-        `self.dr`. Don't calculate fprs.
+        `self.dr` or from `self.files`. Don't calculate fprs.
+        """
+        if self.files is not None and self.link:
+            self.nodes = {}
+            self.leafs = {}
+            for fn in self.files:
+                self.add_file(fn)
+            self.link_nodes()
+        else:
+            for _ in self.iter_build():
+                pass
+
+    def add_file(self, fn):
+        """Add file `fn` as leaf to the node of its dir, which is created if
+        needed (not linked to other nodes, see link_nodes()). Links,
+        filtered files, dirs and anything else are skipped. Return the leaf
+        or None."""
+        if fn in self.leafs:
+            return self.leafs[fn]
+        # isfile(<link>) is True, has to be tested first
+        if os.path.islink(fn):
+            co.debug_msg(f"skip link: {fn}")
+            return None
+        if not os.path.isfile(fn):
+            co.debug_msg(f"skip unknown path type: {fn}")
+            return None
+        filt = self.filt
+        if filt is not None and filt.skip_file(fn):
+            co.debug_msg(f"skip filtered: {fn}")
+            return None
+        leaf = Leaf(path=fn)
+        if filt is not None and filt.skip_size(leaf.filesize):
+            co.debug_msg(f"skip size: {fn}")
+            return None
+        root = os.path.dirname(fn)
+        root = os.path.curdir if root == '' else root
+        node = self.nodes.get(root)
+        if node is None:
+            node = Node(path=root, childs=[])
+            self.nodes[root] = node
+        node.add_child(leaf)
+        self.leafs[fn] = leaf
+        return leaf
+
+    def link_nodes(self):
+        """Add each node as child to the node of its nearest ancestor dir in
+        the tree, with nodes for the dirs in between. Nodes w/o an ancestor
+        in the tree stay separate sub-graphs. Use after add_file(), the
+        result doesn't depend on the order of files."""
+        for path, node in list(self.nodes.items()):
+            chain = []
+            up = os.path.dirname(path)
+            while up not in self.nodes:
+                if os.path.dirname(up) == up:
+                    # '' or '/'
+                    up = None
+                    break
+                chain.append(up)
+                up = os.path.dirname(up)
+            if up is None:
+                continue
+            for dr in chain:
+                parent = Node(path=dr, childs=[node])
+                self.nodes[dr] = parent
+                node = parent
+            self.nodes[up].add_child(node)
+
+    def iter_build(self):
+        """Build the tree step by step, yield ``(node, parent, dirs)`` for
+        each new node, where `node` has all its leafs as childs (sub-nodes
+        are added when they show up later), `parent` is the node it was
+        added to as child (None if there is none in this tree) and `dirs`
+        are the names of sub-dirs os.walk() will visit (None when we
+        have a list of files instead of a dir).
         """
         self.nodes = {}
         self.leafs = {}
-        for root, _, files in self.walker():
+        filt = self.filt
+        for root, dirs, files in self.walker():
             # make sure os.path.dirname() returns the parent dir
             if root.endswith('/'):
                 root = root[:-1]
@@ -269,7 +652,13 @@ class FileDirTree:
                 if os.path.islink(fn):
                     co.debug_msg(f"skip link: {fn}")
                 elif os.path.isfile(fn):
+                    if filt is not None and filt.skip_file(fn):
+                        co.debug_msg(f"skip filtered: {fn}")
+                        continue
                     leaf = Leaf(path=fn)
+                    if filt is not None and filt.skip_size(leaf.filesize):
+                        co.debug_msg(f"skip size: {fn}")
+                        continue
                     node.add_child(leaf)
                     self.leafs[fn] = leaf
                 else:
@@ -278,9 +667,10 @@ class FileDirTree:
             # root        = /foo/bar/baz
             # parent_root = /foo/bar
             self.nodes[root] = node
-            parent_root = os.path.dirname(root)
-            if parent_root in self.nodes.keys():
-                self.nodes[parent_root].add_child(node)
+            parent = self.nodes.get(os.path.dirname(root))
+            if parent is not None:
+                parent.add_child(node)
+            yield node, parent, dirs
 
     def update(self, other):
         for name in ['nodes', 'leafs']:
@@ -361,29 +751,55 @@ class MerkleTree:
        fprD: [path5, path6, path7],
        ...}
     """
-    def __init__(self, tree):
+    def __init__(self, tree, cfg=None, cache=None, pool=None):
         """
         Parameters
         ----------
         tree : FileDirTree instance
+        cfg : config.Config instance, None
+            None = use the package-wide findsame.config.cfg
+        cache : cache.FprCache instance, None
+            leaf fprs found in here are not calculated again, all newly
+            calculated ones are added
+        pool : pool executor instance, None
+            None = create one from cfg.nprocs and cfg.nthreads for each
+            calc_leaf_fprs() call and shut it down afterwards
         """
         self.tree = tree
-        self.set_leaf_fpr_func(cfg.limit)
+        self.cfg = global_cfg if cfg is None else cfg
+        self.cache = cache
+        self.pool = pool
+        # watchdog.Watchdog of the last calc_leaf_fprs() call, if used
+        self.watchdog = None
+        self.set_leaf_fpr_func(self.cfg.limit)
 
     def calc_fprs(self):
-        self.calc_leaf_fprs()
-        self.calc_node_fprs()
+        if self.cfg.dirs_only:
+            self.calc_node_fprs_pruned()
+        else:
+            self.calc_leaf_fprs()
+            self.calc_node_fprs()
 
     def set_leaf_fpr_func(self, limit):
-        if limit is None:
+        if self.cfg.digests:
+            digests = digest_keys(Config(self.cfg, limit=limit))
+            leaf_fpr_func = functools.partial(multi_fpr_func,
+                                              digests=digests,
+                                              blocksize=self.cfg.blocksize,
+                                              sparse=self.cfg.sparse)
+        elif self.cfg.sparse:
+            leaf_fpr_func = functools.partial(hash_file_sparse,
+                                              blocksize=self.cfg.blocksize,
+                                              limit=limit)
+        elif limit is None:
             leaf_fpr_func = functools.partial(hash_file,
-                                              blocksize=cfg.blocksize)
+                                              blocksize=self.cfg.blocksize)
         else:
             leaf_fpr_func = functools.partial(hash_file_limit,
-                                              blocksize=cfg.blocksize,
+                                              blocksize=self.cfg.blocksize,
                                               limit=limit,
                                               use_filesize=True)
-
+        self.leaf_fpr_func = leaf_fpr_func
         for leaf in self.tree.leafs.values():
             leaf.fpr_func = leaf_fpr_func
 
@@ -392,37 +808,138 @@ class MerkleTree:
     # inside _calc_leaf_fprs(), need to def it in outer scope
     @staticmethod
     def fpr_worker(leaf):
-        return leaf.path, leaf.fpr
+        return leaf.path, leaf.fpr, leaf.digests
+
+    def calc_leaf_fprs(self, leafs=None):
+        """Calculate leaf fprs and store them in self.leaf_fprs.
 
-    def calc_leaf_fprs(self):
+        Parameters
+        ----------
+        leafs : seq of Leaf, None
+            calculate only those, None = all leafs in self.tree
+        """
+        cfg = self.cfg
         # whether we use multiprocessing
-        useproc = False
-
-        if cfg.nthreads == 1 and cfg.nprocs == 1:
-            # same as
-            #   self.leaf_fprs = dict((k,v.fpr) for k,v in self.tree.leafs.items())
-            # just looks nicer :)
-            getpool = SequentialPoolExecutor
-        elif cfg.nthreads == 1:
-            assert cfg.nprocs > 1
-            getpool = lambda: ProcessPoolExecutor(cfg.nprocs)
-            useproc = True
-        elif cfg.nprocs == 1:
-            assert cfg.nthreads > 1
-            getpool = lambda: ThreadPoolExecutor(cfg.nthreads)
+        useproc = cfg.nprocs > 1
+        key = fpr_key(cfg)
+
+        # Leafs with a cached fpr get it assigned, only the others are sent to
+        # the pool.
+        self.leaf_fprs = {}
+        todo = []
+        leafs = list(self.tree.leafs.values() if leafs is None else leafs)
+        for leaf in leafs:
+            fpr = None if self.cache is None else self.cache.get(leaf, key)
+            if fpr is None:
+                todo.append(leaf)
+            else:
+                leaf.fpr = fpr
+                self.leaf_fprs[leaf.path] = fpr
+
+        watched = cfg.stall_timeout is not None or \
+            cfg.file_timeout is not None
+        if watched:
+            self._collect_leaf_fprs_watched(todo, key)
+        if self.pool is None:
+            if not watched or cfg.archives:
+                with parallel.get_pool(nprocs=cfg.nprocs,
+                                       nthreads=cfg.nthreads) as pool:
+                    if not watched:
+                        self._collect_leaf_fprs(pool, todo, key)
+                    if cfg.archives:
+                        self.expand_archives(pool, leafs)
         else:
-            getpool = lambda: ProcessAndThreadPoolExecutor(nprocs=cfg.nprocs,
-                                                           nthreads=cfg.nthreads)
-            useproc = True
-
-        with getpool() as pool:
-            self.leaf_fprs = dict(pool.map(self.fpr_worker,
-                                           self.tree.leafs.values(),
-                                           chunksize=1))
+            if not watched:
+                self._collect_leaf_fprs(self.pool, todo, key)
+            if cfg.archives:
+                self.expand_archives(self.pool, leafs)
 
-        if useproc and cfg.share_leafs:
-            for leaf in self.tree.leafs.values():
+        if useproc and cfg.share_leafs and not watched:
+            for leaf in todo:
                 leaf.fpr = self.leaf_fprs[leaf.path]
 
+    def _collect_leaf_fprs(self, pool, todo, key):
+        # Results arrive in order. Put each into the cache right away, such
+        # that a persistent cache (e.g. checkpoint.Checkpoint) has all fprs
+        # calculated so far if we get killed.
+        for leaf, (path, fpr, digests) in zip(todo,
+                                              pool.map(self.fpr_worker, todo,
+                                                       chunksize=1)):
+            self.leaf_fprs[path] = fpr
+            leaf.digests = digests
+            self.cache_leaf(leaf, key, fpr)
+
+    def cache_leaf(self, leaf, key, fpr):
+        """Put `fpr` of `leaf` for fpr setting `key` into self.cache, or all
+        of leaf.digests if we have them. Missing and unreadable files are
+        not cached."""
+        if self.cache is None or fpr in (MISSING_FILE_FPR,
+                                         UNREADABLE_FILE_FPR):
+            return
+        if leaf.digests:
+            for kk, vv in leaf.digests.items():
+                self.cache.set(leaf, kk, vv)
+        else:
+            self.cache.set(leaf, key, fpr)
+
+    def _collect_leaf_fprs_watched(self, todo, key):
+        # Threads in this process only, so leaf.fpr is set here, not only in
+        # the workers.
+        from findsame.watchdog import Watchdog
+        self.watchdog = Watchdog(nworkers=self.cfg.nprocs*self.cfg.nthreads,
+                                 stall_timeout=self.cfg.stall_timeout,
+                                 file_timeout=self.cfg.file_timeout)
+        for leaf, fpr in self.watchdog.run(todo):
+            leaf.fpr = fpr
+            self.leaf_fprs[leaf.path] = fpr
+            self.cache_leaf(leaf, key, fpr)
+
+    def expand_archives(self, pool, leafs):
+        """Hash members of all archives in `leafs` (one pool job per archive)
+        and add them to self.tree and self.leaf_fprs, see findsame.archive.
+        Archives with a cached fpr are expanded as well, members are not
+        cached.
+        """
+        from findsame import archive
+        archives = [leaf for leaf in leafs if archive.is_archive(leaf.path)
+                    and not isinstance(leaf, archive.ArchiveLeaf)
+                    and self.leaf_fprs.get(leaf.path) not in
+                    (MISSING_FILE_FPR, UNREADABLE_FILE_FPR)]
+        worker = functools.partial(archive.hash_archive,
+                                   blocksize=self.cfg.blocksize,
+                                   limit=self.cfg.limit,
+                                   sparse=self.cfg.sparse)
+        for leaf, members in zip(archives,
+                                 pool.map(worker,
+                                          [leaf.path for leaf in archives],
+                                          chunksize=1)):
+            if members is None:
+                continue
+            nodes, leafs = archive.build_nodes(leaf, members)
+            self.tree.nodes.update(nodes)
+            self.tree.leafs.update(leafs)
+            self.leaf_fprs.update((path, elem.fpr) for path, elem in
+                                  leafs.items())
+
     def calc_node_fprs(self):
         self.node_fprs = dict((node.path,node.fpr) for node in self.tree.nodes.values())
+
+    def calc_node_fprs_pruned(self):
+        """Calculate node fprs, but hash only leafs in nodes whose structural
+        signature (Node.sig) is not unique. All other nodes can't have a
+        twin, they get a unique fake fpr w/o reading any file. Also all
+        their parents have a unique signature, so no real fpr depends on a
+        fake one. self.leaf_fprs has only the hashed leafs.
+        """
+        nodes = self.tree.nodes.values()
+        counts = Counter(node.sig for node in nodes)
+        leafs = []
+        for node in nodes:
+            if counts[node.sig] > 1:
+                leafs += [c for c in node.childs if c.kind == 'leaf']
+            else:
+                node.fpr = hashsum(f"unique:{node.path}")
+        co.debug_msg(f"dirs_only: hash {len(leafs)} of "
+                     f"{len(self.tree.leafs)} leafs")
+        self.calc_leaf_fprs(leafs=leafs)
+        self.calc_node_fprs()
@@ -0,0 +1,202 @@
+"""Checkpoint and resume long-running scans.
+
+A checkpoint is a sqlite file with
+
+* the run configuration (paths and all settings which change the result),
+  a resumed run must use the same
+* the listing (sub-dirs, files) and mtime of each walked dir
+* the fprs of all hashed leafs with the size and mtime they had
+
+It is written periodically (every `interval` seconds) during the scan, so
+we lose at most that much work when killed. Checkpoint is an FprCache, use
+it as `cache` in calc.MerkleTree and Checkpoint.walk() as `walk` in
+calc.FileDirTree (see main.get_merkle_tree()). When resuming,
+
+* dirs with unchanged mtime are not listed again but replayed from the
+  checkpoint
+* leafs with unchanged size and mtime (one stat, needed anyway) get their
+  fpr from the checkpoint, all others are hashed
+* node fprs are cheap and always calculated from the leaf fprs
+
+Note that a file changed in-place with the same size and mtime is not
+detected, as with FprCache in general.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+from findsame import calc
+from findsame.cache import FprCache
+
+
+# settings in cfg which change the result
+CFG_KEYS = ['exclude', 'include', 'min_size', 'max_size']
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def run_config(cfg, files_dirs):
+    """Dict which identifies a run, a checkpoint can only be resumed by a
+    run with the same."""
+    dct = dict((kk, cfg[kk]) for kk in CFG_KEYS)
+    dct.update(files_dirs=[os.path.abspath(pp) for pp in files_dirs],
+               fpr_key=calc.fpr_key(cfg))
+    return dct
+
+
+class Checkpoint(FprCache):
+    """
+    Parameters
+    ----------
+    filename : str
+        sqlite file
+    cfg : config.Config instance
+    files_dirs : seq of str
+        what we scan
+    resume : bool
+        continue from an existing checkpoint (error if the run config
+        differs), else the file must not exist
+    interval : float
+        write to `filename` every that many seconds
+    """
+    def __init__(self, filename, cfg, files_dirs, resume=False, interval=60):
+        super().__init__()
+        self.filename = filename
+        self.interval = interval
+        self.config = run_config(cfg, files_dirs)
+        self.key = self.config['fpr_key']
+        exists = os.path.exists(filename)
+        if exists and not resume:
+            raise CheckpointError(f"checkpoint exists, use resume or remove "
+                                  f"it: {filename}")
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY,
+                                             value TEXT);
+            CREATE TABLE IF NOT EXISTS leafs (path TEXT PRIMARY KEY,
+                                              size INTEGER,
+                                              mtime_ns INTEGER,
+                                              fpr TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY,
+                                             mtime_ns INTEGER,
+                                             dirs TEXT,
+                                             files TEXT);
+            """)
+        # dir path -> (mtime_ns, dirs, files)
+        self._dirs = {}
+        if exists:
+            self._load()
+        else:
+            self._set_meta(config=self.config, complete=False)
+            self._conn.commit()
+        self._pending_leafs = []
+        self._pending_dirs = []
+        self._last_flush = time.monotonic()
+
+    def _set_meta(self, **kwds):
+        self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)",
+                               [(kk, json.dumps(vv)) for kk, vv in
+                                kwds.items()])
+
+    def meta(self):
+        return dict((kk, json.loads(vv)) for kk, vv in
+                    self._conn.execute("SELECT key, value FROM meta"))
+
+    def _load(self):
+        config = self.meta().get('config')
+        if config != self.config:
+            diff = sorted(kk for kk in set(self.config) | set(config or {})
+                          if (config or {}).get(kk) != self.config.get(kk))
+            raise CheckpointError(f"run config differs from checkpoint "
+                                  f"{self.filename} in: {diff}")
+        for path, size, mtime_ns, fpr in self._conn.execute(
+                "SELECT path, size, mtime_ns, fpr FROM leafs"):
+            self._data[path] = (size, mtime_ns, {self.key: fpr})
+        for path, mtime_ns, dirs, files in self._conn.execute(
+                "SELECT path, mtime_ns, dirs, files FROM dirs"):
+            self._dirs[path] = (mtime_ns, _split(dirs), _split(files))
+
+    def set(self, leaf, key, fpr):
+        super().set(leaf, key, fpr)
+        if key == self.key:
+            with self._lock:
+                self._pending_leafs.append((leaf.path, leaf.filesize,
+                                            leaf.mtime_ns, fpr))
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush > self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write everything collected since the last flush."""
+        with self._lock:
+            leafs, self._pending_leafs = self._pending_leafs, []
+            dirs, self._pending_dirs = self._pending_dirs, []
+            self._conn.executemany("INSERT OR REPLACE INTO leafs "
+                                   "VALUES (?,?,?,?)", leafs)
+            self._conn.executemany("INSERT OR REPLACE INTO dirs "
+                                   "VALUES (?,?,?,?)", dirs)
+            self._conn.commit()
+            self._last_flush = time.monotonic()
+
+    def walk(self, top):
+        """Same as os.walk(top), but replay listings of dirs which have the
+        same mtime as in the checkpoint and record new ones."""
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            try:
+                mtime_ns = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            entry = self._dirs.get(root)
+            if entry is not None and entry[0] == mtime_ns:
+                dirs, files = list(entry[1]), list(entry[2])
+            else:
+                dirs, files = [], []
+                try:
+                    with os.scandir(root) as it:
+                        for dentry in it:
+                            try:
+                                is_dir = dentry.is_dir()
+                            except OSError:
+                                is_dir = False
+                            (dirs if is_dir else files).append(dentry.name)
+                except OSError:
+                    continue
+                self._dirs[root] = (mtime_ns, dirs[:], files[:])
+                with self._lock:
+                    self._pending_dirs.append((root, mtime_ns, _join(dirs),
+                                               _join(files)))
+                self._maybe_flush()
+            yield root, dirs, files
+            # as os.walk(followlinks=False), dirs may have been pruned by
+            # the caller
+            for name in reversed(dirs):
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    stack.append(path)
+
+    def close(self, complete=False):
+        """Flush and close. With `complete`, mark the run as finished."""
+        if self._conn is not None:
+            self.flush()
+            if complete:
+                self._set_meta(complete=True)
+                self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+
+def _join(names):
+    return '\0'.join(names)
+
+
+def _split(st):
+    return st.split('\0') if st else []
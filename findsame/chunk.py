@@ -0,0 +1,252 @@
+"""Chunk-level analysis of near-duplicate files.
+
+Files are split into variable size chunks using content-defined chunking
+(FastCDC [1] style, i.e. a gear rolling hash with normalized chunking), such
+that an insertion or deletion in a file changes only the chunks around it.
+Chunks are identified by their hash. Shared chunks between files tell us
+how many bytes two files have in common, unique chunks in a tree tell us
+how much space a chunk-level dedup store would need.
+
+Gear hash
+---------
+We use a 32 bit gear hash
+
+    h[i] = ((h[i-1] << 1) + GEAR[data[i]]) mod 2**32
+
+where bytes older than 32 steps have been shifted out, i.e.
+
+    h[i] = sum_{k=0}^{31} GEAR[data[i-k]] << k  mod 2**32
+
+We only test for cut points at least MIN bytes (>= 32) after the chunk
+start, where h only depends on the last 32 bytes. With numpy, h is
+calculated for a whole read buffer at once using the second form, with
+log2(32)=5 shift-and-add passes, see _gear_hash_numpy(). Without numpy, we
+fall back to a (slow) pure Python loop. Both give the same chunks.
+
+[1] Xia et al., FastCDC: a Fast and Efficient Content-Defined Chunking
+    Approach for Data Deduplication, USENIX ATC 2016
+"""
+
+import functools
+import hashlib
+import itertools
+from collections import defaultdict
+
+from findsame import calc, parallel
+from findsame.common import KiB, MiB
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MASK32 = 0xffffffff
+GEAR = [int.from_bytes(hashlib.sha1(bytes([ii])).digest()[:4], 'little')
+        for ii in range(256)]
+READ_SIZE = 4*MiB
+# chunks in more files than that are not counted in file pairs
+MAX_FANOUT = 100
+
+
+class ChunkParams:
+    """Chunk size parameters, derived from the average chunk size `avg_size`
+    (power of 2), as in FastCDC with normalization level 2: minimum
+    avg_size/4, maximum 8*avg_size, cut point masks with log2(avg_size)+2
+    bits (before avg_size, harder to match) and log2(avg_size)-2 bits
+    (after avg_size, easier to match)."""
+    def __init__(self, avg_size=8*KiB):
+        nbits = avg_size.bit_length() - 1
+        assert avg_size == 2**nbits, f"avg_size={avg_size} not a power of 2"
+        assert avg_size >= 256, f"avg_size={avg_size} too small"
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 8
+        # use the upper bits, which depend on the most bytes in the window
+        self.mask_s = ((1 << (nbits + 2)) - 1) << (32 - nbits - 2)
+        self.mask_l = ((1 << (nbits - 2)) - 1) << (32 - nbits + 2)
+
+
+def _gear_hash_numpy(data):
+    gear = np.array(GEAR, dtype=np.uint32)
+    hh = gear[np.frombuffer(data, dtype=np.uint8)]
+    shift = 1
+    while shift < 32:
+        hh[shift:] += hh[:-shift] << np.uint32(shift)
+        shift *= 2
+    return hh
+
+
+def _cut_points_numpy(data, params, eof):
+    """Yield chunk end positions in `data`. If not `eof`, stop before the
+    last chunk which may continue in the next buffer."""
+    hh = _gear_hash_numpy(data)
+    cand_s = np.flatnonzero((hh & np.uint32(params.mask_s)) == 0)
+    cand_l = np.flatnonzero((hh & np.uint32(params.mask_l)) == 0)
+    start = 0
+    end = len(data)
+    while start < end:
+        if not eof and end - start < params.max_size:
+            break
+        lo = start + params.min_size
+        mid = min(start + params.avg_size, end)
+        hi = min(start + params.max_size, end)
+        cut = hi
+        if lo < end:
+            idx = np.searchsorted(cand_s, lo)
+            if idx < len(cand_s) and cand_s[idx] < mid:
+                cut = int(cand_s[idx]) + 1
+            else:
+                idx = np.searchsorted(cand_l, max(lo, mid))
+                if idx < len(cand_l) and cand_l[idx] < hi:
+                    cut = int(cand_l[idx]) + 1
+        yield cut
+        start = cut
+
+
+def _cut_points_python(data, params, eof):
+    start = 0
+    end = len(data)
+    while start < end:
+        if not eof and end - start < params.max_size:
+            break
+        lo = start + params.min_size
+        mid = min(start + params.avg_size, end)
+        hi = min(start + params.max_size, end)
+        cut = hi
+        hh = 0
+        # warm up, h depends only on the last 32 bytes
+        for ii in range(max(start, lo - 32), min(lo, end)):
+            hh = ((hh << 1) + GEAR[data[ii]]) & MASK32
+        for ii in range(lo, hi):
+            hh = ((hh << 1) + GEAR[data[ii]]) & MASK32
+            mask = params.mask_s if ii < mid else params.mask_l
+            if not hh & mask:
+                cut = ii + 1
+                break
+        yield cut
+        start = cut
+
+
+def iter_chunks(path, params, use_numpy=True):
+    """Yield ``(digest, length)`` of all chunks of file `path`, where
+    digest is the binary calc.HASHFUNC digest of the chunk's content."""
+    cut_points = _cut_points_numpy if (use_numpy and np is not None) \
+        else _cut_points_python
+    pending = b''
+    with open(path, 'rb') as fd:
+        while True:
+            buf = fd.read(READ_SIZE)
+            eof = len(buf) == 0
+            data = pending + buf
+            start = 0
+            for cut in cut_points(data, params, eof):
+                yield calc.HASHFUNC(data[start:cut]).digest(), cut - start
+                start = cut
+            pending = data[start:]
+            if eof:
+                break
+
+
+def chunk_file(path, avg_size=8*KiB, use_numpy=True):
+    """List of ``(digest, length)`` of all chunks of file `path`."""
+    return list(iter_chunks(path, ChunkParams(avg_size), use_numpy=use_numpy))
+
+
+def _chunk_worker(path, avg_size):
+    try:
+        return path, chunk_file(path, avg_size=avg_size)
+    except FileNotFoundError:
+        return path, []
+
+
+def analyze(files_dirs, avg_size=8*KiB, cfg=None, pool=None, min_shared=1,
+            max_fanout=MAX_FANOUT):
+    """Chunk all files in `files_dirs` and report shared data.
+
+    Parameters
+    ----------
+    files_dirs : seq of str
+        files and/or dirs, each one is a "tree" for which we report the dedup
+        ratio
+    avg_size : int
+        average chunk size (power of 2)
+    cfg, pool :
+        see calc.MerkleTree, files are chunked in parallel
+    min_shared : int
+        report only file pairs which share at least that many bytes
+    max_fanout : int, None
+        chunks found in more files than that (e.g. zero-filled blocks,
+        common headers) don't count as shared bytes of file pairs, which
+        would give ``n*(n-1)/2`` pairs, None = no limit
+
+    Returns
+    -------
+    dict
+        {'pairs': [{'files': [path_a, path_b],
+                    'shared_bytes': ...,
+                    'sizes': [size_a, size_b]},
+                   ...],
+         'trees': {path: {'files': number of files,
+                          'total_bytes': sum of file sizes,
+                          'unique_bytes': sum of sizes of distinct chunks,
+                          'dedup_ratio': total_bytes / unique_bytes},
+                   ...}}
+
+    Pairs are sorted by shared_bytes, largest first. Shared bytes of a pair
+    is the size of all distinct chunks which are in both files.
+    """
+    from findsame import main
+    trees = {}
+    sizes = {}
+    for path in files_dirs:
+        leafs = main.get_merkle_tree([path], cfg=cfg).tree.leafs
+        trees[path] = list(leafs.keys())
+        sizes.update((kk, vv.filesize) for kk, vv in leafs.items())
+
+    worker = functools.partial(_chunk_worker, avg_size=avg_size)
+    if pool is None:
+        cfg = calc.global_cfg if cfg is None else cfg
+        with parallel.get_pool(nprocs=cfg.nprocs,
+                               nthreads=cfg.nthreads) as pool:
+            file_chunks = dict(pool.map(worker, sizes.keys()))
+    else:
+        file_chunks = dict(pool.map(worker, sizes.keys()))
+
+    # digest -> (length, set of files)
+    chunk_files = defaultdict(set)
+    chunk_size = {}
+    for path, chunks in file_chunks.items():
+        for digest, length in chunks:
+            chunk_files[digest].add(path)
+            chunk_size[digest] = length
+
+    # Sum up chunks by the set of files they are in first (e.g. most chunks
+    # of two near-duplicate files), then each set of files gives its pairs
+    # once, not once per chunk.
+    owners_bytes = defaultdict(int)
+    for digest, paths in chunk_files.items():
+        if len(paths) > 1 and (max_fanout is None or
+                               len(paths) <= max_fanout):
+            owners_bytes[frozenset(paths)] += chunk_size[digest]
+    shared = defaultdict(int)
+    for owners, nbytes in owners_bytes.items():
+        for pair in itertools.combinations(sorted(owners), 2):
+            shared[pair] += nbytes
+
+    pairs = [dict(files=list(pair),
+                  shared_bytes=nbytes,
+                  sizes=[sizes[pair[0]], sizes[pair[1]]])
+             for pair, nbytes in shared.items() if nbytes >= min_shared]
+    pairs.sort(key=lambda dd: (-dd['shared_bytes'], dd['files']))
+
+    tree_stats = {}
+    for root, paths in trees.items():
+        total = sum(sizes[pp] for pp in paths)
+        unique = sum(chunk_size[digest] for digest in
+                     set(dd for pp in paths for dd, _ in file_chunks[pp]))
+        tree_stats[root] = dict(files=len(paths),
+                                total_bytes=total,
+                                unique_bytes=unique,
+                                dedup_ratio=total/unique if unique > 0 else 1.0)
+    return dict(pairs=pairs, trees=tree_stats)
@@ -0,0 +1,579 @@
+"""Command line interface, installed as the ``findsame`` console script.
+
+Keep imports at module level cheap, everything else is imported in the
+command which needs it, see benchmark/importtime.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from findsame import common as co
+from findsame import main
+from findsame.config import cfg
+
+
+def add_hash_args(parser, limit=True):
+    """Add options which control hash calculation to `parser`."""
+    parser.add_argument("-b", "--blocksize",
+                        default=co.size2str(cfg.blocksize),
+                        help="blocksize in hash calculation, "
+                             "use units K,M,G as in 100M, 256K or just "
+                             "1024 (bytes), if LIMIT is used and "
+                             "BLOCKSIZE < LIMIT then we require mod(LIMIT, BLOCKSIZE) = 0 "
+                             "else we set BLOCKSIZE = LIMIT "
+                             "[default: %(default)s]")
+    if limit:
+        parser.add_argument("-l", "--limit",
+                            default=co.size2str(cfg.limit),
+                            help="read limit (bytes, see also BLOCKSIZE), "
+                                 "calculate hash only over the first LIMIT "
+                                 "bytes, makes things go faster for may large "
+                                 "files, try 512K [default: %(default)s]")
+    parser.add_argument("--sparse", action="store_true",
+                        default=cfg.sparse,
+                        help="don't read holes in sparse files (e.g. VM "
+                             "images), uses different hashes than w/o, "
+                             "which don't depend on how files are "
+                             "allocated")
+    parser.add_argument("--also-digest", action="append", default=[],
+                        metavar="SPEC",
+                        help="calculate and cache another hash in the same "
+                             "read, SPEC is [HASHNAME][:LIMIT], e.g. 512K, "
+                             "full, sha256, md5:1M, use with --cache to "
+                             "answer later runs with that LIMIT w/o "
+                             "reading files, other HASHNAMEs are only "
+                             "stored in the cache (scans always use sha1), "
+                             "can be repeated")
+    parser.add_argument("-p", "--nprocs",
+                        default=cfg.nprocs, type=int,
+                        help="number of parallel processes [default: %(default)s]")
+    parser.add_argument("-t", "--nthreads",
+                        default=os.cpu_count(), type=int,
+                        help="threads per process [default: %(default)s]")
+    parser.add_argument("--stall-timeout", type=float, metavar="SEC",
+                        help="report files which take longer than SEC "
+                             "seconds to read (e.g. hung network storage) "
+                             "and read files on other devices meanwhile "
+                             "[default: FILE_TIMEOUT]")
+    parser.add_argument("--file-timeout", type=float, metavar="SEC",
+                        help="give up on files which take longer than SEC "
+                             "seconds to read, they and their dirs are "
+                             "never reported as same")
+
+
+def apply_hash_args(args):
+    """Set cfg values from options added by add_hash_args()."""
+    cfg.nprocs = args.nprocs
+    cfg.nthreads = args.nthreads
+    cfg.blocksize = co.str2size(args.blocksize)
+    cfg.sparse = args.sparse
+    cfg.digests = args.also_digest
+    cfg.stall_timeout = args.stall_timeout
+    cfg.file_timeout = args.file_timeout
+    if hasattr(args, 'limit'):
+        cfg.limit = co.str2size(args.limit)
+    if hasattr(args, 'verbose'):
+        cfg.verbose = args.verbose
+    main.check_cfg(cfg)
+
+
+def add_filter_args(parser):
+    """Add include/exclude and size range options to `parser`."""
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="PATTERN",
+                        help="skip files and dirs matching PATTERN, "
+                             "excluded dirs are not walked, glob matched "
+                             "against the base name (e.g. '.git', '*.pyc') "
+                             "or the full path if it contains '/', prefix "
+                             "'re:' for a regex searched in the full path, "
+                             "can be repeated")
+    parser.add_argument("--include", action="append", default=[],
+                        metavar="PATTERN",
+                        help="use only files matching PATTERN (same syntax "
+                             "as EXCLUDE), can be repeated")
+    parser.add_argument("--min-size", default=co.size2str(cfg.min_size),
+                        help="skip files smaller than that, units as in "
+                             "BLOCKSIZE [default: %(default)s]")
+    parser.add_argument("--max-size", default=co.size2str(cfg.max_size),
+                        help="skip files larger than that, units as in "
+                             "BLOCKSIZE [default: %(default)s]")
+
+
+def apply_filter_args(args):
+    """Set cfg values from options added by add_filter_args()."""
+    cfg.exclude = args.exclude
+    cfg.include = args.include
+    cfg.min_size = co.str2size(args.min_size)
+    cfg.max_size = co.str2size(args.max_size)
+
+
+def add_throttle_args(parser):
+    """Add I/O limit options to `parser`."""
+    parser.add_argument("--max-bytes-per-sec", metavar="RATE",
+                        help="limit read bandwidth of all threads and "
+                             "processes together, units as in BLOCKSIZE, "
+                             "e.g. 50M")
+    parser.add_argument("--max-opens-per-sec", type=float, metavar="RATE",
+                        help="limit number of opened files per second")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="lower the bandwidth limit when read latency "
+                             "rises, needs MAX_BYTES_PER_SEC")
+
+
+def apply_throttle_args(parser, args):
+    """Install a throttle from options added by add_throttle_args(), if
+    any. Return it."""
+    if args.max_bytes_per_sec is None and args.max_opens_per_sec is None:
+        if args.adaptive:
+            parser.error("--adaptive needs --max-bytes-per-sec")
+        return None
+    from findsame import throttle
+    max_bytes = None if args.max_bytes_per_sec is None else \
+        co.str2size(args.max_bytes_per_sec)
+    try:
+        thr = throttle.Throttle(max_bytes_per_sec=max_bytes,
+                                max_opens_per_sec=args.max_opens_per_sec,
+                                adaptive=args.adaptive)
+    except ValueError as ex:
+        parser.error(str(ex))
+    throttle.install(thr)
+    return thr
+
+
+def report_throttle(thr):
+    """Print configured and achieved rates to stderr."""
+    if thr is not None:
+        print(json.dumps(dict(throttle=thr.report())), file=sys.stderr)
+
+
+def report_watchdog(merkle_tree):
+    """Print stalled and unreadable files to stderr, if any."""
+    wd = merkle_tree.watchdog
+    if wd is not None and (wd.stalled or wd.unreadable):
+        print(json.dumps(dict(watchdog=wd.report())), file=sys.stderr)
+
+
+def iter_files_from(filename):
+    """Paths listed in `filename` ('-' = stdin), see main.read_paths()."""
+    if filename == '-':
+        yield from main.read_paths(sys.stdin.buffer)
+    else:
+        with open(filename, 'rb') as fd:
+            yield from main.read_paths(fd)
+
+
+def main_scan(argv):
+    desc = "Find same files and dirs based on file hashes."
+    epilog = ("more commands: diff (compare snapshots), index (build and "
+              "query an index), chunks (near-duplicate analysis), act "
+              "(hardlink, reflink or delete duplicates), waste (largest "
+              "duplicates first), see 'findsame <command> -h'")
+    parser = argparse.ArgumentParser(description=desc, epilog=epilog)
+    parser.add_argument("files_dirs", nargs="*", metavar="file/dir",
+                        help="files and/or dirs to compare", default=[])
+    parser.add_argument("--files-from", metavar="FILE",
+                        help="also use files listed in FILE ('-' for "
+                             "stdin), separated by NUL (e.g. find "
+                             "-print0) or newline, read while building the "
+                             "tree, ignores --pipeline")
+    add_hash_args(parser)
+    add_filter_args(parser)
+    add_throttle_args(parser)
+    parser.add_argument("--recheck", metavar="RESULT",
+                        help="instead of a scan, check the groups in RESULT "
+                             "(json, any outmode, '-' for stdin) again, hash "
+                             "only listed files and dirs which still exist "
+                             "and have a same-size partner, print the "
+                             "updated groups, use the same options as for "
+                             "RESULT")
+    parser.add_argument("--find-copies-of", nargs="+", metavar="FILE",
+                        help="instead of all duplicates, find only copies "
+                             "of FILE(s) in file/dir (put file/dir first or "
+                             "after '--'), print one json object per line "
+                             "for each copy as soon as it is confirmed")
+    parser.add_argument("--estimate", action="store_true",
+                        help="only walk, don't hash, print files, bytes and "
+                             "estimated time for full, limit (LIMIT or "
+                             "512K) and size-prefiltered scans")
+    parser.add_argument("--throughput", metavar="FILE",
+                        help="throughput for --estimate: result file of "
+                             "benchmark/suite/10run.py or json with "
+                             "bytes_per_sec and secs_per_file [default: "
+                             "rough guess]")
+    parser.add_argument("-o", "--outmode",
+                        default=cfg.outmode, type=int,
+                        help="1: list of dicts (values of dict from mode 2), one "
+                             "dict per hash, 2: dict of dicts (full result), "
+                             "keys are hashes, 3: compact, sort by type "
+                             "(file, dir) [default: %(default)s]")
+    parser.add_argument("--pipeline", action="store_true",
+                        default=cfg.pipeline,
+                        help="hash files while still walking the file "
+                             "system, with a bounded number of jobs in "
+                             "flight, only if all args are dirs")
+    parser.add_argument("--dirs-only", action="store_true",
+                        default=cfg.dirs_only,
+                        help="report only same dirs, hash only files in "
+                             "dirs which may have a twin (same number and "
+                             "sizes of files, same structure below), "
+                             "ignores --pipeline")
+    parser.add_argument("--archives", action="store_true",
+                        default=cfg.archives,
+                        help="also hash files in tar and zip archives "
+                             "(.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz, .zip) "
+                             "w/o extracting them, report them as "
+                             "ARCHIVE::MEMBER, ignores --pipeline")
+    parser.add_argument("--snapshot", metavar="FILE",
+                        help="also write a snapshot of all files and dirs "
+                             "(hashes, sizes, paths) to FILE, compare "
+                             "snapshots with 'findsame diff'")
+    parser.add_argument("--db", metavar="FILE",
+                        help="write the result to sqlite database FILE "
+                             "(all files and dirs with hashes and sizes, "
+                             "groups with waste, indexed) instead of json "
+                             "to stdout")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="periodically save progress (dir listings, "
+                             "file hashes) to FILE, such that a killed "
+                             "scan can be continued with --resume")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the scan saved in CHECKPOINT, skip "
+                             "unchanged dirs and files, must be called with "
+                             "the same files/dirs and options")
+    parser.add_argument("--checkpoint-interval", type=float, metavar="SEC",
+                        help="save checkpoint every SEC seconds "
+                             "[default: 60]")
+    parser.add_argument("--state", metavar="FILE",
+                        help="keep dir listings and mtimes, file and dir "
+                             "hashes in FILE (sqlite, created if needed), "
+                             "in the next run list only dirs whose mtime "
+                             "changed, reuse hashes of unchanged dirs, "
+                             "misses in-place changes of files")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="keep file hashes in FILE (sqlite, created if "
+                             "needed) across runs, files with unchanged "
+                             "size and mtime are not read again")
+    parser.add_argument("-v", "--verbose",
+                        default=cfg.verbose, action="store_true",
+                        help="enable verbose/debugging output")
+    args = parser.parse_args(argv)
+
+    apply_hash_args(args)
+    apply_filter_args(args)
+    cfg.outmode = args.outmode
+    cfg.pipeline = args.pipeline
+    cfg.dirs_only = args.dirs_only
+    cfg.archives = args.archives
+    if args.dirs_only and args.snapshot is not None:
+        parser.error("--snapshot needs all files hashed, can't use "
+                     "--dirs-only")
+    if args.db is not None and (args.recheck is not None or args.estimate or
+                                args.find_copies_of is not None):
+        parser.error("--db can't be used with --recheck, --estimate or "
+                     "--find-copies-of")
+    thr = apply_throttle_args(parser, args)
+
+    if args.recheck is not None:
+        if args.files_dirs:
+            parser.error("--recheck takes no file/dir")
+        from findsame import recheck
+        if args.recheck == '-':
+            old = json.load(sys.stdin)
+        else:
+            with open(args.recheck) as fd:
+                old = json.load(fd)
+        groups, stats = recheck.recheck(old)
+        print(json.dumps(dict(recheck=stats)), file=sys.stderr)
+        report_throttle(thr)
+        print(json.dumps(main.assemble_groups(groups, cfg.outmode)))
+        return
+    files_from = None
+    if args.files_from is not None:
+        if args.checkpoint is not None or args.estimate or \
+                args.find_copies_of is not None:
+            parser.error("--files-from can't be used with --checkpoint, "
+                         "--estimate or --find-copies-of")
+        files_from = iter_files_from(args.files_from)
+    elif not args.files_dirs:
+        parser.error("file/dir needed")
+    if args.find_copies_of is not None:
+        from findsame import copies
+        try:
+            for match in copies.iter_copies(args.find_copies_of,
+                                            args.files_dirs):
+                print(json.dumps(match), flush=True)
+        finally:
+            report_throttle(thr)
+        return
+    if args.estimate:
+        from findsame import estimate
+        model = None if args.throughput is None else \
+            estimate.ThroughputModel.from_file(args.throughput)
+        print(estimate.format_table(estimate.estimate(args.files_dirs,
+                                                      model=model)))
+        return
+    if args.state is not None:
+        if args.checkpoint is not None or args.resume or \
+                args.checkpoint_interval is not None or \
+                args.cache is not None or files_from is not None or \
+                args.dirs_only or args.archives or args.also_digest:
+            parser.error("--state can't be used with --checkpoint, --resume, "
+                         "--checkpoint-interval, --cache, --files-from, "
+                         "--dirs-only, --archives or --also-digest")
+        from findsame.state import State
+        with State(args.state, cfg) as state:
+            merkle_tree = state.get_merkle_tree(args.files_dirs)
+            result = main.assemble_result(merkle_tree)
+            state.save(merkle_tree)
+            print(json.dumps(dict(state=state.stats)), file=sys.stderr)
+    elif args.checkpoint is None:
+        if args.resume or args.checkpoint_interval is not None:
+            parser.error("--resume and --checkpoint-interval need "
+                         "--checkpoint")
+        if args.cache is None:
+            merkle_tree = main.get_merkle_tree(args.files_dirs,
+                                               files_from=files_from)
+            result = main.assemble_result(merkle_tree)
+        else:
+            from findsame.cache import PersistentFprCache
+            with PersistentFprCache(args.cache) as cache:
+                merkle_tree = main.get_merkle_tree(args.files_dirs,
+                                                   cache=cache,
+                                                   files_from=files_from)
+                result = main.assemble_result(merkle_tree)
+    else:
+        if args.cache is not None:
+            parser.error("--checkpoint can't be used with --cache")
+        import signal
+        from findsame.checkpoint import Checkpoint
+        ckp = Checkpoint(args.checkpoint, cfg, args.files_dirs,
+                         resume=args.resume,
+                         interval=(60 if args.checkpoint_interval is None
+                                   else args.checkpoint_interval))
+        # save checkpoint when killed by SIGTERM, too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(128 + 15))
+        complete = False
+        try:
+            merkle_tree = main.get_merkle_tree(args.files_dirs, cache=ckp,
+                                               walk=ckp.walk)
+            result = main.assemble_result(merkle_tree)
+            complete = True
+        finally:
+            ckp.close(complete=complete)
+    if args.snapshot is not None:
+        from findsame import snapshot
+        snapshot.write(merkle_tree, args.snapshot, roots=args.files_dirs)
+    report_watchdog(merkle_tree)
+    report_throttle(thr)
+    if args.db is not None:
+        from findsame import resultdb
+        counts = resultdb.write(merkle_tree, args.db)
+        print(json.dumps(dict(db=counts)), file=sys.stderr)
+    else:
+        print(json.dumps(result))
+
+
+def main_waste(argv):
+    desc = ("Find the duplicate files which waste the most space first: "
+            "group files by size, hash same-size groups in order of "
+            "descending potential waste (size * (count - 1)) and print one "
+            "json object per line for each group of same files as soon as "
+            "it is found. Stop at TOP groups, TARGET bytes of waste or after "
+            "BUDGET seconds.")
+    parser = argparse.ArgumentParser(prog="findsame waste", description=desc)
+    parser.add_argument("files_dirs", nargs="+", metavar="file/dir",
+                        help="files and/or dirs to search")
+    parser.add_argument("-n", "--top", type=int,
+                        help="stop after that many groups")
+    parser.add_argument("--target",
+                        help="stop when that much waste was found, units as "
+                             "in BLOCKSIZE, e.g. 100G")
+    parser.add_argument("--budget", type=float, metavar="SEC",
+                        help="stop after that many seconds")
+    add_hash_args(parser)
+    add_filter_args(parser)
+    add_throttle_args(parser)
+    args = parser.parse_args(argv)
+
+    apply_hash_args(args)
+    apply_filter_args(args)
+    thr = apply_throttle_args(parser, args)
+    from findsame import waste
+    target = None if args.target is None else co.str2size(args.target)
+    for group in waste.iter_waste(args.files_dirs, top=args.top,
+                                  target=target, budget=args.budget):
+        print(json.dumps(group), flush=True)
+    report_throttle(thr)
+
+
+def main_diff(argv):
+    desc = ("Compare two snapshots (see 'findsame --snapshot'). Print one "
+            "json object per line for each added, removed, moved or "
+            "duplicated file and dir.")
+    parser = argparse.ArgumentParser(prog="findsame diff", description=desc)
+    parser.add_argument("snap_a", metavar="A.snap", help="old snapshot")
+    parser.add_argument("snap_b", metavar="B.snap", help="new snapshot")
+    parser.add_argument("-s", "--summary", action="store_true",
+                        help="print only the number of events per type and "
+                             "kind (file, dir)")
+    args = parser.parse_args(argv)
+
+    from findsame import snapshot
+    events = snapshot.diff(args.snap_a, args.snap_b)
+    if args.summary:
+        summary = {}
+        for event in events:
+            key = f"{event['event']}:{event['kind']}"
+            summary[key] = summary.get(key, 0) + 1
+        print(json.dumps(summary))
+    else:
+        for event in events:
+            print(json.dumps(event))
+
+
+def main_index(argv):
+    desc = ("Build an index of file hashes and sizes of a (large) reference "
+            "archive once, then quickly check whether files exist in there.")
+    parser = argparse.ArgumentParser(prog="findsame index", description=desc)
+    sub = parser.add_subparsers(dest="action", required=True)
+
+    build = sub.add_parser("build", help="build index from files and dirs")
+    build.add_argument("files_dirs", nargs="+", metavar="file/dir",
+                       help="files and/or dirs to index")
+    build.add_argument("-i", "--index", required=True, metavar="FILE",
+                       help="index file to write")
+    add_hash_args(build)
+    add_filter_args(build)
+    add_throttle_args(build)
+
+    query = sub.add_parser("query",
+                           help="for each file, print json with paths of "
+                                "files in the index which have the same "
+                                "content (empty list if none)")
+    query.add_argument("files_dirs", nargs="+", metavar="file/dir",
+                       help="files and/or dirs to look up")
+    query.add_argument("-i", "--index", required=True, metavar="FILE",
+                       help="index file to use")
+    add_hash_args(query, limit=False)
+    add_throttle_args(query)
+    args = parser.parse_args(argv)
+
+    apply_hash_args(args)
+    thr = apply_throttle_args(parser, args)
+    from findsame import index
+    if args.action == "build":
+        apply_filter_args(args)
+        merkle_tree = main.get_merkle_tree(args.files_dirs)
+        merkle_tree.calc_leaf_fprs()
+        index.write(merkle_tree, args.index)
+        report_watchdog(merkle_tree)
+    else:
+        with index.Index(args.index) as idx:
+            for path, matches in idx.query(args.files_dirs):
+                print(json.dumps(dict(path=path, matches=matches)))
+    report_throttle(thr)
+
+
+def main_chunks(argv):
+    desc = ("Split files into content-defined chunks and report how many "
+            "bytes pairs of files share and the chunk-level dedup ratio of "
+            "each file/dir argument. Prints json.")
+    parser = argparse.ArgumentParser(prog="findsame chunks", description=desc)
+    parser.add_argument("files_dirs", nargs="+", metavar="file/dir",
+                        help="files and/or dirs to analyze")
+    parser.add_argument("-a", "--avg-size", default="8K",
+                        help="average chunk size, power of 2, use units as "
+                             "in BLOCKSIZE [default: %(default)s]")
+    parser.add_argument("-m", "--min-shared", default="1",
+                        help="report only file pairs which share at least "
+                             "that many bytes [default: %(default)s]")
+    parser.add_argument("--max-fanout", type=int, default=100,
+                        metavar="N",
+                        help="chunks in more than N files (e.g. zero-filled "
+                             "blocks) don't count as shared bytes of file "
+                             "pairs [default: %(default)s]")
+    add_hash_args(parser, limit=False)
+    add_filter_args(parser)
+    args = parser.parse_args(argv)
+
+    apply_hash_args(args)
+    apply_filter_args(args)
+    from findsame import chunk
+    print(json.dumps(chunk.analyze(args.files_dirs,
+                                   avg_size=co.str2size(args.avg_size),
+                                   min_shared=co.str2size(args.min_shared),
+                                   max_fanout=args.max_fanout)))
+
+
+def main_act(argv):
+    desc = ("Act on duplicate files in a findsame result (any outmode): keep "
+            "the first file of each group, replace the others by hardlinks "
+            "or reflinks to it, or delete them. Groups are processed in "
+            "parallel, all steps are written to a journal, such that an "
+            "interrupted run can be resumed or rolled back. Empty files and "
+            "dirs are ignored.")
+    from findsame import action
+    parser = argparse.ArgumentParser(prog="findsame act", description=desc)
+    parser.add_argument("action", choices=action.ACTIONS + ['rollback'],
+                        help="what to do with duplicates, 'rollback' "
+                             "restores all duplicates in JOURNAL")
+    parser.add_argument("result", nargs="?", default=None,
+                        help="result json file, '-' for stdin, not needed "
+                             "for rollback")
+    parser.add_argument("-j", "--journal", required=True,
+                        help="journal file")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="continue an interrupted run using JOURNAL, "
+                             "pass the same result again")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="don't compare file content before acting, "
+                             "only safe if the result is from a scan w/o "
+                             "--limit")
+    parser.add_argument("-t", "--nthreads",
+                        default=os.cpu_count(), type=int,
+                        help="number of groups to process in parallel "
+                             "[default: %(default)s]")
+    # allow options between action and result
+    args = parser.parse_intermixed_args(argv)
+
+    if args.action == 'rollback':
+        counts = action.rollback(args.journal)
+    else:
+        if args.result is None:
+            parser.error("result file needed")
+        if args.result == '-':
+            import time
+            # a result from a pipe was written just now
+            result_mtime = time.time()
+            result = json.load(sys.stdin)
+        else:
+            with open(args.result) as fd:
+                result = json.load(fd)
+            result_mtime = os.path.getmtime(args.result)
+        deduper = action.Deduper(args.action, args.journal,
+                                 nthreads=args.nthreads,
+                                 result_mtime=result_mtime,
+                                 verify=args.verify)
+        counts = deduper.run(result, resume=args.resume)
+    print(json.dumps(counts))
+
+
+commands = {'diff': main_diff,
+            'act': main_act,
+            'index': main_index,
+            'chunks': main_chunks,
+            'waste': main_waste}
+
+
+def run(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] in commands:
+        commands[argv[0]](argv[1:])
+    else:
+        main_scan(argv)
+
+
+if __name__ == '__main__':
+    run()
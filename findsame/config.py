@@ -20,6 +20,31 @@ cfg = Config(nprocs=1,
              limit=None,
              outmode=3,
              verbose=False,
+             # walk and hash at the same time, see findsame.pipeline
+             pipeline=False,
+             # see findsame.filters
+             exclude=[],
+             include=[],
+             min_size=None,
+             max_size=None,
+             # only dirs, hash only files in dirs which may have a twin, see
+             # calc.MerkleTree.calc_node_fprs_pruned(), no pipeline
+             dirs_only=False,
+             # hash members of tar/zip files, see findsame.archive, no
+             # pipeline
+             archives=False,
+             # skip holes in sparse files, different fprs, see
+             # calc.hash_file_sparse()
+             sparse=False,
+             # report reads slower than that (seconds), give up on files
+             # after file_timeout, see findsame.watchdog, no pipeline
+             stall_timeout=None,
+             file_timeout=None,
+             # more fprs calculated in the same read and cached, spec
+             # "[HASHNAME][:LIMIT]", see calc.parse_digest()
+             digests=[],
              )
 
-default_cfg = copy.deepcopy(cfg)
+# deepcopy() alone doesn't call __init__(), so the copy wouldn't have
+# attribute access
+default_cfg = Config(copy.deepcopy(cfg))
@@ -0,0 +1,109 @@
+"""Find copies of given files in a tree.
+
+Instead of all duplicates among all files, we often only want to know
+where else a few (large) files live. We
+
+* hash the query files
+* walk the search roots (no hashing, only one stat per file) and keep only
+  files which have the same size as a query file
+* read the first HEAD_SIZE bytes of each candidate and drop it if that
+  isn't the head of a query file of that size
+* hash the rest and yield each match as soon as it is confirmed
+
+So only files which really are copies (or start the same) are read
+completely.
+
+::
+
+    >>> for match in iter_copies(['big.iso'], ['/data']):
+    ...     print(match['query'], match['copy'])
+"""
+
+import os
+from collections import defaultdict
+from concurrent.futures import as_completed
+
+from findsame import calc, main, parallel, throttle
+from findsame import common as co
+from findsame.config import cfg as global_cfg
+
+HEAD_SIZE = 4*co.KiB
+
+
+def read_head(path, size=HEAD_SIZE):
+    thr = throttle.current
+    if thr is not None:
+        thr.open()
+    with open(path, 'rb') as fd:
+        return calc._read(fd, size, thr)
+
+
+def _check(leaf, heads):
+    """Return ``(path, fpr)`` of `leaf`, fpr is None if its head is not one
+    of `heads` (dict size -> set of heads) or it can't be read."""
+    try:
+        if read_head(leaf.path) not in heads[leaf.filesize]:
+            return leaf.path, None
+    except OSError:
+        return leaf.path, None
+    return leaf.path, leaf.fpr
+
+
+def iter_copies(queries, files_dirs, cfg=None, pool=None):
+    """Yield dicts ``{query, copy}`` for each file in `files_dirs` with the
+    same content as one of the files in `queries`, in the order they are
+    confirmed.
+
+    Parameters
+    ----------
+    queries : seq of str
+        files to look for
+    files_dirs : seq of str
+        where to search, the query files themselves are never reported
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg, hash and filter
+        settings are used
+    pool : pool executor instance, None
+        None = create one from cfg.nprocs and cfg.nthreads
+    """
+    cfg = global_cfg if cfg is None else cfg
+    query_leafs = []
+    for path in queries:
+        if not os.path.isfile(path):
+            raise Exception(f"not a file: {path}")
+        query_leafs.append(calc.Leaf(path))
+    query_paths = set(os.path.abspath(leaf.path) for leaf in query_leafs)
+    sizes = set(leaf.filesize for leaf in query_leafs)
+    tree = main.get_file_dir_tree(files_dirs, cfg=cfg)
+    candidates = [leaf for leaf in tree.leafs.values()
+                  if leaf.filesize in sizes and
+                  os.path.abspath(leaf.path) not in query_paths]
+    co.debug_msg(f"copies: {len(candidates)} of {len(tree.leafs)} files "
+                 f"have the size of a query file")
+
+    own_pool = pool is None
+    if own_pool:
+        pool = parallel.get_pool(nprocs=cfg.nprocs, nthreads=cfg.nthreads)
+    try:
+        qtree = calc.FileDirTree(files=[])
+        qtree.leafs.update((leaf.path, leaf) for leaf in query_leafs)
+        merkle_tree = calc.MerkleTree(qtree, cfg=cfg, pool=pool)
+        merkle_tree.calc_leaf_fprs()
+        by_fpr = defaultdict(list)
+        heads = defaultdict(set)
+        for leaf in query_leafs:
+            by_fpr[merkle_tree.leaf_fprs[leaf.path]].append(leaf.path)
+            heads[leaf.filesize].add(read_head(leaf.path))
+        ctree = calc.FileDirTree(files=[])
+        ctree.leafs.update((leaf.path, leaf) for leaf in candidates)
+        # sets fpr_func of the candidates
+        calc.MerkleTree(ctree, cfg=cfg)
+        heads = dict(heads)
+        futures = [pool.submit(_check, leaf, heads) for leaf in candidates]
+        for future in as_completed(futures):
+            path, fpr = future.result()
+            for query in by_fpr.get(fpr, []):
+                yield dict(query=query, copy=path)
+    finally:
+        if own_pool:
+            pool.shutdown()
@@ -0,0 +1,122 @@
+import copy
+
+from findsame import main, parallel
+from findsame.cache import FprCache
+from findsame.config import Config, default_cfg
+
+
+class Engine:
+    """Session object for running many scans in one process.
+
+    In contrast to :func:`findsame.main.main`, which reads the package-wide
+    findsame.config.cfg, an Engine owns its own config, worker pool and leaf
+    fpr cache. Use this in long-running processes or when scanning
+    concurrently with different settings in the same interpreter. The pool is
+    created on first use and kept until close(). Leaf fprs of files with
+    unchanged size and mtime are taken from the cache in later scans. An
+    index file (see findsame.index) can be opened once and queried many
+    times.
+
+    Debug output is not a setting of an Engine, it is process-wide, set
+    findsame.config.cfg.verbose.
+
+    Example
+    -------
+    >>> with Engine(nthreads=4, limit=512*1024) as engine:
+    ...     result = engine.scan(['/path/to/dir'])
+    ...     for fpr, typ, paths in engine.iter_scan(['/other/dir']):
+    ...         print(typ, paths)
+    """
+    def __init__(self, cfg=None, **kwds):
+        """
+        Parameters
+        ----------
+        cfg : dict, None
+            config values to use instead of the defaults in
+            findsame.config.default_cfg
+        kwds :
+            more config values, override `cfg`
+        """
+        self.cfg = Config(copy.deepcopy(default_cfg))
+        if cfg is not None:
+            self.cfg.update(cfg)
+        self.cfg.update(kwds)
+        if 'verbose' in kwds or (cfg is not None and 'verbose' in cfg):
+            raise ValueError("verbose is process-wide, set "
+                             "findsame.config.cfg.verbose")
+        del self.cfg['verbose']
+        main.check_cfg(self.cfg)
+        self.cache = FprCache()
+        self.index = None
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = parallel.get_pool(nprocs=self.cfg.nprocs,
+                                           nthreads=self.cfg.nthreads)
+        return self._pool
+
+    def merkle_tree(self, files_dirs):
+        """MerkleTree of `files_dirs` using this session's config, cache and
+        pool. No fprs are calculated."""
+        return main.get_merkle_tree(files_dirs, cfg=self.cfg,
+                                    cache=self.cache, pool=self.pool)
+
+    def scan(self, files_dirs):
+        """Same as :func:`findsame.main.main`, return the result in
+        self.cfg.outmode format."""
+        return main.assemble_result(self.merkle_tree(files_dirs))
+
+    def iter_scan(self, files_dirs):
+        """Yield ``(fpr, typ, paths)`` for each group of same files and dirs,
+        see :func:`findsame.main.iter_groups`."""
+        merkle_tree = self.merkle_tree(files_dirs)
+        merkle_tree.calc_fprs()
+        yield from main.iter_groups(merkle_tree)
+
+    def iter_waste(self, files_dirs, **kwds):
+        """Yield groups of same files, largest waste first, see
+        :func:`findsame.waste.iter_waste` (`kwds`: top, target, budget)."""
+        from findsame.waste import iter_waste
+        yield from iter_waste(files_dirs, cfg=self.cfg, pool=self.pool,
+                              **kwds)
+
+    def iter_copies(self, queries, files_dirs):
+        """Yield ``{query, copy}`` for each copy of a file in `queries`
+        found in `files_dirs`, see :func:`findsame.copies.iter_copies`."""
+        from findsame.copies import iter_copies
+        yield from iter_copies(queries, files_dirs, cfg=self.cfg,
+                               pool=self.pool)
+
+    def open_index(self, filename):
+        """Open index file (see findsame.index) for query(). The index stays
+        open until close() or the next open_index() call."""
+        from findsame.index import Index
+        if self.index is not None:
+            self.index.close()
+        self.index = Index(filename)
+        return self.index
+
+    def query(self, files_dirs):
+        """Yield ``(path, matches)`` for all files in `files_dirs`, where
+        `matches` are paths of files with the same content in the index
+        opened by open_index(), see :meth:`findsame.index.Index.query`."""
+        if self.index is None:
+            raise Exception("no index, call open_index() first")
+        yield from self.index.query(files_dirs, pool=self.pool,
+                                    cache=self.cache, cfg=self.cfg)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,181 @@
+"""Estimate the cost of a scan without hashing anything.
+
+We walk the file system (one stat per file, as in every scan) and count
+files and bytes which would be read by each strategy:
+
+full
+    every file, completely
+limit
+    only the first LIMIT bytes of each file (``--limit``)
+size
+    only files which have the same size as another file, since only those
+    can be the same (what ``findsame waste`` and ``--recheck`` do)
+size+limit
+    both
+
+Bytes and files are converted to time with a ThroughputModel: time =
+bytes / bytes_per_sec + files * secs_per_file. Its parameters are fitted to
+results of the benchmark suite (benchmark/suite/10run.py, measured on the
+target storage, cold cache preferred) or read from a profile file::
+
+    {"bytes_per_sec": 104857600, "secs_per_file": 0.0005}
+
+Without either, rough defaults are used.
+"""
+
+import json
+import time
+from collections import Counter
+
+from findsame import common as co
+from findsame import main
+from findsame.config import cfg as global_cfg
+
+DEFAULT_BYTES_PER_SEC = 100*co.MiB
+DEFAULT_SECS_PER_FILE = 5e-4
+# used for the limit strategies if cfg.limit is None
+DEFAULT_LIMIT = 512*co.KiB
+
+
+class ThroughputModel:
+    """
+    Parameters
+    ----------
+    bytes_per_sec : float
+    secs_per_file : float
+        open, stat and hasher overhead per file
+    source : str
+        where the numbers come from
+    """
+    def __init__(self, bytes_per_sec=DEFAULT_BYTES_PER_SEC,
+                 secs_per_file=DEFAULT_SECS_PER_FILE, source='default'):
+        assert bytes_per_sec > 0, f"bytes_per_sec={bytes_per_sec}"
+        self.bytes_per_sec = bytes_per_sec
+        self.secs_per_file = secs_per_file
+        self.source = source
+
+    def __call__(self, nbytes, nfiles):
+        """Time in seconds."""
+        return nbytes / self.bytes_per_sec + nfiles * self.secs_per_file
+
+    @classmethod
+    def from_results(cls, results, source='results'):
+        """Fit to benchmark suite results (list of dicts with nbytes, nfiles,
+        time, mix, cache). Use cold cache runs if there are any, and the
+        fastest run per mix."""
+        results = [rr for rr in results if
+                   all(kk in rr for kk in ['nbytes', 'nfiles', 'time',
+                                           'mix'])]
+        if not results:
+            raise Exception(f"no usable benchmark results in {source}")
+        if any(rr.get('cache') == 'cold' for rr in results):
+            results = [rr for rr in results if rr.get('cache') == 'cold']
+        best = {}
+        for rr in results:
+            if rr['mix'] not in best or rr['time'] < best[rr['mix']]['time']:
+                best[rr['mix']] = rr
+        points = [(rr['nbytes'], rr['nfiles'], rr['time'])
+                  for rr in best.values()]
+        # least squares fit of time = a * nbytes + c * nfiles
+        sbb = sum(bb * bb for bb, _, _ in points)
+        snn = sum(nn * nn for _, nn, _ in points)
+        sbn = sum(bb * nn for bb, nn, _ in points)
+        sbt = sum(bb * tt for bb, _, tt in points)
+        snt = sum(nn * tt for _, nn, tt in points)
+        det = sbb * snn - sbn * sbn
+        aa = cc = None
+        if det > 0:
+            aa = (sbt * snn - snt * sbn) / det
+            cc = (snt * sbb - sbt * sbn) / det
+        if aa is None or aa <= 0 or cc < 0:
+            # one point or degenerate fit: all time is for reading bytes
+            aa = sbt / sbb
+            cc = 0.0
+        return cls(bytes_per_sec=1 / aa, secs_per_file=cc, source=source)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Read a profile or benchmark suite result json file."""
+        with open(filename) as fd:
+            data = json.load(fd)
+        if 'results' in data:
+            return cls.from_results(data['results'], source=filename)
+        return cls(bytes_per_sec=data['bytes_per_sec'],
+                   secs_per_file=data.get('secs_per_file', 0.0),
+                   source=filename)
+
+
+def estimate(files_dirs, cfg=None, model=None):
+    """Walk `files_dirs` and estimate bytes, files and time of each
+    strategy.
+
+    Parameters
+    ----------
+    files_dirs : seq of str
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg, filter settings
+        are used, cfg.limit for the limit strategies (DEFAULT_LIMIT if
+        None)
+    model : ThroughputModel, None
+        None = defaults
+
+    Returns
+    -------
+    dict with walk statistics and ``strategies``: list of dicts with
+    strategy, files, bytes, time
+    """
+    cfg = global_cfg if cfg is None else cfg
+    model = ThroughputModel() if model is None else model
+    limit = DEFAULT_LIMIT if cfg.limit is None else cfg.limit
+    t0 = time.monotonic()
+    tree = main.get_file_dir_tree(files_dirs, cfg=cfg)
+    walk_time = time.monotonic() - t0
+    sizes = [leaf.filesize for leaf in tree.leafs.values()]
+    counts = Counter(sizes)
+    same = [size for size in sizes if size > 0 and counts[size] > 1]
+    strategies = []
+    for name, selected, lim in [('full', sizes, None),
+                                (f'limit={co.size2str(limit)}', sizes,
+                                 limit),
+                                ('size', same, None),
+                                (f'size+limit={co.size2str(limit)}', same,
+                                 limit)]:
+        nbytes = sum(selected) if lim is None else \
+            sum(min(size, lim) for size in selected)
+        strategies.append(dict(strategy=name,
+                               files=len(selected),
+                               bytes=nbytes,
+                               time=model(nbytes, len(selected))))
+    return dict(files=len(sizes),
+                dirs=len(tree.nodes),
+                bytes=sum(sizes),
+                walk_time=walk_time,
+                model=dict(bytes_per_sec=model.bytes_per_sec,
+                           secs_per_file=model.secs_per_file,
+                           source=model.source),
+                strategies=strategies)
+
+
+def _time2str(secs):
+    if secs < 60:
+        return f"{secs:.1f} s"
+    elif secs < 3600:
+        return f"{secs / 60:.1f} min"
+    return f"{secs / 3600:.1f} h"
+
+
+def format_table(est):
+    """Text table of the output of estimate()."""
+    model = est['model']
+    lines = [f"walked {est['files']} files, {est['dirs']} dirs, "
+             f"{co.size2str(est['bytes'])} in {_time2str(est['walk_time'])}",
+             f"model ({model['source']}): "
+             f"{co.size2str(model['bytes_per_sec'])}/s, "
+             f"{model['secs_per_file'] * 1e3:.3g} ms/file",
+             "",
+             f"{'strategy':<20} {'files':>10} {'bytes':>10} {'time':>10}"]
+    for st in est['strategies']:
+        lines.append(f"{st['strategy']:<20} {st['files']:>10} "
+                     f"{co.size2str(st['bytes']):>10} "
+                     f"{_time2str(st['time']):>10}")
+    return '\n'.join(lines)
@@ -0,0 +1,95 @@
+"""Include/exclude rules and size ranges applied while walking the file
+system, before anything is hashed.
+
+Patterns
+--------
+A pattern is either a glob (fnmatch syntax) or, if it starts with ``re:``,
+a regular expression. A glob w/o ``/`` is matched against the base name
+(``*.pyc``, ``.git``, ``node_modules``), a glob with ``/`` against the full
+path (``*/build/*``). A regex is searched for in the full path
+(``re:/tmp[0-9]+$``).
+
+Rules
+-----
+* exclude: files and dirs matching any exclude pattern are skipped. Excluded
+  dirs are pruned from the walk, i.e. never listed.
+* include: if given, only files matching any include pattern are used. Dirs
+  are always descended into (unless excluded).
+* min_size, max_size: only files with min_size <= size <= max_size are used.
+
+Dirs and filtered children
+--------------------------
+A dir's fpr and size are calculated from the children which passed the
+filters only. Two dirs are therefore "same" if they have the same content
+*after* filtering, e.g. two checkouts of a repo which differ only in
+``.git`` are found with ``exclude=['.git']``. A dir whose files were all
+filtered out has the fpr of an empty dir. Dirs passed on the command line
+and explicitly listed files are subject to the file rules, but a top dir
+itself is never excluded.
+"""
+
+import fnmatch
+import os
+import re
+
+
+def _compile(pattern):
+    """Return function ``match(path, base) -> bool`` for one pattern."""
+    if pattern.startswith('re:'):
+        rex = re.compile(pattern[3:])
+        return lambda path, base: rex.search(path) is not None
+    elif '/' in pattern:
+        return lambda path, base: fnmatch.fnmatchcase(path, pattern)
+    else:
+        return lambda path, base: fnmatch.fnmatchcase(base, pattern)
+
+
+class PathFilter:
+    """
+    Parameters
+    ----------
+    exclude, include : seq of str
+        patterns, see module doc string
+    min_size, max_size : int, None
+        file size range in bytes, None = no limit
+    """
+    def __init__(self, exclude=(), include=(), min_size=None, max_size=None):
+        self.exclude = [_compile(pp) for pp in exclude]
+        self.include = [_compile(pp) for pp in include]
+        self.min_size = min_size
+        self.max_size = max_size
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        return cls(exclude=cfg.exclude,
+                   include=cfg.include,
+                   min_size=cfg.min_size,
+                   max_size=cfg.max_size)
+
+    @property
+    def active(self):
+        return (len(self.exclude) > 0 or len(self.include) > 0 or
+                self.min_size is not None or self.max_size is not None)
+
+    @staticmethod
+    def _any(matchers, path):
+        base = os.path.basename(path)
+        return any(match(path, base) for match in matchers)
+
+    def skip_dir(self, path):
+        return self._any(self.exclude, path)
+
+    def skip_file(self, path):
+        """Check name only, see also skip_size()."""
+        if self._any(self.exclude, path):
+            return True
+        if self.include and not self._any(self.include, path):
+            return True
+        return False
+
+    def skip_size(self, size):
+        if self.min_size is not None and size < self.min_size:
+            return True
+        if self.max_size is not None and size > self.max_size:
+            return True
+        return False
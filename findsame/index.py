@@ -0,0 +1,257 @@
+"""Prebuilt index of file fprs for fast "do these files already exist in
+there?" queries.
+
+File format
+-----------
+
+::
+
+    MAGIC
+    header length (uint32, little endian)
+    header (json, utf-8), zero-padded to a multiple of 8 bytes
+    sizes : sorted unique file sizes (uint64 each)
+    bloom : Bloom filter bit array over all sizes
+    records : sorted by digest, each record is
+        digest (binary fpr, header['digest_size'] bytes)
+        size (uint64)
+        path offset (uint64, relative to the paths section)
+    paths : each path is
+        path length (uint32)
+        path (os.fsencode()-ed)
+
+All numbers are little endian. Section offsets in the header are relative to
+the end of the (padded) header. The file is accessed with mmap, i.e. only
+the pages needed to answer a query are read: a few Bloom filter bits, a
+binary search in the sizes table and, only for files with a matching size, a
+binary search in the records.
+"""
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from findsame import calc
+from findsame.config import Config, cfg as global_cfg
+
+
+MAGIC = b'findsame-index\n'
+VERSION = 1
+BLOOM_BITS_PER_SIZE = 10
+BLOOM_NHASH = 7
+
+U64 = struct.Struct('<Q')
+U32 = struct.Struct('<I')
+
+
+class IndexFileError(Exception):
+    pass
+
+
+def _bloom_positions(size, nbits, nhash):
+    # double hashing, see Kirsch, Mitzenmacher: Less Hashing, Same
+    # Performance: Building a Better Bloom Filter
+    digest = hashlib.blake2b(U64.pack(size), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + ii*h2) % nbits for ii in range(nhash)]
+
+
+def write(merkle_tree, filename):
+    """Write index of all leafs in `merkle_tree` to `filename`. Leaf fprs must
+    have been calculated already (merkle_tree.calc_leaf_fprs()). Missing and
+    unreadable files (see calc.MISSING_FILE_FPR) are skipped."""
+    leafs = merkle_tree.tree.leafs
+    records = sorted((bytes.fromhex(fpr), leafs[path].filesize, path)
+                     for path, fpr in merkle_tree.leaf_fprs.items()
+                     if fpr not in (calc.MISSING_FILE_FPR,
+                                    calc.UNREADABLE_FILE_FPR))
+    sizes = sorted(set(rec[1] for rec in records))
+    nbits = max(64, BLOOM_BITS_PER_SIZE * len(sizes))
+    nbits += (-nbits) % 64
+    bloom = bytearray(nbits // 8)
+    for size in sizes:
+        for pos in _bloom_positions(size, nbits, BLOOM_NHASH):
+            bloom[pos // 8] |= 1 << (pos % 8)
+
+    digest_size = calc.HASHFUNC().digest_size
+    rec_struct = struct.Struct(f'<{digest_size}sQQ')
+    sizes_off = 0
+    bloom_off = sizes_off + U64.size * len(sizes)
+    records_off = bloom_off + len(bloom)
+    paths_off = records_off + rec_struct.size * len(records)
+    cfg = merkle_tree.cfg
+    header = dict(version=VERSION,
+                  fpr_key=calc.fpr_key(cfg),
+                  hashfunc=calc.HASHFUNC().name,
+                  digest_size=digest_size,
+                  limit=cfg.limit,
+                  blocksize=cfg.blocksize,
+                  sparse=cfg.sparse,
+                  nsizes=len(sizes),
+                  nrecords=len(records),
+                  bloom_nbits=nbits,
+                  bloom_nhash=BLOOM_NHASH,
+                  sizes_off=sizes_off,
+                  bloom_off=bloom_off,
+                  records_off=records_off,
+                  paths_off=paths_off,
+                  )
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b'\0' * ((-(len(MAGIC) + U32.size + len(header_bytes))) % 8)
+    with open(filename, 'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(U32.pack(len(header_bytes)))
+        fd.write(header_bytes)
+        for size in sizes:
+            fd.write(U64.pack(size))
+        fd.write(bloom)
+        path_pos = 0
+        for digest, size, path in records:
+            fd.write(rec_struct.pack(digest, size, path_pos))
+            path_pos += U32.size + len(os.fsencode(path))
+        for _, _, path in records:
+            bpath = os.fsencode(path)
+            fd.write(U32.pack(len(bpath)))
+            fd.write(bpath)
+
+
+class _MmapArray:
+    """Read-only sequence view of fixed size items in an mmap, such that we
+    can use bisect on it."""
+    def __init__(self, mm, offset, nitems, itemsize, getitem):
+        self.mm = mm
+        self.offset = offset
+        self.nitems = nitems
+        self.itemsize = itemsize
+        self.getitem = getitem
+
+    def __len__(self):
+        return self.nitems
+
+    def __getitem__(self, idx):
+        return self.getitem(self.mm, self.offset + idx*self.itemsize)
+
+
+class Index:
+    """Memory-mapped index file written by write().
+
+    Example
+    -------
+    >>> with Index('archive.idx') as index:
+    ...     for path, matches in index.query(['new_dir']):
+    ...         print(path, matches)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = open(filename, 'rb')
+        try:
+            if self._fd.read(len(MAGIC)) != MAGIC:
+                raise IndexFileError(f"not a findsame index: {filename}")
+            nn, = U32.unpack(self._fd.read(U32.size))
+            self.header = json.loads(self._fd.read(nn).rstrip(b'\0').decode('utf-8'))
+            if self.header['version'] != VERSION:
+                raise IndexFileError(f"unsupported index version "
+                                     f"{self.header['version']}: {filename}")
+            self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._fd.close()
+            raise
+        hdr = self.header
+        data_off = len(MAGIC) + U32.size + nn
+        self._sizes = _MmapArray(self._mm, data_off + hdr['sizes_off'],
+                                 hdr['nsizes'], U64.size,
+                                 lambda mm, off: U64.unpack_from(mm, off)[0])
+        self._bloom_off = data_off + hdr['bloom_off']
+        self._rec_struct = struct.Struct(f"<{hdr['digest_size']}sQQ")
+        ds = hdr['digest_size']
+        self._records = _MmapArray(self._mm, data_off + hdr['records_off'],
+                                   hdr['nrecords'], self._rec_struct.size,
+                                   lambda mm, off: mm[off:off+ds])
+        self._paths_off = data_off + hdr['paths_off']
+
+    def cfg(self, cfg=None):
+        """Copy of `cfg` (or the package-wide cfg) with the hash settings of
+        this index, to calculate fprs of files to look up."""
+        cfg = Config(global_cfg if cfg is None else cfg)
+        cfg.limit = self.header['limit']
+        cfg.blocksize = self.header['blocksize']
+        cfg.sparse = self.header['sparse']
+        return cfg
+
+    def maybe_has_size(self, size):
+        """Bloom filter test. False means there is no file with this size in
+        the index, True means there may be one."""
+        hdr = self.header
+        for pos in _bloom_positions(size, hdr['bloom_nbits'], hdr['bloom_nhash']):
+            if not self._mm[self._bloom_off + pos // 8] & (1 << (pos % 8)):
+                return False
+        return True
+
+    def has_size(self, size):
+        if not self.maybe_has_size(size):
+            return False
+        idx = bisect.bisect_left(self._sizes, size)
+        return idx < len(self._sizes) and self._sizes[idx] == size
+
+    def _path(self, offset):
+        off = self._paths_off + offset
+        nn, = U32.unpack_from(self._mm, off)
+        return os.fsdecode(self._mm[off+U32.size:off+U32.size+nn])
+
+    def lookup(self, fpr):
+        """List of paths in the index with fpr `fpr` (hex string)."""
+        digest = bytes.fromhex(fpr)
+        idx = bisect.bisect_left(self._records, digest)
+        paths = []
+        while idx < len(self._records) and self._records[idx] == digest:
+            off = self._records.offset + idx*self._records.itemsize
+            _, _, path_off = self._rec_struct.unpack_from(self._mm, off)
+            paths.append(self._path(path_off))
+            idx += 1
+        return paths
+
+    def query(self, files_dirs, pool=None, cache=None, cfg=None):
+        """For all files in `files_dirs` (files and/or dirs), yield ``(path,
+        matches)``, where `matches` is a list of paths in the index with the
+        same content. Only files with a size found in the index are hashed.
+
+        Parameters
+        ----------
+        files_dirs : seq of str
+        pool, cache, cfg :
+            see calc.MerkleTree, cfg's hash settings are replaced by the
+            index's ones
+        """
+        from findsame import main
+        cfg = self.cfg(cfg)
+        if calc.fpr_key(cfg) != self.header['fpr_key']:
+            raise IndexFileError(f"index hash settings "
+                                 f"{self.header['fpr_key']} not supported, "
+                                 f"expect {calc.fpr_key(cfg)}")
+        merkle_tree = main.get_merkle_tree(files_dirs, cfg=cfg, cache=cache,
+                                           pool=pool)
+        candidates = {}
+        for path, leaf in merkle_tree.tree.leafs.items():
+            if self.has_size(leaf.filesize):
+                candidates[path] = leaf
+            else:
+                yield path, []
+        merkle_tree.calc_leaf_fprs(candidates.values())
+        for path, fpr in merkle_tree.leaf_fprs.items():
+            if fpr in (calc.MISSING_FILE_FPR, calc.UNREADABLE_FILE_FPR):
+                yield path, []
+            else:
+                yield path, self.lookup(fpr)
+
+    def close(self):
+        self._mm.close()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -4,10 +4,27 @@ import os
 
 from findsame import common as co
 from findsame import calc
-from findsame.config import cfg
+from findsame.filters import PathFilter
+from findsame.config import cfg as global_cfg
 
 
-def get_merkle_tree(files_dirs):
+def check_cfg(cfg):
+    """Check and adjust blocksize and limit in `cfg` in-place, check
+    digests."""
+    if cfg.limit is not None:
+        if cfg.blocksize < cfg.limit:
+            assert cfg.limit % cfg.blocksize == 0, \
+                    (f"limit={co.size2str(cfg.limit)} % "
+                     f"blocksize={co.size2str(cfg.blocksize)} != 0")
+        else:
+            cfg.blocksize = cfg.limit
+    calc.digest_keys(cfg)
+    return cfg
+
+
+def split_files_dirs(files_dirs):
+    """Split `files_dirs` into lists of files and dirs, raise if a path
+    doesn't exist."""
     if not co.is_seq(files_dirs):
         raise ValueError("files_dirs must be a list/tuple like sequence, "
                          f"got {type(files_dirs)}")
@@ -28,39 +45,118 @@ def get_merkle_tree(files_dirs):
                 files.append(path)
         else:
             raise Exception(f"not found: {path}")
+    return files, dirs
+
+
+def read_paths(fd, chunk_size=1024**2):
+    """Yield paths from binary file object `fd`, e.g. the output of ``find
+    -print0``, ``fd -0`` or a plain list. Paths are separated by NUL if
+    there is one in the data read until the first separator, else by
+    newline. Read in chunks of `chunk_size` bytes, so the list is never in
+    memory as a whole."""
+    sep = None
+    rest = b''
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            break
+        rest += chunk
+        if sep is None:
+            if b'\0' in rest:
+                sep = b'\0'
+            elif b'\n' in rest:
+                sep = b'\n'
+            else:
+                continue
+        *paths, rest = rest.split(sep)
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+    if rest:
+        yield os.fsdecode(rest)
 
-    tree = calc.FileDirTree(files=files)
+
+def get_file_dir_tree(files_dirs, cfg=None, walk=None, files_from=None):
+    """calc.FileDirTree of all `files_dirs`, with filter settings from `cfg`
+    (None = findsame.config.cfg), `walk` is passed to calc.FileDirTree. No
+    fprs are calculated. More files can be given as iterable `files_from`
+    (e.g. read_paths()), paths in there which don't exist or are not files
+    are skipped."""
+    cfg = global_cfg if cfg is None else cfg
+    files, dirs = split_files_dirs(files_dirs)
+    filt = PathFilter.from_cfg(cfg)
+    filt = filt if filt.active else None
+    tree = calc.FileDirTree(files=files, filt=filt)
+    if files_from is not None:
+        tree.update(calc.FileDirTree(files=files_from, filt=filt, link=True))
     for dr in dirs:
-        dt = calc.FileDirTree(dr=dr)
-        tree.update(dt)
-    return calc.MerkleTree(tree)
+        tree.update(calc.FileDirTree(dr=dr, filt=filt, walk=walk))
+    return tree
 
 
-def assemble_result(merkle_tree):
-    # result:
-    #   {fprA: {typX: [path1, path2],
-    #           typY: [path3]},
-    #    fprB: {typX: [...]},
-    #    ...}
-    merkle_tree.calc_fprs()
-    if cfg.outmode == 3:
-        result = defaultdict(list)
-    else:
-        result = defaultdict(dict)
+def get_merkle_tree(files_dirs, cfg=None, cache=None, pool=None, walk=None,
+                    files_from=None):
+    """
+    Parameters
+    ----------
+    files_dirs : seq
+        list of strings w/ files and/or dirs
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg, passed to
+        calc.MerkleTree, filter settings (cfg.exclude etc) are applied
+        while walking the file system, see findsame.filters
+    cache, pool :
+        passed to calc.MerkleTree
+    walk : callable, None
+        passed to calc.FileDirTree, None = os.walk
+    files_from : iterable of str, None
+        more files, see get_file_dir_tree()
+
+    Returns
+    -------
+    calc.MerkleTree instance, pipeline.PipelineMerkleTree if cfg.pipeline
+    (not with cfg.dirs_only, which needs the full tree before hashing,
+    cfg.archives, the watchdog timeouts, `files_from` and files in
+    `files_dirs`, whose nodes are only linked once all files are known)
+    """
+    cfg = global_cfg if cfg is None else cfg
+    watched = cfg.stall_timeout is not None or cfg.file_timeout is not None
+    files, dirs = split_files_dirs(files_dirs)
+    if cfg.pipeline and files_from is None and not files and \
+            not (cfg.dirs_only or cfg.archives or watched):
+        from findsame.pipeline import PipelineMerkleTree
+        filt = PathFilter.from_cfg(cfg)
+        filt = filt if filt.active else None
+        subtrees = [calc.FileDirTree(dr=dr, filt=filt, build=False,
+                                     walk=walk)
+                    for dr in dirs]
+        return PipelineMerkleTree(subtrees, cfg=cfg, cache=cache, pool=pool)
+    tree = get_file_dir_tree(files_dirs, cfg=cfg, walk=walk,
+                             files_from=files_from)
+    return calc.MerkleTree(tree, cfg=cfg, cache=cache, pool=pool)
+
+
+def iter_groups(merkle_tree):
+    """Yield ``(fpr, typ, paths)`` for each group of same-fpr dirs and
+    files, where `typ` is one of 'dir', 'dir:empty', 'file', 'file:empty'. Fprs
+    must have been calculated already (merkle_tree.calc_fprs()). With
+    cfg.dirs_only, only dirs are reported, since not all files were hashed.
+    """
     cases = [('dir',
               co.invert_dict(merkle_tree.node_fprs),
               calc.EMPTY_DIR_FPR,
-              calc.MISSING_DIR_FPR),
-             ('file',
-              co.invert_dict(merkle_tree.leaf_fprs),
-              calc.EMPTY_FILE_FPR,
-              calc.MISSING_FILE_FPR)]
-    for kind, inv_fprs, empty_fpr, missing_fpr in cases:
+              (calc.MISSING_DIR_FPR,))]
+    if not merkle_tree.cfg.dirs_only:
+        cases.append(('file',
+                      co.invert_dict(merkle_tree.leaf_fprs),
+                      calc.EMPTY_FILE_FPR,
+                      (calc.MISSING_FILE_FPR, calc.UNREADABLE_FILE_FPR)))
+    for kind, inv_fprs, empty_fpr, skip_fprs in cases:
         for fpr, paths in inv_fprs.items():
             # exclude single items, only multiple fprs for now (hence the
             # name find*same* :)
-            if fpr == missing_fpr:
-                co.debug_msg(f"skip missing {kind}: {paths}")
+            if fpr in skip_fprs:
+                co.debug_msg(f"skip missing or unreadable {kind}: {paths}")
                 continue
             if len(paths) > 1:
                 # exclude single deep files, where each upper dir has the same
@@ -82,23 +178,67 @@ def assemble_result(merkle_tree):
                     typ = f'{kind}:empty'
                 else:
                     typ = f'{kind}'
-                if cfg.outmode == 3:
-                    result[typ].append(paths)
-                else:
-                    result[fpr][typ] = result[fpr].get(typ, []) + paths
-    if cfg.outmode == 1:
+                yield fpr, typ, paths
+
+
+def assemble_result(merkle_tree):
+    merkle_tree.calc_fprs()
+    return assemble_groups(iter_groups(merkle_tree), merkle_tree.cfg.outmode)
+
+
+def assemble_groups(groups, outmode):
+    """Result in `outmode` format from ``(fpr, typ, paths)`` `groups` (e.g.
+    from iter_groups())."""
+    # result:
+    #   {fprA: {typX: [path1, path2],
+    #           typY: [path3]},
+    #    fprB: {typX: [...]},
+    #    ...}
+    if outmode == 3:
+        result = defaultdict(list)
+    else:
+        result = defaultdict(dict)
+    for fpr, typ, paths in groups:
+        if outmode == 3:
+            result[typ].append(paths)
+        else:
+            result[fpr][typ] = result[fpr].get(typ, []) + paths
+    if outmode == 1:
         return list(result.values())
-    elif cfg.outmode in [2,3]:
+    elif outmode in [2,3]:
         return result
     else:
-        raise Exception(f"illegal value for outmode: {cfg.outmode}")
+        raise Exception(f"illegal value for outmode: {outmode}")
+
+
+def iter_result_groups(result):
+    """Yield ``(typ, paths)`` for each group of same files or dirs in
+    `result`, which is the output of assemble_result() in any outmode (e.g.
+    loaded from json).
+    """
+    if isinstance(result, list):
+        # -o1: [{typ: paths, ...}, ...]
+        for dct in result:
+            yield from dct.items()
+    else:
+        for key, val in result.items():
+            if isinstance(val, dict):
+                # -o2: {fpr: {typ: paths, ...}, ...}
+                yield from val.items()
+            else:
+                # -o3: {typ: [paths, paths, ...], ...}
+                for paths in val:
+                    yield key, paths
 
 
-def main(files_dirs):
+def main(files_dirs, cfg=None):
     """
     Parameters
     ----------
     files_dirs : seq
         list of strings w/ files and/or dirs
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg
     """
-    return assemble_result(get_merkle_tree(files_dirs))
+    cfg = global_cfg if cfg is None else cfg
+    return assemble_result(get_merkle_tree(files_dirs, cfg=cfg))
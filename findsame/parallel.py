@@ -1,8 +1,21 @@
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
-    Executor
 import time
 import itertools
 
+from findsame import throttle
+
+# concurrent.futures.ProcessPoolExecutor imports multiprocessing, which is
+# slow. We import executors only when a pool is created, such that a
+# sequential run doesn't pay for that, see benchmark/importtime.
+
+
+def process_pool(nprocs):
+    """ProcessPoolExecutor whose processes use the throttle installed in
+    this process (if any)."""
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(nprocs, initializer=throttle.install,
+                               initargs=(throttle.current,))
+
+
 # TODO: investigate Executor.map(..., chunksize=N) with N>1 (default N=1)
 
 
@@ -37,6 +50,19 @@ class SequentialPoolExecutor:
         for item in seq:
             yield worker(item)
 
+    def submit(self, worker, *args, **kwds):
+        """Call worker now, return a completed Future."""
+        from concurrent.futures import Future
+        future = Future()
+        try:
+            future.set_result(worker(*args, **kwds))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+    def shutdown(self, *args, **kwds):
+        pass
+
     def __enter__(self, *args):
         return self
 
@@ -44,17 +70,23 @@ class SequentialPoolExecutor:
         pass
 
 
-class ProcessAndThreadPoolExecutor(Executor):
+class ProcessAndThreadPoolExecutor:
     """Split the sequence given to the map() method into self.nprocs chunks.
     Start nprocs processes, and in each start a thread pool of self.nthreads
-    size to process the sub-sequence."""
+    size to process the sub-sequence.
+
+    The process pool is started on the first map() call and re-used by all
+    following calls until shutdown() (or leaving the context manager).
+    """
     def __init__(self, nprocs, nthreads):
         self.nprocs = nprocs
         self.nthreads = nthreads
+        self._process_pool = None
 
     def process_worker(self, subseq):
         """Worker function for ProcessPoolExecutor. Spawn a thread pool of
         self.nthreads size in each process."""
+        from concurrent.futures import ThreadPoolExecutor
         with ThreadPoolExecutor(self.nthreads) as thread_pool:
             # Need to call list() here in between, else:
             #     concurrent.futures.process.BrokenProcessPool: A process in the
@@ -70,10 +102,54 @@ class ProcessAndThreadPoolExecutor(Executor):
         #     'ProcessAndThreadPoolExecutor.map.<locals>.process_worker'"
         # Must pass thread_worker that way to process_worker.
         self.thread_worker = thread_worker
-        with ProcessPoolExecutor(self.nprocs) as process_pool:
-            results = process_pool.map(self.process_worker, chop(seq,
-                                                                 self.nprocs), **kwds)
-            return itertools.chain(*results)
+        if self._process_pool is None:
+            self._process_pool = process_pool(self.nprocs)
+        results = self._process_pool.map(self.process_worker,
+                                          chop(seq, self.nprocs), **kwds)
+        return itertools.chain(*results)
+
+    def submit(self, worker, *args, **kwds):
+        """Run worker in one of the processes. Threads are not used, pass
+        a worker which processes many items with its own thread pool."""
+        if self._process_pool is None:
+            self._process_pool = process_pool(self.nprocs)
+        return self._process_pool.submit(worker, *args, **kwds)
+
+    def shutdown(self, wait=True, **kwds):
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=wait, **kwds)
+            self._process_pool = None
+
+    def __getstate__(self):
+        # self is sent to the worker processes along with process_worker,
+        # which must not include the process pool
+        state = self.__dict__.copy()
+        state['_process_pool'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown(wait=True)
+
+
+def get_pool(nprocs=1, nthreads=1):
+    """Return a pool executor for `nprocs` processes with `nthreads` threads
+    each. The caller is responsible for shutting it down, e.g. by using it as
+    a context manager.
+    """
+    if nthreads == 1 and nprocs == 1:
+        return SequentialPoolExecutor()
+    elif nthreads == 1:
+        assert nprocs > 1
+        return process_pool(nprocs)
+    elif nprocs == 1:
+        assert nthreads > 1
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(nthreads)
+    else:
+        return ProcessAndThreadPoolExecutor(nprocs=nprocs, nthreads=nthreads)
 
 
 if __name__ == '__main__':
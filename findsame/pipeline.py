@@ -0,0 +1,193 @@
+"""Overlapped walk-and-hash pipeline.
+
+calc.MerkleTree needs the complete tree before any hashing starts, and
+calc_leaf_fprs() submits all leafs to the pool at once. PipelineMerkleTree
+instead hashes leafs while the file system is still being walked:
+
+* The walker (calc.FileDirTree.iter_build()) runs in the main thread and
+  submits leafs to the pool in batches as soon as their dir was listed.
+* The number of batches in flight is bounded (`max_pending`). When the
+  limit is reached, the walker waits for the first batch to complete, so
+  the number of futures (and queued leaf objects) stays constant,
+  independent of the number of files.
+* Each node counts its childs which have no fpr yet. When a leaf's fpr
+  arrives, the count of its node is decreased, and a node whose count
+  reaches zero gets its fpr right away, which in turn decreases the count
+  of its parent. Thus node fprs are calculated bottom-up while the walk is
+  still going on.
+* Nodes whose count doesn't reach zero (e.g. sub-dirs which os.walk()
+  listed but couldn't enter) are finalized at the end.
+
+The result (leaf_fprs, node_fprs, tree) is the same as with
+calc.MerkleTree.
+"""
+
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from findsame import calc, parallel
+
+
+# number of leafs per submitted job with multiprocessing, where the cost of
+# sending each job to a process must be amortized, else 1
+PROC_BATCH_SIZE = 64
+
+
+def _hash_batch(leafs, nthreads=1):
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as pool:
+            return list(pool.map(calc.MerkleTree.fpr_worker, leafs))
+    return [calc.MerkleTree.fpr_worker(leaf) for leaf in leafs]
+
+
+class PipelineMerkleTree(calc.MerkleTree):
+    """MerkleTree which walks and hashes at the same time in calc_fprs(),
+    see module doc string.
+
+    Parameters
+    ----------
+    subtrees : seq of calc.FileDirTree instances
+        not built yet (build=False), they are walked in calc_fprs() and
+        merged into self.tree
+    cfg, cache, pool :
+        see calc.MerkleTree
+    max_pending : int, None
+        max number of jobs (leaf batches) in flight, None = 4 times the
+        number of workers
+    """
+    def __init__(self, subtrees, cfg=None, cache=None, pool=None,
+                 max_pending=None):
+        self.subtrees = subtrees
+        self.max_pending = max_pending
+        self._walked = False
+        # don't walk on self.tree access, see tree()
+        self._hold = True
+        super().__init__(calc.FileDirTree(files=[]), cfg=cfg, cache=cache,
+                         pool=pool)
+        self._hold = False
+
+    @property
+    def tree(self):
+        """The full tree. Code which uses it before calc_fprs() (e.g.
+        calc_leaf_fprs() for some leafs only) triggers a plain walk, after
+        which we behave like calc.MerkleTree."""
+        if not (self._walked or self._hold):
+            self.walk()
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
+
+    def walk(self):
+        """Build the whole tree w/o calculating anything, as
+        calc.MerkleTree would have done."""
+        if not self._walked:
+            for subtree in self.subtrees:
+                subtree.build_tree()
+                self._tree.update(subtree)
+            self._walked = True
+            self.set_leaf_fpr_func(self.cfg.limit)
+
+    def calc_fprs(self):
+        if self._walked:
+            super().calc_fprs()
+        elif self.pool is None:
+            cfg = self.cfg
+            with parallel.get_pool(nprocs=cfg.nprocs,
+                                   nthreads=cfg.nthreads) as pool:
+                self._run(pool)
+        else:
+            self._run(self.pool)
+
+    def _run(self, pool):
+        cfg = self.cfg
+        key = calc.fpr_key(cfg)
+        self.leaf_fprs = {}
+        self.node_fprs = {}
+        # node -> number of childs w/o fpr
+        pending = {}
+        # leaf or node -> parent node
+        parents = {}
+
+        if isinstance(pool, parallel.ProcessAndThreadPoolExecutor):
+            worker = functools.partial(_hash_batch, nthreads=cfg.nthreads)
+        else:
+            worker = _hash_batch
+        batch_size = PROC_BATCH_SIZE if cfg.nprocs > 1 else 1
+        max_pending = (4 * cfg.nprocs * cfg.nthreads
+                       if self.max_pending is None else self.max_pending)
+
+        def finish(elem):
+            parent = parents.pop(elem, None)
+            if parent is not None:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    finish_node(parent)
+
+        def finish_node(node):
+            del pending[node]
+            self.node_fprs[node.path] = node.fpr
+            finish(node)
+
+        def finish_leaf(leaf, fpr):
+            leaf.fpr = fpr
+            self.leaf_fprs[leaf.path] = fpr
+            finish(leaf)
+
+        # future -> batch of leafs
+        futures = {}
+
+        def collect(done):
+            for future in done:
+                batch = futures.pop(future)
+                for leaf, (_, fpr, digests) in zip(batch, future.result()):
+                    leaf.digests = digests
+                    self.cache_leaf(leaf, key, fpr)
+                    finish_leaf(leaf, fpr)
+
+        def submit(batch):
+            while len(futures) >= max_pending:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            futures[pool.submit(worker, batch)] = batch
+
+        batch = []
+        for subtree in self.subtrees:
+            for node, parent, dirs in subtree.iter_build():
+                nsub = 0 if dirs is None else \
+                    sum(not os.path.islink(os.path.join(node.path, dd))
+                        for dd in dirs)
+                leafs = list(node.childs)
+                pending[node] = len(leafs) + nsub
+                if parent is not None:
+                    parents[node] = parent
+                for leaf in leafs:
+                    parents[leaf] = node
+                for leaf in leafs:
+                    leaf.fpr_func = self.leaf_fpr_func
+                    fpr = None if self.cache is None else \
+                        self.cache.get(leaf, key)
+                    if fpr is None:
+                        batch.append(leaf)
+                        if len(batch) >= batch_size:
+                            submit(batch)
+                            batch = []
+                    else:
+                        finish_leaf(leaf, fpr)
+                # no childs or all leafs cached and finished already
+                if pending.get(node) == 0:
+                    finish_node(node)
+            self._tree.update(subtree)
+        if batch:
+            submit(batch)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            collect(done)
+
+        # nodes with sub-dirs which never showed up in the walk, all leaf
+        # fprs are known now, node.fpr calculates the rest recursively
+        for node in pending:
+            self.node_fprs[node.path] = node.fpr
+        self._walked = True
@@ -0,0 +1,145 @@
+"""Check that the groups in a previous result are still valid.
+
+Instead of scanning everything again, we only look at the paths listed in
+the result (any outmode, see main.iter_result_groups()):
+
+* paths which are gone or are not a regular file or dir any more are
+  dropped, w/o reading anything
+* files in a group are split by size first, only files which still have
+  the same size as another one in their group are hashed, empty files
+  never
+* dirs are scanned as in cfg.dirs_only mode, i.e. only files in dirs with a
+  shared structural signature (see calc.Node.sig) are hashed
+
+Each old group is split by the new fprs, new groups with >1 paths are
+returned. So the I/O is proportional to the size of the duplicates, not
+the whole tree.
+"""
+
+import os
+from collections import defaultdict
+
+from findsame import calc, main
+from findsame.config import Config, cfg as global_cfg
+
+
+def _leaf(path):
+    """calc.Leaf of a regular file, None if `path` is anything else or gone.
+    """
+    if os.path.islink(path) or not os.path.isfile(path):
+        return None
+    try:
+        return calc.Leaf(path)
+    except OSError:
+        return None
+
+
+def _top_dirs(paths):
+    """Paths in `paths` which are not below another one."""
+    tops = []
+    for path in sorted(set(paths)):
+        if not (tops and (path + os.sep).startswith(tops[-1] + os.sep)):
+            tops.append(path)
+    return tops
+
+
+def _split(paths, fprs):
+    """Split `paths` into groups of same fpr in `fprs` (dict path -> fpr),
+    yield ``(fpr, paths)`` for groups of >1 paths."""
+    groups = defaultdict(list)
+    for path in paths:
+        fpr = fprs.get(path)
+        if fpr not in (None, calc.MISSING_FILE_FPR, calc.MISSING_DIR_FPR,
+                       calc.UNREADABLE_FILE_FPR):
+            groups[fpr].append(path)
+    for fpr, group in groups.items():
+        if len(group) > 1:
+            yield fpr, group
+
+
+def recheck(result, cfg=None, pool=None):
+    """Check groups in `result` again.
+
+    Parameters
+    ----------
+    result : list, dict
+        output of main.assemble_result() in any outmode
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg, should have the
+        same hash and filter settings as the run which gave `result`
+    pool : pool executor instance, None
+        passed to calc.MerkleTree
+
+    Returns
+    -------
+    groups : list
+        ``(fpr, typ, paths)``, use main.assemble_groups() to get a result
+    stats : dict
+        number of old and new groups, paths, dropped paths and hashed
+        files
+    """
+    cfg = global_cfg if cfg is None else cfg
+    file_groups = []
+    dir_groups = []
+    for typ, paths in main.iter_result_groups(result):
+        (dir_groups if typ.startswith('dir') else file_groups).append(paths)
+    stats = dict(groups_in=len(file_groups) + len(dir_groups),
+                 paths_in=sum(map(len, file_groups + dir_groups)),
+                 dropped=0)
+
+    # files: stat, split by size, hash the rest
+    leafs = {}
+    for paths in file_groups:
+        for path in paths:
+            if path not in leafs:
+                leafs[path] = _leaf(path)
+    todo = {}
+    fprs = {}
+    for paths in file_groups:
+        by_size = defaultdict(list)
+        for path in paths:
+            leaf = leafs[path]
+            if leaf is None:
+                stats['dropped'] += 1
+            else:
+                by_size[leaf.filesize].append(leaf)
+        for size, group in by_size.items():
+            if len(group) < 2:
+                continue
+            for leaf in group:
+                if size == 0:
+                    fprs[leaf.path] = calc.EMPTY_FILE_FPR
+                else:
+                    todo[leaf.path] = leaf
+    tree = calc.FileDirTree(files=[])
+    tree.leafs.update(todo)
+    merkle_tree = calc.MerkleTree(tree, cfg=cfg, pool=pool)
+    merkle_tree.calc_leaf_fprs()
+    fprs.update(merkle_tree.leaf_fprs)
+    stats['hashed'] = len(todo)
+
+    # dirs: pruned scan of all listed dirs
+    dirs = set(path for paths in dir_groups for path in paths
+               if os.path.isdir(path) and not os.path.islink(path))
+    stats['dropped'] += sum(1 for paths in dir_groups for path in paths
+                            if path not in dirs)
+    node_fprs = {}
+    if dirs:
+        dcfg = Config(cfg, dirs_only=True, pipeline=False, archives=False)
+        merkle_tree = main.get_merkle_tree(_top_dirs(dirs), cfg=dcfg,
+                                           pool=pool)
+        merkle_tree.calc_fprs()
+        node_fprs = merkle_tree.node_fprs
+        stats['hashed'] += len(merkle_tree.leaf_fprs)
+
+    groups = []
+    for kind, old_groups, new_fprs, empty_fpr in \
+            [('file', file_groups, fprs, calc.EMPTY_FILE_FPR),
+             ('dir', dir_groups, node_fprs, calc.EMPTY_DIR_FPR)]:
+        for paths in old_groups:
+            for fpr, group in _split(paths, new_fprs):
+                typ = f'{kind}:empty' if fpr == empty_fpr else kind
+                groups.append((fpr, typ, group))
+    stats.update(groups_out=len(groups),
+                 paths_out=sum(len(group) for _, _, group in groups))
+    return groups, stats
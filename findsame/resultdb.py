@@ -0,0 +1,130 @@
+"""Write a scan result to a sqlite database for post-processing.
+
+Large json results are slow to load and query (e.g. with jq). Instead, all
+files, dirs and groups of same files and dirs go into a sqlite file with
+indexes, such that typical queries are fast:
+
+::
+
+    fprs    (id, fpr)
+    files   (path, size, fpr_id)
+    dirs    (path, size, fpr_id)
+    groups  (id, fpr_id, typ, size, count, waste)
+    members (group_id, path)
+
+`typ` is as in main.iter_groups() ('file', 'dir', 'file:empty',
+'dir:empty'), `size` is that of each file or dir in the group (for dirs:
+sum of all files below) and ``waste = size * (count - 1)``. Paths are
+indexed, use a range for all paths below a dir, e.g. largest duplicate dirs
+under /x::
+
+    SELECT g.waste, m.path FROM groups g JOIN members m ON m.group_id = g.id
+    WHERE g.typ = 'dir' AND m.path >= '/x/' AND m.path < '/x0'
+    ORDER BY g.waste DESC LIMIT 10;
+
+Rows are written with executemany() in batches of BATCH_SIZE, all in one
+transaction, indexes are created at the end.
+"""
+
+import itertools
+import os
+import sqlite3
+
+from findsame import calc, main
+
+BATCH_SIZE = 100000
+
+SCHEMA = """
+    CREATE TABLE fprs (id INTEGER PRIMARY KEY, fpr TEXT);
+    CREATE TABLE files (path TEXT, size INTEGER, fpr_id INTEGER);
+    CREATE TABLE dirs (path TEXT, size INTEGER, fpr_id INTEGER);
+    CREATE TABLE groups (id INTEGER PRIMARY KEY, fpr_id INTEGER, typ TEXT,
+                         size INTEGER, count INTEGER, waste INTEGER);
+    CREATE TABLE members (group_id INTEGER, path TEXT);
+    """
+
+INDEXES = """
+    CREATE UNIQUE INDEX fprs_fpr ON fprs (fpr);
+    CREATE UNIQUE INDEX files_path ON files (path);
+    CREATE INDEX files_fpr ON files (fpr_id);
+    CREATE INDEX files_size ON files (size);
+    CREATE UNIQUE INDEX dirs_path ON dirs (path);
+    CREATE INDEX dirs_fpr ON dirs (fpr_id);
+    CREATE INDEX dirs_size ON dirs (size);
+    CREATE INDEX groups_fpr ON groups (fpr_id);
+    CREATE INDEX groups_size ON groups (size);
+    CREATE INDEX groups_waste ON groups (waste);
+    CREATE INDEX members_group ON members (group_id);
+    CREATE INDEX members_path ON members (path);
+    """
+
+
+def _insert(conn, sql, rows):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        conn.executemany(sql, batch)
+
+
+def write(merkle_tree, filename):
+    """Write files, dirs and groups of `merkle_tree` to sqlite database
+    `filename` (replaced if it exists). Fprs must have been calculated
+    already (merkle_tree.calc_fprs()). Missing and unreadable files and
+    missing dirs (see calc.MISSING_FILE_FPR) are skipped.
+
+    Returns
+    -------
+    dict with the number of files, dirs and groups
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    tree = merkle_tree.tree
+    fpr_ids = {}
+
+    def fpr_id(fpr):
+        if fpr not in fpr_ids:
+            fpr_ids[fpr] = len(fpr_ids) + 1
+        return fpr_ids[fpr]
+
+    def elems(fprs, items, skip_fprs):
+        for path, fpr in fprs.items():
+            if fpr not in skip_fprs:
+                counts[items] += 1
+                yield path, getattr(tree, items)[path].filesize, fpr_id(fpr)
+
+    def groups():
+        for gid, (fpr, typ, paths) in enumerate(
+                main.iter_groups(merkle_tree), start=1):
+            dct = tree.nodes if typ.startswith('dir') else tree.leafs
+            size = dct[paths[0]].filesize
+            counts['groups'] += 1
+            members.extend((gid, path) for path in paths)
+            yield (gid, fpr_id(fpr), typ, size, len(paths),
+                   size * (len(paths) - 1))
+
+    counts = dict(leafs=0, nodes=0, groups=0)
+    members = []
+    conn = sqlite3.connect(filename)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(SCHEMA)
+        with conn:
+            _insert(conn, "INSERT INTO files VALUES (?,?,?)",
+                    elems(merkle_tree.leaf_fprs, 'leafs',
+                          (calc.MISSING_FILE_FPR, calc.UNREADABLE_FILE_FPR)))
+            _insert(conn, "INSERT INTO dirs VALUES (?,?,?)",
+                    elems(merkle_tree.node_fprs, 'nodes',
+                          (calc.MISSING_DIR_FPR,)))
+            _insert(conn, "INSERT INTO groups VALUES (?,?,?,?,?,?)",
+                    groups())
+            _insert(conn, "INSERT INTO members VALUES (?,?)", members)
+            _insert(conn, "INSERT INTO fprs VALUES (?,?)",
+                    ((ii, fpr) for fpr, ii in fpr_ids.items()))
+        conn.executescript(INDEXES)
+    finally:
+        conn.close()
+    return dict(files=counts['leafs'], dirs=counts['nodes'],
+                groups=counts['groups'])
@@ -0,0 +1,209 @@
+"""Snapshot files: a compact binary dump of a MerkleTree (fprs, sizes and
+paths of all files and dirs), and a diff between two snapshots.
+
+File format
+-----------
+
+::
+
+    MAGIC
+    header length (uint32, little endian)
+    header (json, utf-8)
+    record
+    record
+    ...
+
+The header holds the format version and all settings needed to decide
+whether two snapshots can be compared (fpr_key, see calc.fpr_key()), plus
+some bookkeeping (roots, number of records). Each record is
+
+::
+
+    kind (uint8, 0=file, 1=dir)
+    digest (binary fpr, header['digest_size'] bytes)
+    size (uint64, bytes, for dirs: sum of all files below)
+    path length (uint32)
+    path (os.fsencode()-ed)
+
+Records are sorted by (digest, kind, path). The tree structure is given by
+the paths (parent dir = os.path.dirname(path)). Since records are sorted by
+digest, diff() can merge two snapshots in one pass, holding only the records
+of one digest in memory.
+"""
+
+import itertools
+import json
+import os
+import struct
+import time
+from collections import namedtuple
+
+from findsame import calc
+
+
+MAGIC = b'findsame-snapshot\n'
+VERSION = 1
+KINDS = ['file', 'dir']
+
+Record = namedtuple('Record', ['kind', 'digest', 'size', 'path'])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _record_struct(digest_size):
+    return struct.Struct(f'<B{digest_size}sQI')
+
+
+def write(merkle_tree, filename, roots=None):
+    """Write snapshot of `merkle_tree` to `filename`. Fprs must have been
+    calculated already (merkle_tree.calc_fprs()). Missing files and dirs
+    and unreadable files (see calc.MISSING_FILE_FPR) are skipped.
+
+    Parameters
+    ----------
+    merkle_tree : calc.MerkleTree
+    filename : str
+    roots : seq of str, None
+        files and dirs the tree was built from, stored in the header
+    """
+    tree = merkle_tree.tree
+    cases = [(0, merkle_tree.leaf_fprs, tree.leafs,
+              (calc.MISSING_FILE_FPR, calc.UNREADABLE_FILE_FPR)),
+             (1, merkle_tree.node_fprs, tree.nodes, (calc.MISSING_DIR_FPR,))]
+    records = []
+    for kind, fprs, elems, skip_fprs in cases:
+        for path, fpr in fprs.items():
+            if fpr not in skip_fprs:
+                records.append((bytes.fromhex(fpr), kind, path,
+                                elems[path].filesize))
+    records.sort()
+    digest_size = calc.HASHFUNC().digest_size
+    cfg = merkle_tree.cfg
+    header = dict(version=VERSION,
+                  fpr_key=calc.fpr_key(cfg),
+                  hashfunc=calc.HASHFUNC().name,
+                  digest_size=digest_size,
+                  limit=cfg.limit,
+                  blocksize=cfg.blocksize,
+                  roots=list(roots) if roots is not None else None,
+                  nfiles=sum(1 for rec in records if rec[1] == 0),
+                  ndirs=sum(1 for rec in records if rec[1] == 1),
+                  created=time.time(),
+                  )
+    rec_struct = _record_struct(digest_size)
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(filename, 'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(struct.pack('<I', len(header_bytes)))
+        fd.write(header_bytes)
+        for digest, kind, path, size in records:
+            bpath = os.fsencode(path)
+            fd.write(rec_struct.pack(kind, digest, size, len(bpath)))
+            fd.write(bpath)
+
+
+def _read_header(fd):
+    if fd.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError(f"not a findsame snapshot: {fd.name}")
+    nn, = struct.unpack('<I', fd.read(4))
+    header = json.loads(fd.read(nn).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise SnapshotError(f"unsupported snapshot version "
+                            f"{header['version']}: {fd.name}")
+    return header
+
+
+def read_header(filename):
+    with open(filename, 'rb') as fd:
+        return _read_header(fd)
+
+
+def iter_records(filename):
+    """Yield all Records in `filename`, sorted by (digest, kind, path)."""
+    with open(filename, 'rb') as fd:
+        header = _read_header(fd)
+        rec_struct = _record_struct(header['digest_size'])
+        while True:
+            buf = fd.read(rec_struct.size)
+            if not buf:
+                break
+            kind, digest, size, nn = rec_struct.unpack(buf)
+            yield Record(kind=KINDS[kind],
+                         digest=digest,
+                         size=size,
+                         path=os.fsdecode(fd.read(nn)))
+
+
+def _iter_groups(filename):
+    """Yield ``((digest, kind), [record, ...])`` for all records of one digest
+    and kind."""
+    key = lambda rec: (rec.digest, KINDS.index(rec.kind))
+    for key, grp in itertools.groupby(iter_records(filename), key=key):
+        yield key, list(grp)
+
+
+def diff(filename_a, filename_b):
+    """Compare two snapshots A (old) and B (new), yield one event dict per
+    changed file or dir.
+
+    Events
+    ------
+    added : content (fpr) not in A, first path in B
+    removed : path in A, content not in B any more, or fewer copies in B
+    moved : path with content from A found at a new path in B, while an old
+        path of the same content is gone
+    duplicated : additional copy in B of content which exists in A or was
+        added in B
+
+    Unchanged paths (same fpr and path in A and B) are not reported. A file
+    whose content was changed shows up as removed (old fpr) + added (new fpr).
+
+    Both snapshots are read in one pass, memory usage only depends on the
+    number of paths with the same fpr.
+    """
+    header_a = read_header(filename_a)
+    header_b = read_header(filename_b)
+    if header_a['fpr_key'] != header_b['fpr_key']:
+        raise SnapshotError(f"snapshots have different hash settings: "
+                            f"{header_a['fpr_key']} != {header_b['fpr_key']}")
+    done = object()
+    groups_a = _iter_groups(filename_a)
+    groups_b = _iter_groups(filename_b)
+    ka, ra = next(groups_a, (done, None))
+    kb, rb = next(groups_b, (done, None))
+    while not (ka is done and kb is done):
+        if kb is done or (ka is not done and ka < kb):
+            yield from _diff_group(ra, [])
+            ka, ra = next(groups_a, (done, None))
+        elif ka is done or kb < ka:
+            yield from _diff_group([], rb)
+            kb, rb = next(groups_b, (done, None))
+        else:
+            yield from _diff_group(ra, rb)
+            ka, ra = next(groups_a, (done, None))
+            kb, rb = next(groups_b, (done, None))
+
+
+def _diff_group(recs_a, recs_b):
+    rec = (recs_a or recs_b)[0]
+    base = dict(kind=rec.kind, size=rec.size, fpr=rec.digest.hex())
+    paths_a = set(r.path for r in recs_a)
+    paths_b = set(r.path for r in recs_b)
+    old = sorted(paths_a - paths_b)
+    new = sorted(paths_b - paths_a)
+    if not paths_a:
+        yield dict(base, event='added', path=new[0])
+        for path in new[1:]:
+            yield dict(base, event='duplicated', path=path, of=new[0])
+        return
+    for src, dst in zip(old, new):
+        yield dict(base, event='moved', path=dst, **{'from': src})
+    if len(new) > len(old):
+        common = paths_a & paths_b
+        of = min(common) if common else new[0]
+        for path in new[len(old):]:
+            yield dict(base, event='duplicated', path=path, of=of)
+    for path in old[len(new):]:
+        yield dict(base, event='removed', path=path)
@@ -0,0 +1,269 @@
+"""Incremental rescans using the state of the previous run.
+
+Even with all leaf fprs cached, a rescan walks everything and stats every
+file. A state file (sqlite) keeps, from the last run,
+
+* the listing (regular files, sub-dirs) and mtime of each dir
+* size, mtime and fpr of each file
+* the fpr of each dir (node)
+
+In the next run, we stat each dir, but not the files in it, if its mtime is
+unchanged ("clean"): it is not listed again and its files are taken from
+the state. Only dirs whose mtime changed ("dirty") are listed again, their
+files are stat'ed and hashed if size or mtime changed (as with a FprCache).
+A node whose dir and all dirs below are clean gets its fpr from the state,
+so only dirty dirs and their parents get new node fprs.
+
+A dir's mtime changes when files in it are created, deleted or renamed,
+which is how most programs replace files, but not when a file is changed
+in-place (e.g. appended to). Such changes are not detected in clean dirs.
+Use a full scan now and then.
+
+The state is valid only for the same fpr settings and filters, else it is
+discarded and we do a full scan.
+"""
+
+import json
+import os
+import sqlite3
+
+from findsame import calc, main
+from findsame import common as co
+from findsame.cache import FprCache
+from findsame.filters import PathFilter
+
+# settings in cfg which change what is in the state
+CFG_KEYS = ['exclude', 'include', 'min_size', 'max_size']
+
+
+def state_config(cfg):
+    dct = dict((kk, cfg[kk]) for kk in CFG_KEYS)
+    dct.update(fpr_key=calc.fpr_key(cfg))
+    return dct
+
+
+class StateLeaf(calc.Leaf):
+    """File in a clean dir, size and mtime are known from the state, no
+    stat."""
+    def __init__(self, path, filesize, mtime_ns):
+        calc.Element.__init__(self, path=path)
+        self.kind = 'leaf'
+        self.fpr_func = None
+        self.filesize = filesize
+        self.mtime_ns = mtime_ns
+
+
+class State(FprCache):
+    """
+    Parameters
+    ----------
+    filename : str
+        sqlite file, created if it doesn't exist
+    cfg : config.Config instance
+    """
+    def __init__(self, filename, cfg):
+        super().__init__()
+        self.filename = filename
+        self.cfg = cfg
+        self.key = calc.fpr_key(cfg)
+        self.config = state_config(cfg)
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY,
+                                             value TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY,
+                                             mtime_ns INTEGER,
+                                             dirs TEXT,
+                                             files TEXT,
+                                             fpr TEXT);
+            CREATE TABLE IF NOT EXISTS leafs (path TEXT PRIMARY KEY,
+                                              size INTEGER,
+                                              mtime_ns INTEGER,
+                                              fpr TEXT);
+            """)
+        row = self._conn.execute("SELECT value FROM meta WHERE "
+                                 "key='config'").fetchone()
+        if row is not None and json.loads(row[0]) != self.config:
+            co.debug_msg(f"state: config changed, discard {filename}")
+            self._conn.executescript("DELETE FROM dirs; DELETE FROM leafs;")
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?,?)",
+                           ('config', json.dumps(self.config)))
+        self._conn.commit()
+        # dir path -> (mtime_ns, dirs, files, fpr)
+        self._dirs = {}
+        for path, mtime_ns, dirs, files, fpr in self._conn.execute(
+                "SELECT path, mtime_ns, dirs, files, fpr FROM dirs"):
+            self._dirs[path] = (mtime_ns, _split(dirs), _split(files), fpr)
+        for path, size, mtime_ns, fpr in self._conn.execute(
+                "SELECT path, size, mtime_ns, fpr FROM leafs"):
+            self._data[path] = (size, mtime_ns, {self.key: fpr})
+        self._pending_leafs = []
+        # dirs listed in this run: path -> (mtime_ns, dirs, files)
+        self._listed = {}
+        self._visited = set()
+        self._clean = set()
+        self.stats = dict(dirs=0, dirs_listed=0, files_stat=0)
+
+    def set(self, leaf, key, fpr):
+        super().set(leaf, key, fpr)
+        if key == self.key:
+            self._pending_leafs.append((leaf.path, leaf.filesize,
+                                        leaf.mtime_ns, fpr))
+
+    def _list(self, root):
+        dirs, files = [], []
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry.name)
+                except OSError:
+                    continue
+        return dirs, files
+
+    def build_tree(self, top, filt=None):
+        """calc.FileDirTree of dir `top`, listing only dirty dirs and
+        stat'ing only files in there. Nodes whose subtree is clean get
+        their fpr from the state."""
+        tree = calc.FileDirTree(files=[])
+        order = []
+        stack = [top.rstrip('/') or '/']
+        while stack:
+            root = stack.pop()
+            try:
+                mtime_ns = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            self.stats['dirs'] += 1
+            entry = self._dirs.get(root)
+            clean = entry is not None and entry[0] == mtime_ns
+            if clean:
+                dirs, files = entry[1], entry[2]
+                self._clean.add(root)
+            else:
+                try:
+                    dirs, files = self._list(root)
+                except OSError:
+                    continue
+                self.stats['dirs_listed'] += 1
+                self._listed[root] = (mtime_ns, dirs, files)
+            self._visited.add(root)
+            node = calc.Node(path=root, childs=[])
+            for name in files:
+                fn = os.path.join(root, name)
+                if filt is not None and filt.skip_file(fn):
+                    continue
+                cached = self._data.get(fn) if clean else None
+                if cached is not None:
+                    leaf = StateLeaf(fn, cached[0], cached[1])
+                else:
+                    try:
+                        leaf = calc.Leaf(path=fn)
+                    except OSError:
+                        continue
+                    self.stats['files_stat'] += 1
+                if filt is not None and filt.skip_size(leaf.filesize):
+                    continue
+                node.add_child(leaf)
+                tree.leafs[fn] = leaf
+            tree.nodes[root] = node
+            parent = tree.nodes.get(os.path.dirname(root))
+            if parent is not None:
+                parent.add_child(node)
+            order.append(node)
+            for name in reversed(dirs):
+                path = os.path.join(root, name)
+                if filt is None or not filt.skip_dir(path):
+                    stack.append(path)
+        # childs before parents
+        clean_below = {}
+        for node in reversed(order):
+            fpr = self._dirs.get(node.path, (None,)*4)[3]
+            # all files from the state, all sub-dirs clean
+            clean_below[node.path] = \
+                node.path in self._clean and fpr is not None and \
+                all(clean_below[cc.path] if cc.kind == 'node' else
+                    isinstance(cc, StateLeaf) for cc in node.childs)
+            if clean_below[node.path]:
+                node.fpr = fpr
+        co.debug_msg(f"state: {top}: {self.stats}")
+        return tree
+
+    def get_merkle_tree(self, files_dirs, pool=None):
+        """Same as main.get_merkle_tree() (w/o pipeline), use the state for
+        all dirs in `files_dirs`."""
+        files, dirs = main.split_files_dirs(files_dirs)
+        filt = PathFilter.from_cfg(self.cfg)
+        filt = filt if filt.active else None
+        tree = calc.FileDirTree(files=files, filt=filt)
+        for dr in dirs:
+            tree.update(self.build_tree(dr, filt=filt))
+        return calc.MerkleTree(tree, cfg=self.cfg, cache=self, pool=pool)
+
+    def save(self, merkle_tree):
+        """Write new listings, leaf fprs and all node fprs of `merkle_tree`
+        (fprs must have been calculated) and remove dirs which are gone."""
+        node_fprs = merkle_tree.node_fprs
+        rows = []
+        for path in self._visited:
+            fpr = node_fprs.get(path)
+            if path in self._listed:
+                mtime_ns, dirs, files = self._listed[path]
+            elif fpr != self._dirs[path][3]:
+                mtime_ns, dirs, files = self._dirs[path][:3]
+            else:
+                continue
+            rows.append((path, mtime_ns, _join(dirs), _join(files), fpr))
+        gone = []
+        for path in self._listed:
+            # dirs below a re-listed dir which are not there any more
+            old = self._dirs.get(path)
+            if old is not None:
+                gone += [os.path.join(path, name) for name in
+                         set(old[1]) - set(self._listed[path][1])]
+        gone_files = [os.path.join(path, name)
+                      for path, (_, _, files) in self._listed.items()
+                      if path in self._dirs
+                      for name in set(self._dirs[path][2]) - set(files)]
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO dirs "
+                                   "VALUES (?,?,?,?,?)", rows)
+            self._conn.executemany("INSERT OR REPLACE INTO leafs "
+                                   "VALUES (?,?,?,?)", self._pending_leafs)
+            for path in gone:
+                self._conn.execute("DELETE FROM dirs WHERE path=? OR "
+                                   "path LIKE ? ESCAPE '\\'",
+                                   (path, _like_prefix(path)))
+                self._conn.execute("DELETE FROM leafs WHERE "
+                                   "path LIKE ? ESCAPE '\\'",
+                                   (_like_prefix(path),))
+            self._conn.executemany("DELETE FROM leafs WHERE path=?",
+                                   [(path,) for path in gone_files])
+        self._pending_leafs = []
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _like_prefix(path):
+    """LIKE pattern for everything below dir `path`."""
+    esc = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return esc + '/%'
+
+
+def _join(names):
+    return '\0'.join(names)
+
+
+def _split(st):
+    return st.split('\0') if st else []
@@ -1,3 +1,4 @@
+import copy
 import hashlib
 import json
 import os
@@ -5,8 +6,10 @@ import random
 import subprocess
 import sys
 import tempfile
+import time
 import shutil
 import pathlib
+import pytest
 import difflib
 
 from findsame import calc, main
@@ -361,3 +364,1240 @@ def test_missing():
         s_missing = set(missing_dirs + missing_files)
         s_paths = set(co.flatten(lst))
         assert s_missing not in s_paths
+
+
+def test_engine():
+    from findsame.engine import Engine
+    from findsame.config import default_cfg
+    cfg_before = dict(cfg)
+    with TstDataTmpdir() as ctx:
+        ref_fn = f'{here}/ref_output_o3.json'
+        with open(ref_fn) as fd:
+            ref = json.load(fd)
+        for nn in [1,2]:
+            os.mkdir(f"{ctx.datadir}/empty_dir_{nn}")
+        for kwds in [{}, dict(nthreads=2), dict(nprocs=2, nthreads=2)]:
+            with Engine(outmode=3, **kwds) as engine:
+                # relative paths, as in the reference output
+                cwd = os.getcwd()
+                os.chdir(ctx.tmpdir)
+                try:
+                    val = json.loads(json.dumps(engine.scan(['data'])))
+                    assert cmp_o3(val, ref)
+                    ncache = len(engine.cache)
+                    assert ncache > 0
+                    # 2nd scan: all leafs from cache, same pool
+                    pool = engine.pool
+                    val = json.loads(json.dumps(engine.scan(['data'])))
+                    assert cmp_o3(val, ref)
+                    assert engine.pool is pool
+                    assert len(engine.cache) == ncache
+                    groups = list(engine.iter_scan(['data']))
+                    assert set(typ for _,typ,_ in groups) == set(ref.keys())
+                finally:
+                    os.chdir(cwd)
+        # config of one Engine doesn't leak into another or into the global
+        # one
+        e1 = Engine(limit=128*1024, blocksize=512*1024)
+        e2 = Engine()
+        assert e1.cfg.blocksize == 128*1024
+        assert e2.cfg.blocksize == default_cfg.blocksize
+        assert e2.cfg.limit is None
+        assert dict(cfg) == cfg_before
+        # debug output is process-wide, not an Engine setting
+        assert 'verbose' not in e2.cfg
+        with pytest.raises(ValueError):
+            Engine(verbose=True)
+
+
+def test_snapshot_diff():
+    from findsame import snapshot
+    with TstDataTmpdir() as ctx:
+        snap_a = f"{ctx.tmpdir}/a.snap"
+        snap_b = f"{ctx.tmpdir}/b.snap"
+        exe = f'{here}/../../bin/findsame'
+        subprocess.check_output(f'cd {ctx.tmpdir} && {exe} --snapshot {snap_a} data',
+                                shell=True)
+        mt = main.get_merkle_tree([ctx.datadir])
+        mt.calc_fprs()
+        recs = list(snapshot.iter_records(snap_a))
+        assert [r.digest for r in recs] == sorted(r.digest for r in recs)
+        header = snapshot.read_header(snap_a)
+        assert header['nfiles'] == len(mt.leaf_fprs)
+        assert header['ndirs'] == len(mt.node_fprs)
+        sizes = dict((r.path, r.size) for r in recs if r.kind == 'dir')
+        assert sizes['data/dir1'] == sum(os.path.getsize(f"{ctx.datadir}/dir1/{x}")
+                                         for x in os.listdir(f"{ctx.datadir}/dir1"))
+
+        # no changes
+        assert list(snapshot.diff(snap_a, snap_a)) == []
+
+        d = ctx.datadir
+        shutil.move(f"{d}/file1", f"{d}/file1_moved")
+        shutil.copy(f"{d}/lena.png", f"{d}/lena_copy2.png")
+        os.remove(f"{d}/file2")
+        with open(f"{d}/new_file", 'w') as fd:
+            fd.write('new content')
+        subprocess.check_output(f'cd {ctx.tmpdir} && {exe} --snapshot {snap_b} data',
+                                shell=True)
+        events = list(snapshot.diff(snap_a, snap_b))
+        files = [(e['event'], e['path']) for e in events if e['kind'] == 'file']
+        assert ('moved', 'data/file1_moved') in files
+        assert ('duplicated', 'data/lena_copy2.png') in files
+        assert ('removed', 'data/file2') in files
+        assert ('added', 'data/new_file') in files
+        assert len(files) == 4
+        # dir "data" changed, the rest is the same
+        dirs = [(e['event'], e['path']) for e in events if e['kind'] == 'dir']
+        assert sorted(dirs) == [('added', 'data'), ('removed', 'data')]
+
+        out = subprocess.check_output(f'{exe} diff -s {snap_a} {snap_b}',
+                                      shell=True)
+        assert json.loads(out.decode()) == {'moved:file': 1,
+                                            'duplicated:file': 1,
+                                            'removed:file': 1,
+                                            'added:file': 1,
+                                            'removed:dir': 1,
+                                            'added:dir': 1}
+
+
+def test_index():
+    from findsame.engine import Engine
+    from findsame import index
+    with TstDataTmpdir() as ctx:
+        idx_fn = f"{ctx.tmpdir}/archive.idx"
+        exe = f'{here}/../../bin/findsame'
+        subprocess.check_output(f'cd {ctx.tmpdir} && {exe} index build '
+                                f'-i {idx_fn} data/dir1 data/lena.png',
+                                shell=True)
+        with index.Index(idx_fn) as idx:
+            assert idx.header['nrecords'] == 4
+            assert idx.has_size(os.path.getsize(f"{ctx.datadir}/lena.png"))
+            assert not idx.has_size(123456789)
+
+        newdir = f"{ctx.tmpdir}/new"
+        os.mkdir(newdir)
+        shutil.copy(f"{ctx.datadir}/lena.png", f"{newdir}/lena_new.png")
+        shutil.copy(f"{ctx.datadir}/file2", f"{newdir}/file2")
+        with open(f"{newdir}/other", 'w') as fd:
+            fd.write('not in there')
+        with Engine(nthreads=2) as engine:
+            engine.open_index(idx_fn)
+            res = dict(engine.query([newdir]))
+            assert res[f"{newdir}/lena_new.png"] == ['data/lena.png']
+            assert res[f"{newdir}/file2"] == ['data/dir1/file2',
+                                              'data/dir1/file2_copy']
+            assert res[f"{newdir}/other"] == []
+            # size doesn't match, so not hashed and not in the cache
+            assert f"{newdir}/other" not in engine.cache
+            assert f"{newdir}/file2" in engine.cache
+
+        out = subprocess.check_output(f'{exe} index query -i {idx_fn} {newdir}',
+                                      shell=True).decode()
+        res = dict((dd['path'], dd['matches'])
+                   for dd in map(json.loads, out.splitlines()))
+        assert res[f"{newdir}/lena_new.png"] == ['data/lena.png']
+
+        # hash settings are taken from the index
+        subprocess.check_output(f'cd {ctx.tmpdir} && {exe} index build '
+                                f'--sparse -i {idx_fn} data/dir1 '
+                                f'data/lena.png', shell=True)
+        with index.Index(idx_fn) as idx:
+            assert idx.header['sparse']
+            assert idx.cfg().sparse
+        out = subprocess.check_output(f'{exe} index query -i {idx_fn} {newdir}',
+                                      shell=True).decode()
+        res = dict((dd['path'], dd['matches'])
+                   for dd in map(json.loads, out.splitlines()))
+        assert res[f"{newdir}/lena_new.png"] == ['data/lena.png']
+
+
+def test_chunks():
+    from findsame import chunk
+    rnd = random.Random(42)
+    data = bytes(rnd.getrandbits(8) for _ in range(150000))
+    params = chunk.ChunkParams(avg_size=1024)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn_a = f"{tmpdir}/a"
+        fn_b = f"{tmpdir}/b"
+        with open(fn_a, 'wb') as fd:
+            fd.write(data)
+        # insert some bytes in the middle, only chunks around it change
+        with open(fn_b, 'wb') as fd:
+            fd.write(data[:70000] + b'inserted' + data[70000:])
+        chunks_a = chunk.chunk_file(fn_a, avg_size=1024, use_numpy=False)
+        assert sum(ll for _,ll in chunks_a) == len(data)
+        assert all(params.min_size <= ll <= params.max_size
+                   for _,ll in chunks_a[:-1])
+        assert 0.5*len(data)/1024 < len(chunks_a) < 2*len(data)/1024
+        if chunk.np is not None:
+            assert chunk.chunk_file(fn_a, avg_size=1024, use_numpy=True) == chunks_a
+        chunks_b = chunk.chunk_file(fn_b, avg_size=1024, use_numpy=False)
+        shared = set(chunks_a) & set(chunks_b)
+        assert len(shared) >= len(chunks_a) - 3
+
+        res = chunk.analyze([fn_a, fn_b, tmpdir], avg_size=1024)
+        pair, = res['pairs']
+        assert pair['files'] == [fn_a, fn_b]
+        assert pair['shared_bytes'] == sum(ll for _,ll in shared)
+        assert res['trees'][fn_a]['dedup_ratio'] == 1.0
+        tree = res['trees'][tmpdir]
+        assert tree['files'] == 2
+        assert tree['total_bytes'] == 2*len(data) + 8
+        assert tree['total_bytes'] / tree['unique_bytes'] > 1.8
+
+        # chunks in more than max_fanout files don't count in pairs
+        fn_c = f"{tmpdir}/c"
+        shutil.copy(fn_a, fn_c)
+        res = chunk.analyze([tmpdir], avg_size=1024)
+        assert len(res['pairs']) == 3
+        res = chunk.analyze([tmpdir], avg_size=1024, max_fanout=2)
+        pair, = res['pairs']
+        assert pair['files'] == [fn_a, fn_c]
+        assert pair['shared_bytes'] == \
+            sum(ll for dd, ll in set(chunks_a) - shared)
+
+
+def test_act():
+    from findsame import action
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        exe = f'{here}/../../bin/findsame'
+        result_fn = f"{ctx.tmpdir}/result.json"
+        subprocess.check_output(f'{exe} -o1 {d} > {result_fn}', shell=True)
+        with open(result_fn) as fd:
+            result = json.load(fd)
+        groups = list(action.iter_dup_groups(result))
+        assert len(groups) > 0
+        dups = [dup for _, dups in groups for dup in dups]
+        content = dict((pp, open(pp, 'rb').read()) for pp in dups)
+
+        # interrupted run: one duplicate was renamed to the temp file, but
+        # the link was not made yet
+        journal = f"{ctx.tmpdir}/journal"
+        keeper, (dup, *_) = groups[0]
+        jrnl = action.Journal(journal)
+        jrnl.write(step='start', action='hardlink')
+        st = os.stat(dup)
+        jrnl.write(step='backup', path=dup, keeper=keeper,
+                   tmp=dup + action.TMP_SUFFIX, mode=st.st_mode,
+                   mtime_ns=st.st_mtime_ns, size=st.st_size)
+        jrnl.close()
+        os.rename(dup, dup + action.TMP_SUFFIX)
+
+        out = subprocess.check_output(f'{exe} act hardlink -r -j {journal} '
+                                      f'{result_fn}', shell=True)
+        assert json.loads(out.decode()) == {'done': len(dups)}
+        for keeper, dups_ in groups:
+            for pp in dups_:
+                assert os.path.samefile(keeper, pp)
+                assert not os.path.exists(pp + action.TMP_SUFFIX)
+
+        # again: journal exists
+        with pytest.raises(action.ActionError):
+            action.Deduper('hardlink', journal).run(result)
+
+        subprocess.check_output(f'{exe} act rollback -j {journal}', shell=True)
+        for keeper, dups_ in groups:
+            for pp in dups_:
+                assert open(pp, 'rb').read() == content[pp]
+                assert not os.path.samefile(keeper, pp)
+
+        # delete, with one file changed after the scan
+        os.remove(journal)
+        changed = groups[-1][1][0]
+        with open(changed, 'ab') as fd:
+            fd.write(b'x')
+        deduper = action.Deduper('delete', journal, nthreads=2,
+                                 result_mtime=os.path.getmtime(result_fn))
+        counts = deduper.run(result)
+        assert counts == {'done': len(dups) - 1, 'skip': 1}
+        for pp in dups:
+            assert os.path.exists(pp) == (pp == changed)
+        # deleted files are restored as copies of the keeper
+        assert action.rollback(journal) == {'copied': len(dups) - 1}
+        for pp in dups:
+            if pp != changed:
+                assert open(pp, 'rb').read() == content[pp]
+
+        # existing temp file (e.g. a user's file) is not overwritten
+        os.remove(journal)
+        dup = [pp for pp in dups if pp != changed][0]
+        with open(dup + action.TMP_SUFFIX, 'wb') as fd:
+            fd.write(b'user data')
+        counts = action.Deduper('delete', journal).run(result)
+        assert counts == {'done': len(dups) - 2, 'skip': 2}
+        assert open(dup, 'rb').read() == content[dup]
+        assert open(dup + action.TMP_SUFFIX, 'rb').read() == b'user data'
+
+    # files with the same first bytes are the same with --limit, content is
+    # compared by default
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, data in [('a', b'x' * 5000), ('b', b'x' * 4999 + b'y'),
+                           ('c', b'x' * 5000)]:
+            with open(pj(tmpdir, name), 'wb') as fd:
+                fd.write(data)
+        exe = f'{here}/../../bin/findsame'
+        result_fn = pj(tmpdir, 'result.json')
+        subprocess.check_output(f'{exe} -l 1K -o1 {tmpdir}/a {tmpdir}/b '
+                                f'{tmpdir}/c > {result_fn}', shell=True)
+        with open(result_fn) as fd:
+            assert sorted(json.load(fd)[0]['file']) == \
+                [pj(tmpdir, name) for name in 'abc']
+        # result from stdin: files modified after act started are skipped
+        os.utime(pj(tmpdir, 'c'), (time.time() + 100,) * 2)
+        out = subprocess.check_output(f'{exe} act delete -j '
+                                      f'{tmpdir}/journal - < {result_fn}',
+                                      shell=True)
+        assert json.loads(out.decode()) == {'skip': 2}
+        assert sorted(os.listdir(tmpdir)) == \
+            ['a', 'b', 'c', 'journal', 'result.json']
+        with open(pj(tmpdir, 'journal')) as fd:
+            reasons = sorted(json.loads(ll).get('reason', '') for ll in fd)
+        assert reasons[-2:] == ['content differs', 'modified after scan']
+
+
+def test_filters():
+    from findsame import Engine
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, git in [('a', 'A'), ('b', 'B')]:
+            os.makedirs(f"{tmpdir}/{name}/src")
+            os.makedirs(f"{tmpdir}/{name}/.git")
+            with open(f"{tmpdir}/{name}/src/x.py", 'w') as fd:
+                fd.write('x = 1\n')
+            with open(f"{tmpdir}/{name}/src/data.bin", 'wb') as fd:
+                fd.write(b'\0' * 2000)
+            with open(f"{tmpdir}/{name}/.git/obj", 'w') as fd:
+                fd.write(git)
+        adir, bdir = f"{tmpdir}/a", f"{tmpdir}/b"
+
+        def tree(**kwds):
+            with Engine(**kwds) as engine:
+                mt = engine.merkle_tree([tmpdir])
+                mt.calc_fprs()
+            return mt
+
+        mt = tree()
+        assert mt.node_fprs[adir] != mt.node_fprs[bdir]
+        assert f"{adir}/.git" in mt.tree.nodes
+
+        for exclude in [['.git'], ['*/.git'], ['re:/\\.git$']]:
+            mt = tree(exclude=exclude)
+            assert mt.node_fprs[adir] == mt.node_fprs[bdir]
+            # pruned from the walk
+            assert not any('.git' in pp for pp in mt.tree.nodes)
+            assert not any('.git' in pp for pp in mt.tree.leafs)
+            assert len(mt.tree.leafs) == 4
+
+        mt = tree(include=['*.py'])
+        assert sorted(mt.tree.leafs) == [f"{adir}/src/x.py", f"{bdir}/src/x.py"]
+        # .git dirs are walked, but have no files left, so they look empty
+        assert mt.node_fprs[f"{adir}/.git"] == calc.EMPTY_DIR_FPR
+        assert mt.tree.nodes[adir].filesize == 6
+
+        mt = tree(min_size=1000)
+        assert sorted(mt.tree.leafs) == [f"{adir}/src/data.bin",
+                                         f"{bdir}/src/data.bin"]
+        mt = tree(max_size=10)
+        assert len(mt.tree.leafs) == 4
+        mt = tree(min_size=2, max_size=1000)
+        assert len(mt.tree.leafs) == 2
+
+        exe = f'{here}/../../bin/findsame'
+        out = subprocess.check_output(f'{exe} --exclude .git --exclude '
+                                      f'"*.bin" {tmpdir}', shell=True)
+        assert [adir, bdir] in json.loads(out.decode())['dir']
+
+
+@pytest.mark.parametrize('nprocs,nthreads', [(1,1), (1,3), (2,1), (2,2)])
+def test_pipeline(nprocs, nthreads):
+    from findsame import Engine
+    from findsame.pipeline import PipelineMerkleTree
+    with TstDataTmpdir() as ctx:
+        files_dirs = [ctx.datadir, pj(ctx.datadir, 'dir1')]
+        with Engine(nprocs=nprocs, nthreads=nthreads) as engine:
+            ref = engine.merkle_tree(files_dirs)
+            ref.calc_fprs()
+        kwds = dict(nprocs=nprocs, nthreads=nthreads, pipeline=True)
+        with Engine(**kwds) as engine:
+            mt = engine.merkle_tree(files_dirs)
+            assert isinstance(mt, PipelineMerkleTree)
+            mt.max_pending = 2
+            mt.calc_fprs()
+            assert mt.leaf_fprs == ref.leaf_fprs
+            assert mt.node_fprs == ref.node_fprs
+            assert set(mt.tree.nodes) == set(ref.tree.nodes)
+            # again, all leafs from cache
+            mt = engine.merkle_tree(files_dirs)
+            mt.calc_fprs()
+            assert mt.leaf_fprs == ref.leaf_fprs
+            assert mt.node_fprs == ref.node_fprs
+            assert cmp_o3(engine.scan(files_dirs),
+                          main.assemble_result(ref))
+
+        # tree used before calc_fprs(): plain walk
+        with Engine(**kwds) as engine:
+            mt = engine.merkle_tree(files_dirs)
+            assert set(mt.tree.leafs) == set(ref.tree.leafs)
+            mt.calc_fprs()
+            assert mt.node_fprs == ref.node_fprs
+
+        # files at different depths below the same dir: no pipeline, same
+        # result
+        files = [pj(ctx.datadir, 'dir1/file2'),
+                 pj(ctx.datadir, 'dir1/file3'),
+                 pj(ctx.datadir, 'dir3/deep/but/only/one/file')]
+        with Engine(nprocs=nprocs, nthreads=nthreads) as engine:
+            ref = engine.merkle_tree(files)
+            ref.calc_fprs()
+        with Engine(**kwds) as engine:
+            mt = engine.merkle_tree(files)
+            assert not isinstance(mt, PipelineMerkleTree)
+            mt.calc_fprs()
+            assert mt.node_fprs == ref.node_fprs
+        if (nprocs, nthreads) == (1, 1):
+            os.makedirs(pj(ctx.tmpdir, 'a/x'))
+            for name in ['a/f0', 'a/x/f2']:
+                with open(pj(ctx.tmpdir, name), 'wb') as fd:
+                    fd.write(os.urandom(100))
+            exe = f'{here}/../../bin/findsame'
+            out = subprocess.check_output([exe, '--pipeline', 'a/f0',
+                                           'a/x/f2'], cwd=ctx.tmpdir)
+            assert json.loads(out.decode()) == {}
+
+
+def test_cli_imports():
+    # starting the CLI must not import modules which only some code paths
+    # need, see benchmark/importtime
+    code = "import sys, findsame.cli; print(' '.join(sys.modules))"
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  env=dict(os.environ,
+                                           PYTHONPATH=pj(here, '../..')))
+    modules = out.decode().split()
+    for name in ['multiprocessing', 'concurrent.futures.process',
+                 'concurrent.futures.thread', 'numpy', 'matplotlib',
+                 'findsame.engine']:
+        assert name not in modules, name
+    from findsame import Engine
+    assert Engine.__module__ == 'findsame.engine'
+
+
+def test_analyze():
+    np = pytest.importorskip('numpy')
+    from findsame import analyze
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        mt = main.get_merkle_tree([d])
+        ref = sorted(leaf.filesize for leaf in mt.tree.leafs.values())
+        for nthreads in [1, 3]:
+            sizes = analyze.collect_file_sizes([d], nthreads=nthreads)
+            assert sizes.dtype == np.int64
+            assert sorted(sizes.tolist()) == ref
+
+        smry = analyze.summary(sizes)
+        assert smry['nfiles'] == len(ref)
+        assert smry['total_size'] == sum(ref)
+        assert sum(cc['nfiles'] for cc in smry['classes']) == len(ref)
+        assert np.isclose(sum(cc['size_share'] for cc in smry['classes']), 1)
+        # empty files are in the first class
+        assert smry['classes'][0]['nfiles'] == ref.count(0)
+        counts = dict((ss, ref.count(ss)) for ss in set(ref))
+        assert smry['same_size_groups'] == \
+            sum(1 for cc in counts.values() if cc > 1)
+        assert smry['same_size_files'] == \
+            sum(cc for cc in counts.values() if cc > 1)
+
+        # cache in DataDir
+        cache_dir = pj(ctx.tmpdir, 'cache')
+        dd = analyze.DataDir(d, tmpdir=cache_dir)
+        assert sorted(dd.sizes.tolist()) == ref
+        with open(pj(d, 'dir1', 'new_file'), 'w') as fd:
+            fd.write('12345')
+        # only one dir's mtime changed -> cache invalid
+        dd = analyze.DataDir(d, tmpdir=cache_dir)
+        assert sorted(dd.sizes.tolist()) == sorted(ref + [5])
+        dd = analyze.DataDir(d, tmpdir=cache_dir)
+        assert len(dd.sizes) == len(ref) + 1
+
+
+def test_checkpoint():
+    from findsame import checkpoint
+    from findsame.config import Config, default_cfg
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        fn = pj(ctx.tmpdir, 'ckp.sqlite')
+        cfg = Config(copy.deepcopy(default_cfg))
+
+        # interval=0: write on each set()
+        ckp = checkpoint.Checkpoint(fn, cfg, [d], interval=0)
+        mt = main.get_merkle_tree([d], cfg=cfg, cache=ckp, walk=ckp.walk)
+        assert set(mt.tree.leafs) == set(main.get_merkle_tree([d]).tree.leafs)
+        assert set(mt.tree.nodes) == set(main.get_merkle_tree([d]).tree.nodes)
+        # simulate a kill after half the leafs
+        leafs = list(mt.tree.leafs.values())
+        mt.calc_leaf_fprs(leafs=leafs[:len(leafs)//2])
+        ckp._conn.close()
+        ckp._conn = None
+
+        with pytest.raises(checkpoint.CheckpointError):
+            checkpoint.Checkpoint(fn, cfg, [d])
+        cfg_other = Config(cfg, limit=4096)
+        with pytest.raises(checkpoint.CheckpointError):
+            checkpoint.Checkpoint(fn, cfg_other, [d], resume=True)
+
+        # one file changed since
+        changed = leafs[0].path
+        with open(changed, 'a') as fd:
+            fd.write('x')
+        ckp = checkpoint.Checkpoint(fn, cfg, [d], resume=True)
+        assert len(ckp) == len(leafs)//2
+        assert set(ckp._dirs) == set(mt.tree.nodes)
+        mt = main.get_merkle_tree([d], cfg=cfg, cache=ckp, walk=ckp.walk)
+        assert ckp.get(mt.tree.leafs[changed], ckp.key) is None
+        assert cmp_o3(main.assemble_result(mt), main.main([d], cfg=cfg))
+        ckp.close(complete=True)
+        assert checkpoint.Checkpoint(fn, cfg, [d], resume=True).meta()['complete']
+
+        # CLI
+        exe = f'{here}/../../bin/findsame'
+        fn = pj(ctx.tmpdir, 'ckp2.sqlite')
+        for opt in ['', '--resume']:
+            out = subprocess.check_output(f'{exe} --checkpoint {fn} {opt} {d}',
+                                          shell=True)
+            assert cmp_o3(json.loads(out.decode()), main.main([d], cfg=cfg))
+
+
+@pytest.mark.parametrize('nprocs,nthreads', [(1,4), (2,1)])
+def test_throttle(nprocs, nthreads):
+    import time
+    from findsame import Engine, throttle
+    with tempfile.TemporaryDirectory() as tmpdir:
+        nfiles = 8
+        for ii in range(nfiles):
+            with open(pj(tmpdir, f'file_{ii}'), 'wb') as fd:
+                fd.write(os.urandom(64*1024))
+        rate = 1024*1024
+        thr = throttle.Throttle(max_bytes_per_sec=rate,
+                                max_opens_per_sec=100)
+        throttle.install(thr)
+        try:
+            with Engine(nprocs=nprocs, nthreads=nthreads,
+                        blocksize=16*1024) as engine:
+                t0 = time.monotonic()
+                engine.scan([tmpdir])
+                elapsed = time.monotonic() - t0
+        finally:
+            throttle.install(None)
+        rep = thr.report()
+        # all processes and threads account in the same shared state
+        assert rep['opens'] == nfiles
+        assert rep['bytes'] == nfiles*64*1024
+        # 512K at 1M/s, minus the initial burst
+        assert elapsed > 0.5 - throttle.BURST_SEC - 0.05
+        assert rep['bytes_per_sec'] < 1.3 * rate
+
+    with pytest.raises(ValueError):
+        throttle.Throttle(adaptive=True)
+    thr = throttle.Throttle(max_bytes_per_sec=1e9, adaptive=True)
+    for _ in range(50):
+        thr.read(100, 0.001)
+    assert thr.report()['rate_factor'] == 1
+    # latency jumps: back off, once per cooldown
+    for _ in range(3):
+        thr.read(100, 0.1)
+        time.sleep(throttle.ADAPT_COOLDOWN)
+    assert thr.report()['rate_factor'] < 0.6
+    for _ in range(200):
+        thr.read(100, 0.001)
+    assert thr.report()['rate_factor'] == 1
+    assert thr.report()['min_rate_factor'] < 0.6
+
+
+def test_waste():
+    from findsame import Engine, waste
+    from findsame.config import Config, default_cfg
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # (size, number of copies): waste = size * (copies - 1)
+        spec = [(1000, 2), (300, 5), (10, 3), (50, 1)]
+        for size, ncopies in spec:
+            data = os.urandom(size)
+            for ii in range(ncopies):
+                with open(pj(tmpdir, f'file_{size}_{ii}'), 'wb') as fd:
+                    fd.write(data)
+        # same size as a dup group, different content: candidate, no dup
+        with open(pj(tmpdir, 'other_1000'), 'wb') as fd:
+            fd.write(os.urandom(1000))
+        with open(pj(tmpdir, 'empty_1'), 'wb'), \
+                open(pj(tmpdir, 'empty_2'), 'wb'):
+            pass
+
+        groups = list(waste.iter_waste([tmpdir]))
+        assert [(gg['size'], gg['count'], gg['waste']) for gg in groups] == \
+            [(300, 5, 1200), (1000, 2, 1000), (10, 3, 20)]
+        assert groups[1]['paths'] == [pj(tmpdir, 'file_1000_0'),
+                                      pj(tmpdir, 'file_1000_1')]
+
+        # same groups as a full scan
+        ref = main.main([tmpdir], cfg=Config(copy.deepcopy(default_cfg)))
+        assert sorted(sorted(pp) for pp in ref['file']) == \
+            sorted(gg['paths'] for gg in groups)
+
+        assert [gg['size'] for gg in waste.iter_waste([tmpdir], top=1)] \
+            == [300]
+        assert [gg['size'] for gg in waste.iter_waste([tmpdir],
+                                                      target=1500)] \
+            == [300, 1000]
+        # stop after the first batch
+        part = list(waste.iter_waste([tmpdir], budget=0))
+        assert 0 < len(part) < len(groups)
+        assert part == groups[:len(part)]
+
+        with Engine(nthreads=3) as engine:
+            assert list(engine.iter_waste([tmpdir])) == groups
+
+        out = subprocess.run([sys.executable, '-m', 'findsame.cli', 'waste',
+                              '-n', '2', tmpdir],
+                             capture_output=True, text=True, check=True,
+                             env=dict(os.environ,
+                                      PYTHONPATH=pj(here, '../..')))
+        lines = [json.loads(ll) for ll in out.stdout.splitlines()]
+        assert lines == groups[:2]
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_dirs_only(nprocs):
+    from findsame import Engine
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        # same structure as dir1 (file sizes), different content
+        shutil.copytree(pj(d, 'dir1'), pj(d, 'dir1_fake'))
+        for name in os.listdir(pj(d, 'dir1_fake')):
+            fn = pj(d, 'dir1_fake', name)
+            if os.path.isfile(fn) and os.path.getsize(fn) > 0:
+                with open(fn, 'r+b') as fd:
+                    fd.write(b'X')
+        # no twin: no file in here is read
+        os.makedirs(pj(d, 'unique'))
+        with open(pj(d, 'unique', 'big'), 'wb') as fd:
+            fd.write(os.urandom(12345))
+
+        with Engine(nprocs=nprocs) as engine:
+            ref = engine.scan([d])
+        with Engine(nprocs=nprocs, dirs_only=True, pipeline=True) as engine:
+            mt = engine.merkle_tree([d])
+            mt.calc_fprs()
+            val = main.assemble_result(mt)
+        assert set(val) == set(kk for kk in ref if kk.startswith('dir'))
+        assert cmp_o3(val, dict((kk, ref[kk]) for kk in val))
+        assert pj(d, 'dir1_fake') not in sum(val['dir'], [])
+        assert pj(d, 'unique', 'big') not in mt.leaf_fprs
+        assert pj(d, 'dir1_fake', 'file2') in mt.leaf_fprs
+        # the whole data dir is unique, so are all files directly in there
+        assert pj(d, 'file1') not in mt.leaf_fprs
+        assert mt.tree.nodes[pj(d, 'dir1')].sig == \
+            mt.tree.nodes[pj(d, 'dir1_fake')].sig
+
+
+@pytest.mark.parametrize('nprocs,nthreads,limit',
+                         [(1,1,None), (1,3,None), (2,1,1024)])
+def test_archives(nprocs, nthreads, limit):
+    import tarfile
+    import zipfile
+    from findsame import Engine, archive
+    with tempfile.TemporaryDirectory() as tmpdir:
+        proj = pj(tmpdir, 'proj')
+        os.makedirs(pj(proj, 'sub'))
+        os.makedirs(pj(proj, 'empty'))
+        for name in ['a', 'sub/b', 'sub/c']:
+            with open(pj(proj, name), 'wb') as fd:
+                fd.write(os.urandom(5000))
+        with tarfile.open(pj(tmpdir, 'proj.tar.gz'), 'w:gz') as tf:
+            tf.add(proj, arcname='proj')
+        with zipfile.ZipFile(pj(tmpdir, 'proj.zip'), 'w') as zf:
+            for root, dirs, files in os.walk(proj):
+                arcroot = os.path.relpath(root, tmpdir)
+                zf.write(root, arcroot)
+                for name in files:
+                    zf.write(pj(root, name), pj(arcroot, name))
+        with open(pj(tmpdir, 'bad.zip'), 'wb') as fd:
+            fd.write(b'not a zip file')
+        # encrypted member: set the flag bit in the local and central
+        # header, zipfile can't write encrypted files
+        with zipfile.ZipFile(pj(tmpdir, 'enc.zip'), 'w') as zf:
+            zf.writestr('secret', b'x' * 100)
+            zf.writestr('public', b'y' * 100)
+        with open(pj(tmpdir, 'enc.zip'), 'r+b') as fd:
+            buf = bytearray(fd.read())
+            buf[6] |= 0x1
+            buf[buf.find(b'PK\x01\x02') + 8] |= 0x1
+            fd.seek(0)
+            fd.write(buf)
+
+        kwds = dict(nprocs=nprocs, nthreads=nthreads, limit=limit)
+        with Engine(archives=True, pipeline=True, **kwds) as engine:
+            mt = engine.merkle_tree([tmpdir])
+            mt.calc_fprs()
+            val = main.assemble_result(mt)
+            # 2nd scan: archive fprs from the cache, members still there
+            mt2 = engine.merkle_tree([tmpdir])
+            mt2.calc_fprs()
+            assert cmp_o3(main.assemble_result(mt2), val)
+            assert mt2.leaf_fprs == mt.leaf_fprs
+        dirs = [sorted(pp) for pp in val['dir']]
+        sep = archive.SEP
+        assert [proj, pj(tmpdir, f'proj.tar.gz{sep}proj'),
+                pj(tmpdir, f'proj.zip{sep}proj')] in dirs
+        assert [pj(tmpdir, f'proj.tar.gz{sep}'),
+                pj(tmpdir, f'proj.zip{sep}')] in dirs
+        assert sorted([pj(proj, 'sub/b'),
+                       pj(tmpdir, f'proj.tar.gz{sep}proj/sub/b'),
+                       pj(tmpdir, f'proj.zip{sep}proj/sub/b')]) in \
+            [sorted(pp) for pp in val['file']]
+        assert mt.node_fprs[pj(tmpdir, f'proj.zip{sep}proj/empty')] == \
+            calc.EMPTY_DIR_FPR
+        assert not any(pp.startswith(pj(tmpdir, 'bad.zip') + sep)
+                       for pp in mt.leaf_fprs)
+        assert pj(tmpdir, f'enc.zip{sep}public') in mt.leaf_fprs
+        assert pj(tmpdir, f'enc.zip{sep}secret') not in mt.leaf_fprs
+        # same as w/o archives, apart from the archive members
+        with Engine(**kwds) as engine:
+            ref = engine.merkle_tree([tmpdir])
+            ref.calc_fprs()
+        assert dict((kk, vv) for kk, vv in mt.leaf_fprs.items()
+                    if sep not in kk) == ref.leaf_fprs
+        assert dict((kk, vv) for kk, vv in mt.node_fprs.items()
+                    if sep not in kk) == ref.node_fprs
+
+
+@pytest.mark.parametrize('outmode', [1, 2, 3])
+def test_recheck(outmode):
+    from findsame import recheck
+    from findsame.config import Config, default_cfg
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        cfg = Config(copy.deepcopy(default_cfg), outmode=outmode)
+        old = main.main([d], cfg=cfg)
+        groups, stats = recheck.recheck(json.loads(json.dumps(old)), cfg=cfg)
+        assert stats['groups_in'] == stats['groups_out']
+        assert stats['dropped'] == 0
+        ref = main.main([d], cfg=Config(cfg, outmode=3))
+        assert cmp_o3(main.assemble_groups(groups, 3), ref)
+
+        # file2 group: one gone, one changed (same size), one changed size
+        os.remove(pj(d, 'file2'))
+        for name, data in [('dir1/file2_copy', None), ('dir1_copy/file2', b'x')]:
+            fn = pj(d, name)
+            if data is None:
+                with open(fn, 'rb') as fd:
+                    data = bytes(255 - bb for bb in fd.read())
+            with open(fn, 'wb') as fd:
+                fd.write(data)
+        groups, stats = recheck.recheck(old, cfg=cfg)
+        val = main.assemble_groups(groups, 3)
+        # dir1 and dir1_copy differ now
+        assert [pj(d, 'dir1'), pj(d, 'dir1_copy')] not in \
+            [sorted(pp) for pp in val['dir']]
+        assert [pj(d, 'dir1/file2'), pj(d, 'dir1_copy/file2_copy')] in \
+            [sorted(pp) for pp in val['file']]
+        assert stats['dropped'] == 1
+        # nothing new, so same as a new scan
+        assert cmp_o3(val, main.main([d], cfg=Config(cfg, outmode=3)))
+
+
+def test_estimate():
+    from findsame import estimate
+    from findsame.config import Config, default_cfg
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, size in [('a', 3000), ('b', 3000), ('c', 1000),
+                           ('d', 2000), ('e', 0), ('f', 0)]:
+            with open(pj(tmpdir, name), 'wb') as fd:
+                fd.write(os.urandom(size))
+        model = estimate.ThroughputModel(bytes_per_sec=1000,
+                                         secs_per_file=0.5)
+        cfg = Config(copy.deepcopy(default_cfg), limit=1024)
+        est = estimate.estimate([tmpdir], cfg=cfg, model=model)
+        assert (est['files'], est['dirs'], est['bytes']) == (6, 1, 9000)
+        strat = dict((st['strategy'], (st['files'], st['bytes']))
+                     for st in est['strategies'])
+        assert strat == {'full': (6, 9000),
+                         'limit=1.0K': (6, 4072),
+                         'size': (2, 6000),
+                         'size+limit=1.0K': (2, 2048)}
+        assert [st['time'] for st in est['strategies']] == \
+            pytest.approx([12, 7.072, 7, 3.048])
+        assert 'size+limit' in estimate.format_table(est)
+
+    # fit to benchmark suite results: 100 bytes/s, 0.1 s per file
+    results = [dict(mix=mix, cache=cache, nbytes=nbytes, nfiles=nfiles,
+                    time=(nbytes / 100 + nfiles * 0.1) * factor)
+               for mix, nbytes, nfiles in [('small', 1000, 100),
+                                           ('large', 10000, 2),
+                                           ('mixed', 5000, 50)]
+               for cache, factor in [('cold', 1), ('warm', 0.1)]]
+    model = estimate.ThroughputModel.from_results(results)
+    assert model.bytes_per_sec == pytest.approx(100)
+    assert model.secs_per_file == pytest.approx(0.1)
+
+
+def test_sparse(monkeypatch):
+    import tarfile
+    from findsame import Engine, archive
+    chunk = calc.SPARSE_CHUNK
+    with tempfile.TemporaryDirectory() as tmpdir:
+        size = 50*chunk + 123
+        data = os.urandom(3000)
+        # sparse: data at 0, in the middle (not chunk aligned) and at the end
+        sparse = pj(tmpdir, 'sparse')
+        with open(sparse, 'wb') as fd:
+            for pos in [0, 20*chunk - 1000, size - len(data)]:
+                fd.seek(pos)
+                fd.write(data)
+            fd.truncate(size)
+        # same content, all zeros written
+        with open(sparse, 'rb') as fd:
+            content = fd.read()
+        dense = pj(tmpdir, 'dense')
+        with open(dense, 'wb') as fd:
+            fd.write(content)
+        # one byte different in a hole
+        other = pj(tmpdir, 'other')
+        with open(other, 'wb') as fd:
+            fd.write(content[:30*chunk] + b'x' + content[30*chunk+1:])
+        with tarfile.open(pj(tmpdir, 'arch.tar'), 'w') as tf:
+            tf.add(dense, arcname='dense')
+
+        # data regions are found, if the file system supports that
+        with open(sparse, 'rb') as fd:
+            extents = list(calc.data_extents(fd.fileno(), size))
+        assert extents[0][0] == 0 and extents[-1][1] == size
+
+        fprs = {}
+        for blocksize in [1024, chunk, 3*chunk + 17]:
+            for limit in [None, 25*chunk]:
+                func = lambda fn: calc.hash_file_sparse(calc.Leaf(fn),
+                                                        blocksize=blocksize,
+                                                        limit=limit)
+                assert func(sparse) == func(dense)
+                assert (func(other) == func(dense)) == (limit is not None)
+                fprs.setdefault(limit, set()).add(func(dense))
+        # blocksize doesn't change the fpr
+        assert [len(vv) for vv in fprs.values()] == [1, 1]
+        assert calc.hash_file_sparse(calc.Leaf(sparse)) != \
+            calc.hash_file(calc.Leaf(sparse))
+        # same fpr in one read with other digests
+        key = calc.make_fpr_key('sha1', None, sparse=True)
+        assert calc.hash_file_multi(calc.Leaf(dense), [(key, 'sha1', None)],
+                                    blocksize=chunk, sparse=True)[key] == \
+            calc.hash_file_sparse(calc.Leaf(sparse))
+
+        # short read (e.g. file truncated while we read it): stop, offsets
+        # stay aligned
+        offsets = []
+        pread = os.pread
+        update_sparse = calc.update_sparse
+
+        def spy(hasher, offset, buf):
+            offsets.append(offset)
+            update_sparse(hasher, offset, buf)
+
+        monkeypatch.setattr(calc.os, 'pread',
+                            lambda fd, nn, pos: pread(fd, nn, pos)[:-1000])
+        monkeypatch.setattr(calc, 'update_sparse', spy)
+        calc.hash_file_sparse(calc.Leaf(dense), blocksize=2*chunk)
+        monkeypatch.undo()
+        assert offsets == [0]
+
+        with Engine(sparse=True, archives=True, nthreads=2) as engine:
+            val = engine.scan([tmpdir])
+            assert calc.fpr_key(engine.cfg).endswith(':sparse')
+        assert sorted([dense, sparse, pj(tmpdir, f'arch.tar{archive.SEP}dense')]) \
+            in [sorted(pp) for pp in val['file']]
+
+
+def test_watchdog(monkeypatch):
+    import threading
+    from findsame import Engine
+    from findsame.watchdog import Watchdog
+    release = threading.Event()
+    hash_file = calc.hash_file
+
+    def slow_hash_file(leaf, **kwds):
+        if os.path.basename(leaf.path).startswith('slow'):
+            release.wait(timeout=30)
+        return hash_file(leaf, **kwds)
+
+    monkeypatch.setattr(calc, 'hash_file', slow_hash_file)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for dr in ['a', 'b']:
+                os.makedirs(pj(tmpdir, dr))
+                for name in ['file1', 'file2', 'slow']:
+                    with open(pj(tmpdir, dr, name), 'w') as fd:
+                        fd.write(name)
+            with Engine(nthreads=2, file_timeout=0.3) as engine:
+                merkle_tree = main.get_merkle_tree([tmpdir], cfg=engine.cfg,
+                                                   pool=engine.pool)
+                merkle_tree.calc_fprs()
+            slow = [pj(tmpdir, dr, 'slow') for dr in ['a', 'b']]
+            assert sorted(merkle_tree.watchdog.unreadable) == slow
+            assert sorted(merkle_tree.watchdog.stalled) == slow
+            fprs = merkle_tree.leaf_fprs
+            assert [fprs[pp] for pp in slow] == [calc.UNREADABLE_FILE_FPR]*2
+            assert fprs[pj(tmpdir, 'a/file1')] == fprs[pj(tmpdir, 'b/file1')]
+            # dirs with an unreadable file are never the same
+            result = main.assemble_result(merkle_tree)
+            assert sorted(result['file']) == \
+                [[pj(tmpdir, dr, name) for dr in ['a', 'b']]
+                 for name in ['file1', 'file2']]
+            assert 'dir' not in result
+    finally:
+        release.set()
+
+    # give up on a device after max_timeouts, read errors are unreadable
+    class FakeLeaf:
+        def __init__(self, path, dev):
+            self.path = path
+            self.dev = dev
+
+        def _get_fpr(self):
+            if self.path.startswith('hang'):
+                release.wait(timeout=30)
+            elif self.path.startswith('err'):
+                raise OSError(5, 'Input/output error')
+            return self.path
+
+    release.clear()
+    leafs = [FakeLeaf(f'hang{ii}', 1) for ii in range(5)]
+    leafs += [FakeLeaf(f'ok{ii}', 2) for ii in range(5)]
+    leafs += [FakeLeaf('err', 2)]
+    try:
+        wd = Watchdog(nworkers=2, file_timeout=0.2, max_timeouts=2)
+        fprs = dict((leaf.path, fpr) for leaf, fpr in wd.run(leafs))
+    finally:
+        release.set()
+    assert len(fprs) == len(leafs)
+    assert all(fprs[f'ok{ii}'] == f'ok{ii}' for ii in range(5))
+    assert all(fprs[f'hang{ii}'] == calc.UNREADABLE_FILE_FPR
+               for ii in range(5))
+    assert fprs['err'] == calc.UNREADABLE_FILE_FPR
+    assert wd.dead_devices == [1]
+
+
+def test_digests(monkeypatch):
+    from findsame.cache import PersistentFprCache
+    from findsame.config import Config, default_cfg
+    assert calc.parse_digest('512K') == ('sha1', 512*1024)
+    assert calc.parse_digest('md5:1M') == ('md5', 1024**2)
+    assert calc.parse_digest('full') == ('sha1', None)
+    with pytest.raises(ValueError):
+        calc.parse_digest('shake_128')
+    with pytest.raises(ValueError):
+        calc.parse_digest('sha1:foo')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = pj(tmpdir, 'file')
+        with open(fn, 'wb') as fd:
+            fd.write(os.urandom(10000) + bytes(70000) + os.urandom(5000))
+        leaf = calc.Leaf(fn)
+        for sparse in [False, True]:
+            for blocksize in [None, 1024, 3000, 100000]:
+                digests = calc.digest_keys(
+                    Config(default_cfg, sparse=sparse,
+                           digests=['4000B', '20000B', 'sha256', 'md5:1M',
+                                    '1M']))
+                fprs = calc.hash_file_multi(leaf, digests,
+                                            blocksize=blocksize,
+                                            sparse=sparse)
+                assert list(fprs) == [key for key, _, _ in digests]
+                for key, hashname, limit in digests:
+                    if hashname != 'sha1':
+                        continue
+                    if sparse:
+                        ref = calc.hash_file_sparse(leaf, blocksize=4096,
+                                                    limit=limit)
+                    elif limit is None:
+                        ref = calc.hash_file(leaf)
+                    else:
+                        ref = calc.hash_file_limit(leaf, blocksize=limit,
+                                                   limit=limit)
+                    assert fprs[key] == ref, (key, blocksize)
+                if not sparse:
+                    with open(fn, 'rb') as fd:
+                        content = fd.read()
+                    assert fprs['sha256'] == hashlib.sha256(
+                        str(len(content)).encode() + content).hexdigest()
+
+    # one run with extra digests, a later run with one of those settings
+    # reads nothing
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        cache_fn = pj(ctx.tmpdir, 'cache.sqlite')
+        cfg = Config(copy.deepcopy(default_cfg), digests=['4K', 'sha256'])
+        with PersistentFprCache(cache_fn) as cache:
+            mt = main.get_merkle_tree([d], cfg=cfg, cache=cache)
+            mt.calc_fprs()
+            assert cmp_o3(main.assemble_result(mt), main.main([d]))
+            leaf = next(iter(mt.tree.leafs.values()))
+            assert set(cache._data[leaf.path][2]) == \
+                {'sha1', 'sha1:4096', 'sha256'}
+
+        def fail(*args, **kwds):
+            raise Exception("file read")
+
+        for name in ['hash_file', 'hash_file_limit', 'hash_file_multi']:
+            monkeypatch.setattr(calc, name, fail)
+        cfg = Config(copy.deepcopy(default_cfg), limit=4096, blocksize=4096)
+        with PersistentFprCache(cache_fn) as cache:
+            mt = main.get_merkle_tree([d], cfg=cfg, cache=cache)
+            mt.calc_fprs()
+        monkeypatch.undo()
+        assert cmp_o3(main.assemble_result(mt), main.main([d], cfg=cfg))
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_copies(nprocs, monkeypatch):
+    from findsame import Engine, copies
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = os.urandom(20000)
+        files = dict(query=data,
+                     copy1=data,
+                     copy2=data,
+                     # same size, head differs: never hashed
+                     head=b'x' + data[1:],
+                     # same size and head, differs later
+                     tail=data[:-1] + b'x',
+                     other=os.urandom(300))
+        os.makedirs(pj(tmpdir, 'search/sub'))
+        for name, content in files.items():
+            path = pj(tmpdir, name if name == 'query' else
+                      f'search/sub/{name}' if name == 'copy2' else
+                      f'search/{name}')
+            with open(path, 'wb') as fd:
+                fd.write(content)
+        query = pj(tmpdir, 'query')
+        hashed = []
+        hash_file = calc.hash_file
+
+        def spy(leaf, **kwds):
+            hashed.append(os.path.basename(leaf.path))
+            return hash_file(leaf, **kwds)
+
+        # can't pickle spy for processes
+        if nprocs == 1:
+            monkeypatch.setattr(calc, 'hash_file', spy)
+        with Engine(nprocs=nprocs, nthreads=2) as engine:
+            # the query file itself is not reported
+            matches = list(engine.iter_copies([query], [tmpdir]))
+        assert sorted(mm['copy'] for mm in matches) == \
+            [pj(tmpdir, 'search/copy1'), pj(tmpdir, 'search/sub/copy2')]
+        assert all(mm['query'] == query for mm in matches)
+        if nprocs == 1:
+            assert sorted(hashed) == ['copy1', 'copy2', 'query', 'tail']
+        monkeypatch.undo()
+
+        # matches in the order they are confirmed, a slow candidate doesn't
+        # hold back the others
+        if nprocs == 1:
+            check = copies._check
+
+            def slow_check(leaf, heads):
+                if leaf.path.endswith('copy1'):
+                    time.sleep(0.5)
+                return check(leaf, heads)
+
+            monkeypatch.setattr(copies, '_check', slow_check)
+            with Engine(nthreads=4) as engine:
+                matches = list(engine.iter_copies([query], [tmpdir]))
+            assert [mm['copy'] for mm in matches] == \
+                [pj(tmpdir, 'search/sub/copy2'), pj(tmpdir, 'search/copy1')]
+            monkeypatch.undo()
+
+        exe = f'{here}/../../bin/findsame'
+        out = subprocess.check_output(f'{exe} {tmpdir}/search '
+                                      f'--find-copies-of {query}',
+                                      shell=True)
+        lines = [json.loads(ll) for ll in out.decode().splitlines()]
+        assert sorted(ll['copy'] for ll in lines) == \
+            sorted(mm['copy'] for mm in matches)
+        with pytest.raises(Exception):
+            list(copies.iter_copies([pj(tmpdir, 'search')], [tmpdir]))
+
+
+def test_files_from():
+    import io
+    lst = ['a/f1', 'b/c/f2', 'b/f3', 'b/c/d/f4']
+    for sep in ['\0', '\n']:
+        data = (sep.join(lst) + sep).encode()
+        for chunk_size in [1, 3, 1000]:
+            assert list(main.read_paths(io.BytesIO(data),
+                                        chunk_size=chunk_size)) == lst
+    assert list(main.read_paths(io.BytesIO(b'x\ny'))) == ['x', 'y']
+    assert list(main.read_paths(io.BytesIO(b''))) == []
+
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        files = [pj(r, f) for r, _, fs in os.walk(d) for f in fs]
+        ref = main.main([d])
+        # links are skipped as in a walk, missing and dirs in the list, too
+        extra = [pj(d, 'missing'), pj(d, 'dir1')]
+        trees = []
+        for seed in range(3):
+            random.Random(seed).shuffle(files)
+            tree = calc.FileDirTree(files=iter(files + extra), link=True)
+            trees.append(tree)
+            # nodes are linked to their parents whatever the order
+            for path, node in tree.nodes.items():
+                childs = sorted(cc.path for cc in node.childs)
+                assert childs == sorted(set(childs))
+                if path != d:
+                    assert path in [cc.path for cc in
+                                    tree.nodes[os.path.dirname(path)].childs]
+            mt = calc.MerkleTree(tree)
+            mt.calc_fprs()
+            assert cmp_o3(main.assemble_result(mt), ref)
+        assert set(trees[0].nodes) == \
+            set(main.get_file_dir_tree([d]).nodes) - \
+            set(pp for pp in main.get_file_dir_tree([d]).nodes
+                if not any(ff.startswith(pp + '/') for ff in files))
+        # files on the command line: no nodes for dirs in between
+        args = [pj(d, 'file1'), pj(d, 'dir3/deep/but/only/one/file'),
+                pj(d, 'dir1/file2')]
+        assert set(main.get_file_dir_tree(args).nodes) == \
+            set(os.path.dirname(ff) for ff in args)
+        assert set(main.get_file_dir_tree(
+            [], files_from=iter(args)).nodes) == \
+            set([d, pj(d, 'dir1'), pj(d, 'dir3'), pj(d, 'dir3/deep'),
+                 pj(d, 'dir3/deep/but'), pj(d, 'dir3/deep/but/only'),
+                 pj(d, 'dir3/deep/but/only/one')])
+
+        # CLI
+        lst = pj(ctx.tmpdir, 'files.lst')
+        with open(lst, 'w') as fd:
+            fd.write('\0'.join(files))
+        exe = f'{here}/../../bin/findsame'
+        for cmd in [f'{exe} --files-from {lst}',
+                    f'cat {lst} | {exe} --files-from -']:
+            out = subprocess.check_output(cmd, shell=True)
+            assert cmp_o3(json.loads(out.decode()), ref)
+
+
+def test_state():
+    from findsame.config import Config, default_cfg
+    from findsame.state import State
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        fn = pj(ctx.tmpdir, 'state.sqlite')
+        cfg = Config(copy.deepcopy(default_cfg))
+        nfiles = len(main.get_file_dir_tree([d]).leafs)
+        ndirs = len(main.get_file_dir_tree([d]).nodes)
+
+        def run():
+            with State(fn, cfg) as state:
+                mt = state.get_merkle_tree([d])
+                # nodes with fpr from the state
+                reused = set(path for path, node in mt.tree.nodes.items()
+                             if 'fpr' in node.__dict__)
+                result = main.assemble_result(mt)
+                state.save(mt)
+            assert cmp_o3(result, main.main([d], cfg=cfg))
+            return state.stats, reused
+
+        stats, _ = run()
+        assert stats == dict(dirs=ndirs, dirs_listed=ndirs,
+                             files_stat=nfiles)
+        mt_nodes = main.get_file_dir_tree([d]).nodes
+        # nothing changed: no dir listed, no file stat'ed, all node fprs
+        # from the state
+        stats, reused = run()
+        assert stats == dict(dirs=ndirs, dirs_listed=0, files_stat=0)
+        assert len(reused) == ndirs
+
+        # new file in one dir: only that one is listed, its files stat'ed,
+        # it and its parents get new fprs
+        dr = pj(d, 'dir3/deep/but')
+        with open(pj(dr, 'new'), 'w') as fd:
+            fd.write('new')
+        stats, reused = run()
+        assert stats == dict(dirs=ndirs, dirs_listed=1, files_stat=1)
+        ancestors = {dr, pj(d, 'dir3/deep'), pj(d, 'dir3'), d}
+        assert reused == set(mt_nodes) - ancestors
+
+        # removed dir, changed filter: full scan
+        shutil.rmtree(pj(d, 'dir1_copy'))
+        stats, _ = run()
+        assert stats['dirs_listed'] == 1
+        import sqlite3
+        with sqlite3.connect(fn) as conn:
+            for table in ['dirs', 'leafs']:
+                assert not [pp for pp, in conn.execute(f"SELECT path FROM "
+                                                       f"{table}")
+                            if 'dir1_copy' in pp]
+        cfg = Config(cfg, min_size=2)
+        stats, _ = run()
+        assert stats['dirs_listed'] == stats['dirs']
+
+        # CLI
+        exe = f'{here}/../../bin/findsame'
+        for _ in range(2):
+            out = subprocess.check_output(f'{exe} --state {fn} {d}',
+                                          shell=True)
+            assert cmp_o3(json.loads(out.decode()), main.main([d]))
+        for opt in ['--resume', '--checkpoint-interval 1',
+                    '--also-digest 1K']:
+            proc = subprocess.run(f'{exe} --state {fn} {opt} {d}',
+                                  shell=True, capture_output=True)
+            assert proc.returncode != 0
+            assert b"--state can't be used" in proc.stderr
+
+
+def test_resultdb():
+    import sqlite3
+    from findsame import resultdb
+    with TstDataTmpdir() as ctx:
+        d = ctx.datadir
+        fn = pj(ctx.tmpdir, 'result.db')
+        mt = main.get_merkle_tree([d])
+        result = main.assemble_result(mt)
+        counts = resultdb.write(mt, fn)
+        assert counts == dict(files=len(mt.leaf_fprs),
+                              dirs=len(mt.node_fprs),
+                              groups=sum(map(len, result.values())))
+        with sqlite3.connect(fn) as conn:
+            # same groups as in the json result
+            groups = {}
+            for typ, gid, path in conn.execute(
+                    "SELECT g.typ, g.id, m.path FROM groups g JOIN members m "
+                    "ON m.group_id = g.id"):
+                groups.setdefault((typ, gid), []).append(path)
+            dbres = {}
+            for (typ, _), paths in groups.items():
+                dbres.setdefault(typ, []).append(paths)
+            assert cmp_o3(dbres, result)
+            # fprs, sizes and waste
+            for path, size, fpr in conn.execute(
+                    "SELECT f.path, f.size, p.fpr FROM files f JOIN fprs p "
+                    "ON f.fpr_id = p.id"):
+                assert fpr == mt.leaf_fprs[path]
+                assert size == os.path.getsize(path)
+            for size, count, waste in conn.execute(
+                    "SELECT size, count, waste FROM groups"):
+                assert waste == size * (count - 1)
+            # largest duplicate dirs below a dir
+            rows = conn.execute(
+                "SELECT g.waste, m.path FROM groups g JOIN members m ON "
+                "m.group_id = g.id WHERE g.typ = 'dir' AND m.path >= ? AND "
+                "m.path < ? ORDER BY g.waste DESC",
+                (d + '/', d + '0')).fetchall()
+            assert sorted(pp for _, pp in rows) == \
+                sorted(pp for paths in result['dir'] for pp in paths)
+            plan = ' '.join(str(rr) for rr in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT path FROM dirs WHERE path >= ? "
+                "AND path < ?", ('/x/', '/x0')))
+            assert 'dirs_path' in plan
+
+        # CLI
+        exe = f'{here}/../../bin/findsame'
+        out = subprocess.check_output(f'{exe} --db {fn} {d}', shell=True)
+        assert out == b''
+        with sqlite3.connect(fn) as conn:
+            assert conn.execute("SELECT count(*) FROM groups").fetchone() == \
+                (counts['groups'],)
@@ -0,0 +1,180 @@
+"""Limit the read bandwidth and file open rate of hash calculation.
+
+Use this when scanning live file servers where the scan must not hurt
+other users' latency.
+
+::
+
+    >>> from findsame import throttle
+    >>> throttle.install(throttle.Throttle(max_bytes_per_sec=50*MiB,
+    ...                                    max_opens_per_sec=1000))
+    >>> ... scan ...
+    >>> throttle.current.report()
+
+Limits are token buckets. Each file open takes one token from the opens
+bucket, each read takes as many tokens as bytes were read from the bytes
+bucket. If a bucket is empty, the caller sleeps until the tokens are
+refilled (at the configured rate). The state lives in shared memory
+(multiprocessing.Value), so the limits apply to all threads and processes
+together: worker processes started by findsame.parallel get the installed
+throttle passed to them.
+
+Adaptive mode
+-------------
+With `adaptive=True`, we measure the latency of each read per byte read
+(at least `ADAPT_MIN_BYTES`, such that small reads are not penalized). If
+a fast moving average rises above `ADAPT_LATENCY_FACTOR` times a slow one
+(the baseline), the bytes rate is reduced by `ADAPT_DECREASE` (at most
+once per `ADAPT_COOLDOWN` seconds), else it is increased by
+`ADAPT_INCREASE` times the configured rate, which is the upper bound
+(AIMD, as in TCP congestion control).
+"""
+
+import time
+
+# Bucket size in seconds of the rate, i.e. how much can be used at once
+# after an idle phase.
+BURST_SEC = 0.1
+ADAPT_LATENCY_FACTOR = 2.0
+ADAPT_DECREASE = 0.8
+ADAPT_INCREASE = 0.01
+ADAPT_MIN_FACTOR = 0.05
+ADAPT_COOLDOWN = 0.1
+ADAPT_MIN_BYTES = 4096
+# weights of a new latency in the fast and slow moving average
+ADAPT_FAST_WEIGHT = 0.2
+ADAPT_SLOW_WEIGHT = 0.02
+# number of reads before we start adapting
+ADAPT_WARMUP = 10
+
+
+# the installed Throttle instance, used in calc.hash_file*()
+current = None
+
+
+def install(throttle):
+    """Install `throttle` (None = remove), used by all following hash
+    calculations in this process and worker processes started afterwards."""
+    global current
+    current = throttle
+
+
+class TokenBucket:
+    """Token bucket with state in shared memory."""
+    def __init__(self, rate, ctx, burst=None):
+        assert rate > 0, f"rate={rate}"
+        self.rate = rate
+        self.burst = max(rate * BURST_SEC, 1) if burst is None else burst
+        self._tokens = ctx.Value('d', self.burst, lock=False)
+        self._last = ctx.Value('d', time.monotonic(), lock=False)
+        self._lock = ctx.Lock()
+
+    def acquire(self, ntokens, factor=1.0):
+        """Take `ntokens`, sleep if there are not enough. The rate is scaled
+        by `factor`. We can go into debt (negative tokens): the caller
+        sleeps until the debt would be payed back, later callers wait
+        longer. That's fair and allows `ntokens` > burst."""
+        rate = self.rate * factor
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst,
+                         self._tokens.value + (now - self._last.value) * rate)
+            tokens -= ntokens
+            self._tokens.value = tokens
+            self._last.value = now
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+
+class Throttle:
+    """
+    Parameters
+    ----------
+    max_bytes_per_sec : float, None
+        read bandwidth limit, None = unlimited
+    max_opens_per_sec : float, None
+        file open limit, None = unlimited
+    adaptive : bool
+        reduce the bandwidth limit if read latency rises, needs
+        `max_bytes_per_sec`
+    """
+    def __init__(self, max_bytes_per_sec=None, max_opens_per_sec=None,
+                 adaptive=False):
+        import multiprocessing
+        ctx = multiprocessing.get_context()
+        if adaptive and max_bytes_per_sec is None:
+            raise ValueError("adaptive mode needs max_bytes_per_sec")
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_opens_per_sec = max_opens_per_sec
+        self.adaptive = adaptive
+        self._bytes_bucket = None if max_bytes_per_sec is None else \
+            TokenBucket(max_bytes_per_sec, ctx)
+        self._opens_bucket = None if max_opens_per_sec is None else \
+            TokenBucket(max_opens_per_sec, ctx)
+        self._start = time.monotonic()
+        self._lock = ctx.Lock()
+        self._nbytes = ctx.Value('q', 0, lock=False)
+        self._nopens = ctx.Value('q', 0, lock=False)
+        # adaptive state: rate factor, fast and slow latency moving average
+        self._factor = ctx.Value('d', 1.0, lock=False)
+        self._min_factor = ctx.Value('d', 1.0, lock=False)
+        self._lat_fast = ctx.Value('d', 0.0, lock=False)
+        self._lat_slow = ctx.Value('d', 0.0, lock=False)
+        self._nreads = ctx.Value('q', 0, lock=False)
+        self._last_decrease = ctx.Value('d', 0.0, lock=False)
+
+    def open(self):
+        """Call before opening a file."""
+        if self._opens_bucket is not None:
+            self._opens_bucket.acquire(1)
+        with self._lock:
+            self._nopens.value += 1
+
+    def read(self, nbytes, latency):
+        """Call after reading `nbytes` which took `latency` seconds."""
+        with self._lock:
+            self._nbytes.value += nbytes
+            if self.adaptive and nbytes > 0:
+                self._adapt(latency / max(nbytes, ADAPT_MIN_BYTES))
+            factor = self._factor.value
+        if self._bytes_bucket is not None and nbytes > 0:
+            self._bytes_bucket.acquire(nbytes, factor=factor)
+
+    def _adapt(self, latency):
+        fast = self._lat_fast
+        slow = self._lat_slow
+        self._nreads.value += 1
+        if self._nreads.value == 1:
+            fast.value = slow.value = latency
+            return
+        fast.value += ADAPT_FAST_WEIGHT * (latency - fast.value)
+        slow.value += ADAPT_SLOW_WEIGHT * (latency - slow.value)
+        if self._nreads.value < ADAPT_WARMUP:
+            return
+        factor = self._factor.value
+        if fast.value > ADAPT_LATENCY_FACTOR * slow.value:
+            now = time.monotonic()
+            if now - self._last_decrease.value > ADAPT_COOLDOWN:
+                factor = max(ADAPT_MIN_FACTOR, factor * ADAPT_DECREASE)
+                self._last_decrease.value = now
+        else:
+            factor = min(1.0, factor + ADAPT_INCREASE)
+        self._factor.value = factor
+        self._min_factor.value = min(self._min_factor.value, factor)
+
+    def report(self):
+        """Dict with configured and achieved rates."""
+        elapsed = time.monotonic() - self._start
+        nbytes = self._nbytes.value
+        nopens = self._nopens.value
+        dct = dict(max_bytes_per_sec=self.max_bytes_per_sec,
+                   max_opens_per_sec=self.max_opens_per_sec,
+                   bytes=nbytes,
+                   opens=nopens,
+                   elapsed=elapsed,
+                   bytes_per_sec=nbytes / elapsed if elapsed > 0 else 0.0,
+                   opens_per_sec=nopens / elapsed if elapsed > 0 else 0.0)
+        if self.adaptive:
+            dct.update(rate_factor=self._factor.value,
+                       min_rate_factor=self._min_factor.value)
+        return dct
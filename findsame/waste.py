@@ -0,0 +1,124 @@
+"""Find the largest duplicates first.
+
+For cleanup under disk pressure, we want the files which waste the most
+space, not a complete listing. Files can only be the same if they have the
+same size, so we walk the file system (no hashing, only one stat per file),
+build a table size -> files and order all groups of >1 same-size files by
+the space they could waste, ``size * (count - 1)``. Then we hash the groups
+in that order and yield the confirmed groups of same files right away, such
+that the biggest duplicates come first. We stop when `top` groups were
+found, `target` bytes of waste were found or `budget` seconds have passed.
+
+The order is by potential waste of each same-size group. A group whose
+files are not all the same wastes less than that, so confirmed groups come
+in roughly, not strictly, descending order of waste. Empty files waste
+nothing and are skipped.
+
+::
+
+    >>> for group in iter_waste(['/data'], top=10):
+    ...     print(group['waste'], group['paths'])
+"""
+
+import time
+from collections import defaultdict
+
+from findsame import calc, main, parallel
+from findsame.config import cfg as global_cfg
+
+# Number of files hashed in one batch per worker (threads * processes). Small
+# same-size groups are put into one batch to keep all workers busy, large
+# groups are one batch.
+BATCH_PER_WORKER = 4
+
+
+def size_groups(tree):
+    """Groups of >1 non-empty leafs with the same size in `tree`
+    (calc.FileDirTree), largest potential waste first."""
+    by_size = defaultdict(list)
+    for leaf in tree.leafs.values():
+        if leaf.filesize > 0:
+            by_size[leaf.filesize].append(leaf)
+    groups = [leafs for leafs in by_size.values() if len(leafs) > 1]
+    groups.sort(key=lambda leafs: leafs[0].filesize * (len(leafs) - 1),
+                reverse=True)
+    return groups
+
+
+def _batches(groups, batch_size):
+    batch = []
+    nleafs = 0
+    for leafs in groups:
+        batch.append(leafs)
+        nleafs += len(leafs)
+        if nleafs >= batch_size:
+            yield batch
+            batch = []
+            nleafs = 0
+    if batch:
+        yield batch
+
+
+def iter_waste(files_dirs, cfg=None, top=None, target=None, budget=None,
+               pool=None):
+    """Yield dicts ``{size, count, waste, paths}`` for groups of same files,
+    largest potential waste first.
+
+    Parameters
+    ----------
+    files_dirs : seq of str
+    cfg : config.Config instance, None
+        None = use the package-wide findsame.config.cfg, filter settings
+        are used
+    top : int, None
+        stop after that many groups
+    target : int, None
+        stop when the sum of waste of all yielded groups is at least that
+        (bytes)
+    budget : float, None
+        stop after that many seconds, checked after each batch of hashed
+        files, so a batch of large files can go over budget
+    pool : pool executor instance, None
+        passed to calc.MerkleTree
+    """
+    t0 = time.monotonic()
+    cfg = global_cfg if cfg is None else cfg
+    tree = main.get_file_dir_tree(files_dirs, cfg=cfg)
+    own_pool = pool is None
+    if own_pool:
+        pool = parallel.get_pool(nprocs=cfg.nprocs, nthreads=cfg.nthreads)
+    merkle_tree = calc.MerkleTree(tree, cfg=cfg, pool=pool)
+    batch_size = BATCH_PER_WORKER * cfg.nprocs * cfg.nthreads
+    ngroups = 0
+    total = 0
+    try:
+        for batch in _batches(size_groups(tree), batch_size):
+            merkle_tree.calc_leaf_fprs(leafs=[leaf for leafs in batch
+                                              for leaf in leafs])
+            fprs = merkle_tree.leaf_fprs
+            found = []
+            for leafs in batch:
+                by_fpr = defaultdict(list)
+                for leaf in leafs:
+                    fpr = fprs[leaf.path]
+                    if fpr not in (calc.MISSING_FILE_FPR,
+                                   calc.UNREADABLE_FILE_FPR):
+                        by_fpr[fpr].append(leaf.path)
+                size = leafs[0].filesize
+                found += [dict(size=size, count=len(paths),
+                               waste=size * (len(paths) - 1),
+                               paths=sorted(paths))
+                          for paths in by_fpr.values() if len(paths) > 1]
+            found.sort(key=lambda group: group['waste'], reverse=True)
+            for group in found:
+                yield group
+                ngroups += 1
+                total += group['waste']
+                if (top is not None and ngroups >= top) or \
+                        (target is not None and total >= target):
+                    return
+            if budget is not None and time.monotonic() - t0 >= budget:
+                return
+    finally:
+        if own_pool:
+            pool.shutdown()
@@ -0,0 +1,202 @@
+"""Watch leaf fpr calculation for stalled reads, e.g. on hung network file
+systems.
+
+A read on a dead NFS mount can block forever and can't be interrupted from
+Python. With cfg.stall_timeout and/or cfg.file_timeout, leaf fprs are
+calculated by Watchdog.run() instead of the pool (see
+calc.MerkleTree.calc_leaf_fprs()):
+
+* each read in flight is timed, reads taking longer than `stall_timeout`
+  are reported (stderr) and their device (st_dev) is marked as slow: no new
+  files from a slow device are started while it has a stalled read, we
+  work on files on other devices instead
+* reads taking longer than `file_timeout` are given up: the file gets
+  calc.UNREADABLE_FILE_FPR, the blocked worker thread is left behind (it's a
+  daemon thread, so it doesn't block the exit) and replaced by a new one;
+  after `max_timeouts` given up files on a device, all other files on it
+  are marked unreadable w/o trying
+* read errors (OSError, e.g. EIO) also give calc.UNREADABLE_FILE_FPR
+
+Work is done by ``nprocs * nthreads`` threads, no processes.
+"""
+
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from findsame import calc
+
+# number of given up files after which a device is considered dead
+MAX_TIMEOUTS = 3
+
+
+def _report(msg):
+    print(f"findsame: {msg}", file=sys.stderr, flush=True)
+
+
+def _work(jobs, results):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        jid, leaf = job
+        results.put((jid, 'start', time.monotonic()))
+        try:
+            # not leaf.fpr: an abandoned thread must not set it later
+            ret = leaf._get_fpr()
+        except OSError as ex:
+            ret = ex
+        results.put((jid, 'done', ret))
+
+
+class Watchdog:
+    """
+    Parameters
+    ----------
+    nworkers : int
+        number of threads
+    stall_timeout : float, None
+        report reads taking longer than that many seconds, None = use
+        `file_timeout`
+    file_timeout : float, None
+        give up on reads taking longer than that, None = never
+    max_timeouts : int
+        give up on a device after that many timeouts
+    poll : float, None
+        check in-flight reads that often (seconds), None = derive from the
+        timeouts
+    """
+    def __init__(self, nworkers=1, stall_timeout=None, file_timeout=None,
+                 max_timeouts=MAX_TIMEOUTS, poll=None):
+        self.nworkers = nworkers
+        self.stall_timeout = file_timeout if stall_timeout is None else \
+            stall_timeout
+        self.file_timeout = file_timeout
+        self.max_timeouts = max_timeouts
+        timeouts = [tt for tt in [stall_timeout, file_timeout] if tt]
+        self.poll = poll if poll is not None else \
+            min([1.0] + [tt / 10 for tt in timeouts])
+        self.stalled = []
+        self.unreadable = []
+        self.dead_devices = []
+
+    def report(self):
+        """Dict with stalled and unreadable paths and dead devices."""
+        return dict(stalled=self.stalled, unreadable=self.unreadable,
+                    dead_devices=self.dead_devices)
+
+    def run(self, leafs):
+        """Yield ``(leaf, fpr)`` for all `leafs` (calc.Leaf), in the order
+        they finish."""
+        jobs = queue.Queue()
+        results = queue.Queue()
+        nthreads = 0
+
+        def add_worker():
+            nonlocal nthreads
+            threading.Thread(target=_work, args=(jobs, results),
+                             daemon=True).start()
+            nthreads += 1
+
+        for _ in range(self.nworkers):
+            add_worker()
+        # device -> files to do, in order of appearance
+        todo = OrderedDict()
+        for leaf in leafs:
+            todo.setdefault(getattr(leaf, 'dev', None), deque()).append(leaf)
+        # job id -> [leaf, start time (None = not started), stalled]
+        inflight = {}
+        # devices with a stalled read
+        slow = set()
+        ntimeouts = {}
+        idle = self.nworkers
+        jid = 0
+        try:
+            while todo or inflight:
+                while idle > 0:
+                    leaf = self._next(todo, slow)
+                    if leaf is None:
+                        break
+                    inflight[jid] = [leaf, None, False]
+                    jobs.put((jid, leaf))
+                    jid += 1
+                    idle -= 1
+                try:
+                    rjid, what, val = results.get(timeout=self.poll)
+                except queue.Empty:
+                    pass
+                else:
+                    # results of given up jobs are ignored
+                    if rjid in inflight:
+                        if what == 'start':
+                            inflight[rjid][1] = val
+                        else:
+                            leaf, _, stalled = inflight.pop(rjid)
+                            idle += 1
+                            if stalled:
+                                _report(f"stalled read finished: "
+                                        f"{leaf.path}")
+                            if isinstance(val, OSError):
+                                _report(f"read error: {leaf.path}: {val}")
+                                self.unreadable.append(leaf.path)
+                                val = calc.UNREADABLE_FILE_FPR
+                            yield leaf, val
+                slow.clear()
+                now = time.monotonic()
+                for rjid, entry in list(inflight.items()):
+                    leaf, start, stalled = entry
+                    if start is None:
+                        continue
+                    elapsed = now - start
+                    dev = getattr(leaf, 'dev', None)
+                    if self.stall_timeout is not None and \
+                            elapsed > self.stall_timeout:
+                        slow.add(dev)
+                        if not stalled:
+                            entry[2] = True
+                            self.stalled.append(leaf.path)
+                            _report(f"stalled read ({elapsed:.0f} s): "
+                                    f"{leaf.path}")
+                    if self.file_timeout is not None and \
+                            elapsed > self.file_timeout:
+                        del inflight[rjid]
+                        _report(f"give up after {elapsed:.0f} s: "
+                                f"{leaf.path}")
+                        self.unreadable.append(leaf.path)
+                        yield leaf, calc.UNREADABLE_FILE_FPR
+                        # the blocked thread is left behind, start a new
+                        # one in its place
+                        add_worker()
+                        idle += 1
+                        ntimeouts[dev] = ntimeouts.get(dev, 0) + 1
+                        if ntimeouts[dev] >= self.max_timeouts and \
+                                dev in todo:
+                            rest = todo.pop(dev)
+                            _report(f"give up on device {dev}, skip "
+                                    f"{len(rest)} more files")
+                            self.dead_devices.append(dev)
+                            for skipped in rest:
+                                self.unreadable.append(skipped.path)
+                                yield skipped, calc.UNREADABLE_FILE_FPR
+        finally:
+            for _ in range(nthreads):
+                jobs.put(None)
+
+    @staticmethod
+    def _next(todo, slow):
+        """Next leaf to start, round-robin over devices w/o a stalled read.
+        None if there is none."""
+        for dev in list(todo):
+            if dev in slow:
+                continue
+            files = todo[dev]
+            leaf = files.popleft()
+            if files:
+                # to the end, next call takes the next device
+                todo.move_to_end(dev)
+            else:
+                del todo[dev]
+            return leaf
+        return None
@@ -2,8 +2,7 @@ import os
 from setuptools import setup, find_packages
 
 here = os.path.abspath(os.path.dirname(__file__))
-bindir = 'bin'
-with open(os.path.join(here, 'README.rst')) as fd:
+with open(os.path.join(here, 'README.md')) as fd:
     long_description = fd.read()
 
 
@@ -12,6 +11,7 @@ setup(
     version='0.1.2',
     description='Find duplicate files and directories using hashes and a Merkle tree',
     long_description=long_description,
+    long_description_content_type='text/markdown',
     url='https://github.com/elcorto/findsame',
     author='Steve Schmerler',
     author_email='git@elcorto.com',
@@ -19,5 +19,6 @@ setup(
     keywords='merkle-tree hash duplicates multithreading multiprocessing',
     packages=find_packages(include=('findsame',),
                            exclude=('findsame/test', 'benchmark')),
-    scripts=[f'{bindir}/{script}' for script in os.listdir(bindir)]
+    # bin/findsame is the same for running from a source checkout
+    entry_points={'console_scripts': ['findsame=findsame.cli:run']},
 )